@@ -32,14 +32,60 @@ class ConfigManager:
                 "socket_buffer_size": 1048576,  # 1MB
                 "disable_nagle": True,
                 "thread_count": 4,
+                "hash_workers": 0,  # 新增：清单哈希并行数（0为自动）
+                "hash_use_processes": False,  # 新增：清单哈希使用进程池
+                "walk_workers": 1,  # 新增：目录遍历并行数
                 "use_memory_mapping": True,  # 新增：启用内存映射
                 "use_stream_protocol": True,  # 新增：启用流式协议
+                "use_sendfile": True,  # 新增：未压缩文件使用 sendfile 零拷贝发送
+                "multi_stream_count": 4,  # 新增：大文件并行数据连接数（小于2时不使用）
+                "multi_stream_threshold": 67108864,  # 新增：使用并行数据连接的文件大小阈值64MB
+                "delta_transfer": True,  # 新增：已有旧版本的大文件只传输变化部分
+                "delta_threshold": 4194304,  # 新增：增量传输的文件大小阈值4MB
+                "chunk_dedup": False,  # 新增：大文件按内容分块，只传输接收方本地没有的块（默认关闭）
+                "chunk_threshold": 1048576,  # 新增：块去重传输的文件大小阈值1MB
+                "file_batch": True,  # 新增：小文件打包成批量消息发送
+                "batch_file_threshold": 65536,  # 新增：参与批量发送的文件大小上限64KB
+                "batch_max_bytes": 4194304,  # 新增：单个批量消息的内容上限4MB
+                "batch_write_workers": 4,  # 新增：接收方写入批量文件的线程数
+                "resumable_transfers": True,  # 新增：保存中断的大文件，下次同步时续传
+                "resume_min_bytes": 8388608,  # 新增：中断时至少收到8MB才保存部分文件
+                "hash_while_transfer": True,  # 新增：传输时计算摘要，接收方替换前校验并记入哈希缓存
+                "write_behind_depth": 8,  # 新增：接收大文件时读写分离的缓冲区个数（0为不使用）
+                "write_behind_buffer_size": 1048576,  # 新增：后台写入的缓冲区大小1MB
+                "write_behind_threshold": 4194304,  # 新增：使用后台写入的文件大小阈值4MB
+                "read_ahead_depth": 4,  # 新增：发送时后台预读的块数（0为不预读）
+                "read_ahead_memory": 16777216,  # 新增：预读缓冲区的内存上限16MB
+                "read_ahead_files": 2,  # 新增：发送大文件时提示内核预读的后续文件数
+                "sparse_transfer": True,  # 新增：稀疏文件只传输数据区段，接收方保留空洞
+                "sparse_threshold": 1048576,  # 新增：按稀疏文件传输的最小文件大小1MB
+                "want_policy": "smallest",  # 新增：需求文件顺序 smallest/largest/newest/manifest
+                "want_in_flight": 1024,  # 新增：最多同时请求的文件数（0为一次请求全部）
+                "want_chunk_size": 256,  # 新增：每条需求消息的文件数
                 "dynamic_chunk_size": True,  # 新增：启用动态块大小
                 "max_chunk_size": 1048576,  # 新增：最大块大小1MB
                 "min_chunk_size": 65536,  # 新增：最小块大小64KB
                 "compression_threshold": 1048576,  # 新增：压缩阈值1MB
                 "enable_compression": False,  # 新增：启用压缩
-                "adaptive_threading": True  # 新增：自适应线程数
+                "compression_level": 1,  # 新增：分帧压缩的 zlib 级别
+                "compression_sample_size": 65536,  # 新增：按文件试压缩的样本大小64KB
+                "link_speed_mbps": 1000,  # 新增：链路速度初始估计，之后按实测更新
+                "adaptive_threading": True,  # 新增：自适应线程数
+                "use_hash_cache": True,  # 新增：持久化哈希缓存
+                "hash_cache_xattr": False,  # 新增：哈希缓存写入扩展属性（仅Linux）
+                "lazy_hashing": True,  # 新增：懒哈希，只为有歧义的文件计算摘要
+                "hash_verify_policy": "lazy",  # 新增：摘要校验策略 lazy/always
+                "digest_algorithms": ["blake2b", "blake2s", "sha256"],  # 新增：可协商的摘要算法
+                "digest_size": 32,  # 新增：blake2 摘要字节数
+                "stream_manifest": True,  # 新增：流式清单
+                "manifest_batch_size": 1000,  # 新增：流式清单每批条目数
+                "merkle_tree": True,  # 新增：先比较目录摘要，只交换有差异的子目录
+                "binary_manifest": True,  # 新增：二进制清单编码
+                "manifest_compression": True,  # 新增：二进制清单 zlib 压缩
+                "sync_journal": True,  # 新增：按对端记录同步日志，只交换变化的清单条目
+                "watch_debounce": 0.5,  # 新增：监视模式防抖时间（秒）
+                "watch_rescan_interval": 300,  # 新增：监视模式完整扫描间隔（秒）
+                "manifest_store": "memory"  # 新增：清单存储 memory/sqlite
             }
         }
         self.config = self._load_config()
@@ -1,7 +1,9 @@
 """双向同步模块"""
 
 import socket
+import logging
 import threading
+from collections import deque
 from pathlib import Path
 
 # 添加项目根目录到Python路径
@@ -12,56 +14,258 @@ if str(project_root) not in sys.path:
 
 from .helpers import get_socket_buffer_size, should_disable_nagle, get_thread_count
 from .network_services import create_socket_with_performance_settings
-from .helpers import send_json, recv_json, build_manifest
-from .file_transfer import send_file_by_rel, receive_file
+from .helpers import (
+    send_json, recv_json, build_manifest, should_compress_manifest, should_use_sync_journal,
+    should_use_sqlite_manifest
+)
+from .manifest_diff import is_newer, exchange_digests
+from .protocol import (
+    build_hello, negotiate_features, negotiate_digest_algorithm,
+    FEATURE_LAZY_HASH, FEATURE_STREAM_MANIFEST, FEATURE_MERKLE_TREE, FEATURE_BINARY_MANIFEST,
+    FEATURE_SYNC_JOURNAL, FEATURE_WATCH, FEATURE_MULTI_STREAM, FEATURE_DELTA_TRANSFER,
+    FEATURE_CHUNK_DEDUP, FEATURE_FILE_BATCH, FEATURE_WANT_PIPELINE, FEATURE_RESUME,
+    FEATURE_TRANSFER_DIGEST, FEATURE_SPARSE, negotiate_settings, apply_settings
+)
+from .manifest_store import (
+    ManifestStore, LOCAL, PEER, build_local_store, spool_local_store, ingest_peer_manifest,
+    exchange_store_digests
+)
+from .sync_journal import SyncJournal, local_node_id, manifest_delta, apply_delta
+from .manifest_codec import send_manifest_message, recv_manifest_entries
+from .merkle import MerkleTree, compare_trees
+from .stream_sync import StreamingSync
+from .watch_sync import WatchSync
+from .file_transfer import receive_file
+from .file_batch import send_files, receive_file_batch
+from .multi_stream import new_stream_session, setup_stream_pool, close_stream_pool
+from .delta_transfer import send_signatures, receive_signatures
+from .chunk_store import (
+    exchange_chunk_lists, dedup_candidates, send_chunk_haves, receive_chunk_haves, index_in_background
+)
+from .want_scheduler import WantScheduler
+from .compression import enable_framed_compression
+from .resume import send_resume_requests, receive_resume_request
+from .transfer_digest import enable_transfer_digest
+from .sparse import enable_sparse_transfer
 
 
-def handle_connection(sock, base_dir, log_callback=None):
-    """交换清单并相互请求/发送文件"""
+def handle_connection(sock, base_dir, log_callback=None, watch=False, listener=None):
+    """交换清单并相互请求/发送文件；watch为True且对端也在监视模式时持续同步
+
+    listener 为监听方的监听套接字，用于接受对端为大文件建立的并行数据连接。
+    """
     base_dir = Path(base_dir)
     log_func = log_callback or logging.info
     
     incoming_done = threading.Event()
     outgoing_done = threading.Event()
-    peer_manifest = {}
-    my_manifest = build_manifest(base_dir)
-    log_func('Built local manifest with %d files', len(my_manifest))
-
-    # 发送我的清单
-    send_json(sock, {'type': 'manifest', 'manifest': my_manifest})
-    log_func('Sent local manifest')
+    # 正常完成（而非出错结束）的标记，只有完整的会话才记录同步日志
+    peer_finished = threading.Event()
+    sent_all = threading.Event()
+    received = []
 
-    # 接收对等方清单
+    # 握手：以空清单的形式携带协议信息，旧版本对端会把它当作空清单
+    node_id = local_node_id(base_dir) if should_use_sync_journal() else None
+    extra = [FEATURE_WATCH] if watch else []
+    session = new_stream_session() if listener is not None else None
+    send_json(sock, {'type': 'manifest', 'manifest': {}, 'hello': build_hello(node_id, extra, session)})
     msg = recv_json(sock)
     if not msg or msg.get('type') != 'manifest':
         log_func('Expected manifest from peer, got: %s', msg)
         return
-    peer_manifest = msg['manifest']
-    log_func('Received peer manifest with %d files', len(peer_manifest))
-
-    # 计算需求列表
-    want = []
-    for rel, meta in peer_manifest.items():
-        if rel not in my_manifest:
-            want.append(rel)
-        else:
-            my_meta = my_manifest[rel]
-            if my_meta['sha256'] != meta['sha256'] and meta['mtime'] > my_meta['mtime']:
-                want.append(rel)
-    log_func('Will request %d files from peer', len(want))
-
-    will_send = []
-    for rel, meta in my_manifest.items():
-        if rel not in peer_manifest:
-            will_send.append(rel)
+    peer_hello = msg.get('hello')
+    features = negotiate_features(peer_hello)
+    lazy = FEATURE_LAZY_HASH in features
+    binary = FEATURE_BINARY_MANIFEST in features
+    delta = FEATURE_DELTA_TRANSFER in features
+    dedup = FEATURE_CHUNK_DEDUP in features
+    batched = FEATURE_FILE_BATCH in features
+    pipelined = FEATURE_WANT_PIPELINE in features
+    resume = FEATURE_RESUME in features
+    algorithm = negotiate_digest_algorithm(peer_hello)
+    log_func('Using %s digests', algorithm)
+    settings = negotiate_settings(peer_hello)
+    if settings is not None:
+        # 双方按相同规则得到同一组传输参数，之后不再各自读取配置
+        apply_settings(sock, settings, log_func)
+        if settings['codec']:
+            enable_framed_compression(sock)
+    if FEATURE_TRANSFER_DIGEST in features:
+        # 发送的文件带清单算法的摘要，接收方校验后记入哈希缓存
+        enable_transfer_digest(sock, algorithm)
+    if FEATURE_SPARSE in features:
+        enable_sparse_transfer(sock)
+    if FEATURE_MULTI_STREAM in features:
+        setup_stream_pool(sock, peer_hello.get('streams'), log_func, listener, session)
+
+    if watch:
+        if FEATURE_WATCH in (peer_hello or {}).get('features', []):
+            log_func('Entering watch mode')
+            WatchSync(sock, base_dir, algorithm, lazy, log_func, binary, delta, dedup, batched,
+                      pipelined, resume).run()
+            _close_connection(sock)
+            return
+        log_func('Peer is not in watch mode, running a one-shot sync')
+
+    journal = None
+    use_delta = False
+    if FEATURE_SYNC_JOURNAL in features and lazy:
+        journal = SyncJournal(base_dir, peer_hello['node_id'])
+        use_delta = _journal_matches(sock, journal, log_func)
+        if use_delta is None:
+            return
+
+    # 基线一致时只交换变化；否则目录树大多未变化时 Merkle 比较只需少量往返，优先于流式清单
+    merkle = FEATURE_MERKLE_TREE in features and not use_delta
+    if FEATURE_STREAM_MANIFEST in features and not merkle and not use_delta:
+        session = StreamingSync(sock, base_dir, algorithm, lazy, log_func, binary,
+                                keep_manifest=journal is not None, delta=delta, dedup=dedup,
+                                batched=batched, pipelined=pipelined, resume=resume)
+        session.run()
+        if journal is not None and session.completed:
+            journal.record(session.manifest, session.received)
+        _close_connection(sock)
+        if dedup:
+            index_in_background(base_dir, log_func)
+        return
+
+    if should_use_sqlite_manifest() and peer_hello is not None:
+        want = _diff_with_store(sock, base_dir, algorithm, lazy, binary, log_func)
+        if want is None:
+            return
+        # 本地清单在存储中，发送时按文件实际大小决定是否批量发送
+        my_manifest = None
+        push = []
+        chunk_lists = {}
+        # 需求排序所需的对端条目不在内存中，按清单顺序请求
+        peer_manifest = {}
+    else:
+        my_manifest = build_manifest(base_dir, with_digests=not lazy, algorithm=algorithm)
+        log_func('Built local manifest with %d files', len(my_manifest))
+
+        if peer_hello is None:
+            # 旧版本对端已经发来完整清单，并认为我方没有任何文件
+            log_func('Peer uses legacy protocol')
+            peer_manifest = msg['manifest']
+        elif use_delta:
+            # 双方基线相同：只发送相对基线新增/变化的条目和已删除的路径
+            changed, removed = manifest_delta(journal.baseline, my_manifest)
+            sent = _send_in_background(lambda: send_manifest_message(
+                sock, {'type': 'manifest_delta', 'removed': removed}, 'changed',
+                changed, algorithm, binary, should_compress_manifest()), log_func)
+            msg = recv_json(sock)
+            if not msg or msg.get('type') != 'manifest_delta':
+                log_func('Expected manifest delta from peer, got: %s', msg)
+                return
+            peer_changed = recv_manifest_entries(sock, msg, 'changed')
+            if not sent():
+                return
+            peer_manifest = apply_delta(journal.baseline, peer_changed, msg.get('removed', []))
+            log_func('Exchanged manifest deltas: sent %d changes, received %d',
+                     len(changed) + len(removed), len(peer_changed) + len(msg.get('removed', [])))
+        elif merkle:
+            # 只获得对端在有差异的目录中的条目
+            peer_manifest = compare_trees(sock, MerkleTree(my_manifest), log_func)
+            if peer_manifest is None:
+                return
         else:
-            peer_meta = peer_manifest[rel]
-            if peer_meta['sha256'] != meta['sha256'] and my_manifest[rel]['mtime'] > peer_meta['mtime']:
-                will_send.append(rel)
-    log_func('Peer may request up to %d files from us', len(will_send))
+            # 在后台发送我的清单，同时接收对端清单，双方同时发送大清单时不会互相阻塞
+            sent = _send_in_background(lambda: send_manifest_message(
+                sock, {'type': 'manifest', 'algorithm': algorithm}, 'manifest',
+                my_manifest, algorithm, binary, should_compress_manifest()), log_func)
+
+            # 接收对等方清单
+            msg = recv_json(sock)
+            if not msg or msg.get('type') != 'manifest':
+                log_func('Expected manifest from peer, got: %s', msg)
+                return
+            peer_manifest = recv_manifest_entries(sock, msg, 'manifest')
+            if not sent():
+                return
+            log_func('Sent local manifest')
+        log_func('Received peer manifest with %d files', len(peer_manifest))
+
+        if lazy and not exchange_digests(sock, base_dir, my_manifest, peer_manifest, algorithm, log_func):
+            return
+
+        # 计算需求列表
+        want = [rel for rel, meta in peer_manifest.items()
+                if is_newer(meta, my_manifest.get(rel), algorithm)]
+        log_func('Will request %d files from peer', len(want))
+
+        chunk_lists = {}
+        if dedup:
+            # 大文件先取得块列表，之后只请求本地块索引中没有的块
+            sizes = {rel: peer_manifest[rel]['size'] for rel in want}
+            paths = dedup_candidates(base_dir, sizes, delta)
+            chunk_lists = exchange_chunk_lists(sock, base_dir, paths, log_func)
+            if chunk_lists is None:
+                return
+
+        push = []
+        if not merkle:
+            will_send = [rel for rel, meta in my_manifest.items()
+                         if is_newer(meta, peer_manifest.get(rel), algorithm)]
+            log_func('Peer may request up to %d files from us', len(will_send))
+            # 旧版本对端不会请求它不知道的文件，由我方随其请求一并推送
+            if peer_hello is None:
+                push = will_send
+
+    # 需求按策略排序，对端支持时分块发出，未完成的请求数有上限
+    scheduler = WantScheduler(pipelined)
+    scheduler.add((rel, peer_manifest.get(rel, {})) for rel in want)
+    scheduler.finish()
+    control_sent = threading.Event()
+    cond = threading.Condition()
+    serve = deque()
+    peer_wants_done = False
+    closed = False
+
+    def writer():
+        """发出需求、发送对端请求的文件，最后发送 done_sending"""
+        try:
+            # 我方的签名和已有块发完后才能发出需求和文件数据，避免交错
+            control_sent.wait()
+            while True:
+                with cond:
+                    while True:
+                        if closed or (sent_all.is_set() and scheduler.final_sent):
+                            return
+                        if scheduler.ready():
+                            kind, item = 'want', scheduler.next_want()
+                        elif serve:
+                            kind, item = 'files', serve.popleft()
+                        elif peer_wants_done and not sent_all.is_set():
+                            kind, item = 'done', None
+                        else:
+                            cond.wait()
+                            continue
+                        break
+
+                if kind == 'want':
+                    send_json(sock, item)
+                    log_func('Sent want for %d files to peer', len(item['files']))
+                elif kind == 'files':
+                    _, failed = send_files(sock, base_dir, item, log_func, batched, my_manifest)
+                    if failed and pipelined:
+                        # 对端据此释放未完成的请求数
+                        send_json(sock, {'type': 'unavailable', 'files': failed})
+                else:
+                    send_json(sock, {'type': 'done_sending'})
+                    sent_all.set()
+        except Exception as e:
+            log_func('Sender error: %s', e)
+        finally:
+            outgoing_done.set()
+
+    def completed(count):
+        with cond:
+            scheduler.completed(count)
+            cond.notify()
 
     def receiver():
-        nonlocal incoming_done
+        nonlocal incoming_done, peer_wants_done, closed
+        pushed = False
         try:
             while True:
                 m = recv_json(sock)
@@ -71,37 +275,157 @@ def handle_connection(sock, base_dir, log_callback=None):
                 t = m.get('type')
                 if t == 'want':
                     files = m.get('files', [])
+                    if not pushed:
+                        files = files + push
+                        pushed = True
                     log_func('Peer requested %d files', len(files))
-                    for f in files:
-                        try:
-                            send_file_by_rel(sock, base_dir, f)
-                            log_func('Sent file to peer: %s', f)
-                        except Exception as e:
-                            log_func('Failed to send file %s: %s', f, e)
-                    send_json(sock, {'type': 'done_sending'})
+                    # 由写线程发送，接收线程继续读取，双方同时发送大文件时不会互相阻塞
+                    with cond:
+                        if files:
+                            serve.append(files)
+                        if not m.get('more'):
+                            peer_wants_done = True
+                        cond.notify()
+                elif t == 'signatures':
+                    receive_signatures(sock, m)
+                elif t == 'resume':
+                    receive_resume_request(sock, m)
+                elif t == 'chunk_have':
+                    receive_chunk_haves(sock, m)
                 elif t == 'file':
                     receive_file(sock, base_dir, m)
+                    received.append(m['path'])
                     log_func('Received file from peer: %s', m['path'])
+                    completed(1)
+                elif t == 'file_batch':
+                    paths = receive_file_batch(sock, base_dir, m)
+                    received.extend(paths)
+                    log_func('Received batch of %d files from peer', len(paths))
+                    completed(len(m['files']))
+                elif t == 'unavailable':
+                    log_func('Peer could not send %d requested files', len(m.get('files', [])))
+                    completed(len(m.get('files', [])))
                 elif t == 'done_sending':
                     log_func('Peer finished sending requested files')
+                    peer_finished.set()
                     incoming_done.set()
                 else:
                     log_func('Unknown message type: %s', t)
         except Exception as e:
-            log_func('Receiver error: %s', e)
+            # 双方都完成后连接被关闭，读取失败属于正常结束
+            if not (incoming_done.is_set() and outgoing_done.is_set()):
+                log_func('Receiver error: %s', e)
         finally:
+            with cond:
+                closed = True
+                cond.notify()
             incoming_done.set()
+            outgoing_done.set()
 
+    # 接收线程先启动，双方同时发送签名时不会互相阻塞
     recv_thread = threading.Thread(target=receiver, daemon=True)
     recv_thread.start()
+    threading.Thread(target=writer, daemon=True).start()
 
-    send_json(sock, {'type': 'want', 'files': want})
-    log_func('Sent want list to peer')
+    try:
+        if resume:
+            send_resume_requests(sock, base_dir, want, peer_manifest, log_func)
+        if delta:
+            send_signatures(sock, base_dir, want, log_func)
+        if chunk_lists:
+            reused = sum(send_chunk_haves(sock, base_dir, rel, chunks, log_func)
+                         for rel, chunks in chunk_lists.items())
+            log_func('%d bytes of requested files are already present locally', reused)
+    finally:
+        control_sent.set()
 
     log_func('Waiting for peer to send files we requested...')
     incoming_done.wait(timeout=300)
     log_func('Incoming phase done (or timeout)')
-    
+    # 等待对端请求的文件发送完毕再关闭连接
+    outgoing_done.wait(timeout=300)
+    if journal is not None and peer_finished.is_set() and sent_all.is_set():
+        journal.record(my_manifest, received)
+    _close_connection(sock)
+    if dedup:
+        index_in_background(base_dir, log_func)
+
+
+def _send_in_background(send_func, log_func):
+    """在后台线程发送，返回等待发送完成的函数（成功时返回True）"""
+    errors = []
+
+    def target():
+        try:
+            send_func()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+
+    def wait():
+        thread.join()
+        if errors:
+            log_func('Failed to send manifest: %s', errors[0])
+            return False
+        return True
+    return wait
+
+
+def _diff_with_store(sock, base_dir, algorithm, lazy, binary, log_func):
+    """使用 SQLite 清单存储完成清单交换和比较，返回需求列表（失败返回None）"""
+    store = ManifestStore(algorithm)
+    try:
+        count = build_local_store(base_dir, store, with_digests=not lazy)
+        log_func('Built local manifest with %d files (SQLite store)', count)
+        spool = spool_local_store(store, binary, should_compress_manifest())
+
+        def send_spool():
+            with spool:
+                while True:
+                    chunk = spool.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    sock.sendall(chunk)
+        sent = _send_in_background(send_spool, log_func)
+
+        msg = recv_json(sock)
+        if not msg or msg.get('type') != 'manifest':
+            log_func('Expected manifest from peer, got: %s', msg)
+            return None
+        count = ingest_peer_manifest(sock, store, msg)
+        if not sent():
+            return None
+        log_func('Received peer manifest with %d files', count)
+
+        if lazy and not exchange_store_digests(sock, base_dir, store, log_func):
+            return None
+
+        want = store.newer(PEER, LOCAL)
+        log_func('Will request %d files from peer', len(want))
+        log_func('Peer may request up to %d files from us', len(store.newer(LOCAL, PEER)))
+        return want
+    finally:
+        store.close()
+
+
+def _journal_matches(sock, journal, log_func):
+    """交换同步日志基线的校验和，双方一致返回True；连接失败返回None"""
+    send_json(sock, {'type': 'journal', 'checksum': journal.checksum})
+    msg = recv_json(sock)
+    if not msg or msg.get('type') != 'journal':
+        log_func('Expected journal checksum from peer, got: %s', msg)
+        return None
+    if journal.checksum is None or msg.get('checksum') != journal.checksum:
+        log_func('No matching sync journal with peer, exchanging full state')
+        return False
+    log_func('Sync journal matches peer (%d baseline files)', len(journal.baseline))
+    return True
+
+
+def _close_connection(sock):
+    """关闭连接"""
     try:
         sock.shutdown(socket.SHUT_RDWR)
     except Exception:
@@ -109,60 +433,33 @@ def handle_connection(sock, base_dir, log_callback=None):
     sock.close()
 
 
-def run_listen(port, base_dir, log_callback=None, bind='0.0.0.0'):
-    """运行监听模式"""
+def run_listen(port, base_dir, log_callback=None, bind='0.0.0.0', watch=False):
+    """运行监听模式（使用性能配置）"""
     log_func = log_callback or logging.info
     log_func('Listening on %s:%d', bind, port)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    with create_socket_with_performance_settings() as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((bind, port))
         s.listen(1)
         conn, addr = s.accept()
         log_func('Accepted connection from %s:%d', addr[0], addr[1])
         with conn:
-            handle_connection(conn, base_dir, log_callback)
+            try:
+                handle_connection(conn, base_dir, log_callback, watch, listener=s)
+            finally:
+                close_stream_pool(conn)
 
 
-def run_connect(host, port, base_dir, log_callback=None):
-    """运行连接模式"""
+def run_connect(host, port, base_dir, log_callback=None, watch=False):
+    """运行连接模式（使用性能配置）"""
     log_func = log_callback or logging.info
     log_func('Connecting to %s:%d ...', host, port)
-    with socket.create_connection((host, port), timeout=30) as sock:
-        log_func('Connected to %s:%d', host, port)
-        handle_connection(sock, base_dir, log_callback)
-
-
-def run_listen(port, folder, log_callback):
-    """监听模式（使用性能配置）"""
-    try:
-        sock = create_socket_with_performance_settings()
-        sock.bind(('0.0.0.0', port))
-        sock.listen(1)
-        log_callback(f'监听端口 {port}，等待连接...')
-        
-        conn, addr = sock.accept()
-        log_callback(f'接收到来自 {addr[0]}:{addr[1]} 的连接')
-        
-        # 执行双向同步逻辑
-        perform_bidirectional_sync(conn, folder, log_callback)
-        
-        conn.close()
-        sock.close()
-        log_callback('同步完成')
-    except Exception as e:
-        log_callback(f'同步错误: {e}')
-
-def run_connect(host, port, folder, log_callback):
-    """连接模式（使用性能配置）"""
-    try:
-        sock = create_socket_with_performance_settings()
+    with create_socket_with_performance_settings() as sock:
+        sock.settimeout(30)
         sock.connect((host, port))
-        log_callback(f'已连接到 {host}:{port}')
-        
-        # 执行双向同步逻辑
-        perform_bidirectional_sync(sock, folder, log_callback)
-        
-        sock.close()
-        log_callback('同步完成')
-    except Exception as e:
-        log_callback(f'同步错误: {e}')
\ No newline at end of file
+        sock.settimeout(None)
+        log_func('Connected to %s:%d', host, port)
+        try:
+            handle_connection(sock, base_dir, log_callback, watch)
+        finally:
+            close_stream_pool(sock)
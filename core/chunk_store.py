@@ -0,0 +1,551 @@
+"""内容定义分块模块 - 按内容切分大文件，只传输接收方本地没有的块
+
+文件按内容切成平均约百KB的块（边界只取决于附近的数据，插入或删除只影响
+附近的块），块以 blake2b-256 摘要标识。每个同步根目录在 .lan_sync 中保存
+块索引（摘要 -> 文件、偏移），接收方先请求需求文件的块列表，只告诉发送方
+哪些块本地已有；发送方对这些块（以及同一文件中重复出现的块）只发送引用，
+接收方从本地文件复制，其余块经连接传输，逐块校验后组装到 .tmp 再替换。
+
+消息：chunk_request {'paths'}；chunk_list {'path', 'count'} 后跟 count 条
+(4字节长度 + 32字节摘要)；chunk_have {'path', 'count'} 后跟 count 个摘要。
+块流（文件头带 'chunked' 字段）：
+    b'D' + 长度 + 摘要 + 数据
+    b'R' + 长度 + 摘要（接收方本地已有）
+    b'E'
+"""
+
+import os
+import mmap
+import zlib
+import time
+import random
+import sqlite3
+import struct
+import hashlib
+import logging
+import threading
+import weakref
+from pathlib import Path
+
+from .helpers import (
+    SYNC_META_DIR, send_json, recv_json, apply_file_mtime, get_walk_workers, get_chunk_threshold,
+    get_delta_threshold
+)
+from .socket_reader import get_reader
+from .walker import walk_tree
+from .resume import save_partial
+from .sparse import should_send_sparse
+from .transfer_digest import (
+    start_send_digest, start_receive_digest, verify_received, discard_digest, record_received
+)
+
+INDEX_FILE_NAME = 'chunk_index.db'
+DIGEST_SIZE = 32
+CHUNK_ENTRY = struct.Struct('>I32s')
+OP_DATA = b'D'
+OP_REUSE = b'R'
+OP_END = b'E'
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 512 * 1024
+# 候选锚点：字节映射到4个字母后出现固定的4字母序列（随机数据中约1/256的位置）
+_ANCHOR_TABLE = bytes(random.Random(0x1a75).sample([97 + i % 4 for i in range(256)], 256))
+_ANCHOR = b'bdac'
+# 候选处再以结尾32字节的 CRC32 确认（1/256），数据分布不均匀时平均块大小也基本稳定
+_WINDOW = 32
+_CUT_MASK = 0xff
+# 每次映射转换的数据量
+_SCAN_SIZE = 8 * 1024 * 1024
+_FLUSH_SIZE = 256 * 1024
+# 两次补齐索引（遍历目录树）的最短间隔（秒）
+_REFRESH_INTERVAL = 60
+
+_haves = weakref.WeakKeyDictionary()
+_haves_lock = threading.Lock()
+
+# 每个同步根目录共享一个索引实例
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def iter_chunks(data):
+    """产出内容定义的块 (偏移, 长度)
+
+    逐字节滚动哈希在 Python 中太慢：先用 bytes.translate 和 find 在C代码中找出
+    候选锚点，只对候选位置计算结尾窗口的 CRC32，切点仍然只取决于它前面的数据。
+    """
+    n = len(data)
+    start = scan_start = 0
+    scan = b''
+    while start < n:
+        if n - start <= MIN_CHUNK:
+            yield start, n - start
+            return
+        lo = start + MIN_CHUNK - len(_ANCHOR)
+        hi = min(start + MAX_CHUNK, n)
+        if lo < scan_start or hi > scan_start + len(scan):
+            scan_start = lo
+            scan = bytes(data[lo:lo + _SCAN_SIZE]).translate(_ANCHOR_TABLE)
+        cut = hi
+        i = scan.find(_ANCHOR, lo - scan_start, hi - scan_start)
+        while i >= 0:
+            end = scan_start + i + len(_ANCHOR)
+            if not zlib.crc32(data[end - _WINDOW:end]) & _CUT_MASK:
+                cut = end
+                break
+            i = scan.find(_ANCHOR, i + 1, hi - scan_start)
+        yield start, cut - start
+        start = cut
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def chunk_file(path):
+    """切分文件，返回 [(偏移, 长度, 摘要), ...]"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return []
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            chunks = []
+            for offset, length in iter_chunks(view):
+                with view[offset:offset + length] as chunk:
+                    chunks.append((offset, length, _digest(chunk)))
+            return chunks
+
+
+def get_chunk_index(base_dir):
+    """获取（必要时打开）同步根目录对应的块索引"""
+    root = str(Path(base_dir).resolve())
+    with _indexes_lock:
+        index = _indexes.get(root)
+        if index is not None and not index.path.exists():
+            # 元数据目录被删除，重新建立索引
+            index.close()
+            index = None
+        if index is None:
+            index = _indexes[root] = ChunkIndex(root)
+        return index
+
+
+class ChunkIndex:
+    """同步根目录的块索引（``<根目录>/.lan_sync/chunk_index.db``）
+
+    按 (大小, mtime_ns) 判断文件的索引是否仍然有效；从本地文件取块时再校验摘要，
+    索引之后被修改的文件不会产生错误的数据。
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = Path(base_dir)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._refreshed = None
+        self._refreshing = None
+        self.path = self.base_dir / SYNC_META_DIR / INDEX_FILE_NAME
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 同一会话的发送线程和接收线程共用连接，由 _lock 串行化
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                digest BLOB NOT NULL,
+                path TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS chunks_digest ON chunks (digest)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path)')
+        self.db.commit()
+        # 从未建立过索引：第一次补齐完成前不使用
+        self._cold = self.db.execute('SELECT 1 FROM files LIMIT 1').fetchone() is None
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def _indexed(self, rel):
+        return self.db.execute('SELECT size, mtime_ns FROM files WHERE path = ?', (rel,)).fetchone()
+
+    def _store(self, rel, st, chunks):
+        self.db.execute('DELETE FROM chunks WHERE path = ?', (rel,))
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (rel, st.st_size, st.st_mtime_ns))
+        self.db.executemany('INSERT INTO chunks VALUES (?, ?, ?, ?)',
+                            [(digest, rel, offset, length) for offset, length, digest in chunks])
+        self.db.commit()
+
+    def _forget(self, rel):
+        self.db.execute('DELETE FROM chunks WHERE path = ?', (rel,))
+        self.db.execute('DELETE FROM files WHERE path = ?', (rel,))
+        self.db.commit()
+
+    def record(self, rel, st, chunks):
+        """记录文件的块列表（st 为写入后的 stat 结果）"""
+        with self._lock:
+            self._store(rel, st, chunks)
+
+    def chunks_of(self, rel, st):
+        """本地文件的块列表，索引与 st 不符时重新切分"""
+        with self._lock:
+            if self._indexed(rel) == (st.st_size, st.st_mtime_ns):
+                return self.db.execute('SELECT offset, length, digest FROM chunks WHERE path = ? '
+                                       'ORDER BY offset', (rel,)).fetchall()
+        chunks = chunk_file(self.base_dir / rel)
+        with self._lock:
+            self._store(rel, st, chunks)
+        return chunks
+
+    def refresh(self, log_func):
+        """为达到阈值的本地文件补齐索引，删除已不存在的文件（间隔内只遍历一次）"""
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshed is not None and now - self._refreshed < _REFRESH_INTERVAL:
+                return
+            self._refreshed = now
+            indexed = {rel: (size, mtime_ns) for rel, size, mtime_ns
+                       in self.db.execute('SELECT path, size, mtime_ns FROM files')}
+        threshold = get_chunk_threshold()
+        count = 0
+        for rel, fpath, st in walk_tree(self.base_dir, workers=get_walk_workers(),
+                                        skip_root_dirs=(SYNC_META_DIR,)):
+            current = indexed.pop(rel, None)
+            if st.st_size < threshold or rel.endswith('.tmp'):
+                continue
+            if current == (st.st_size, st.st_mtime_ns):
+                continue
+            try:
+                chunks = chunk_file(fpath)
+            except OSError as e:
+                self.logger.warning('Cannot index chunks of %s: %s', rel, e)
+                continue
+            self.record(rel, st, chunks)
+            count += 1
+        with self._lock:
+            for rel in indexed:
+                self._forget(rel)
+            self._cold = False
+        if count:
+            log_func('Indexed chunks of %d local files', count)
+
+    def is_cold(self):
+        """索引还没有建立过（第一次补齐尚未完成）"""
+        return self._cold
+
+    def refresh_in_background(self, log_func):
+        """在后台线程中补齐索引，不阻塞当前同步（已在进行时直接返回）"""
+        with self._lock:
+            if self._refreshing is not None and self._refreshing.is_alive():
+                return
+            self._refreshing = threading.Thread(target=self._refresh_quietly, args=(log_func,),
+                                                daemon=True)
+            self._refreshing.start()
+
+    def _refresh_quietly(self, log_func):
+        try:
+            self.refresh(log_func)
+        except Exception as e:
+            self.logger.warning('Chunk index refresh failed: %s', e)
+
+    def has(self, digest):
+        """本地是否有仍然有效的该块"""
+        return self._locate(digest) is not None
+
+    def _locate(self, digest):
+        with self._lock:
+            rows = self.db.execute(
+                'SELECT chunks.path, offset, length, size, mtime_ns FROM chunks '
+                'JOIN files ON files.path = chunks.path WHERE digest = ?', (digest,)).fetchall()
+        for rel, offset, length, size, mtime_ns in rows:
+            try:
+                st = (self.base_dir / rel).stat()
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+                return rel, offset, length
+        return None
+
+    def read_chunk(self, digest, length):
+        """从本地文件读取块并校验摘要，找不到时返回 None"""
+        found = self._locate(digest)
+        if found is None or found[2] != length:
+            return None
+        rel, offset, length = found
+        try:
+            with open(self.base_dir / rel, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except OSError:
+            return None
+        return data if _digest(data) == digest else None
+
+
+def index_in_background(base_dir, log_func):
+    """同步结束后在后台补齐本地块索引，不与传输争用磁盘和CPU"""
+    get_chunk_index(base_dir).refresh_in_background(log_func)
+
+
+def dedup_candidates(base_dir, sizes, delta):
+    """需求文件中应先请求块列表的路径（sizes 为 {相对路径: 对端大小}）
+
+    delta 为 True 时，本地已有旧版本且会走增量传输的文件不参与。本地块索引
+    还没有建立时不请求块列表，发送方不必为此先切分文件（索引在同步结束后由
+    index_in_background 建立）。
+    """
+    if get_chunk_index(base_dir).is_cold():
+        return []
+    threshold = get_chunk_threshold()
+    delta_threshold = get_delta_threshold()
+    paths = []
+    for rel, size in sizes.items():
+        if size < threshold:
+            continue
+        if delta:
+            try:
+                if (Path(base_dir) / rel).stat().st_size >= delta_threshold:
+                    continue
+            except OSError:
+                pass
+        paths.append(rel)
+    return paths
+
+
+def _read(reader, n):
+    data = reader.read_exact(n)
+    if data is None:
+        raise ConnectionError('Unexpected EOF during chunked transfer')
+    return data
+
+
+# 发送方
+
+def send_chunk_lists(sock, base_dir, paths, log_func):
+    """为对端请求的路径逐个发送块列表（本地不存在的文件发送空列表）"""
+    index = get_chunk_index(base_dir)
+    for rel in paths:
+        chunks = []
+        rel_path = Path(rel)
+        # 稀疏文件之后只发送数据区段，不为切块读取其中的空洞
+        if (not rel_path.is_absolute() and '..' not in rel_path.parts
+                and not should_send_sparse(sock, Path(base_dir) / rel_path)):
+            try:
+                st = (Path(base_dir) / rel_path).stat()
+                chunks = index.chunks_of(rel, st)
+            except OSError as e:
+                log_func('Cannot chunk %s: %s', rel, e)
+        send_json(sock, {'type': 'chunk_list', 'path': rel, 'count': len(chunks)})
+        sock.sendall(b''.join(CHUNK_ENTRY.pack(length, digest) for _, length, digest in chunks))
+
+
+def receive_chunk_haves(sock, msg):
+    """读取对端已有的块摘要，保存到发送该文件时使用"""
+    blob = _read(get_reader(sock), msg['count'] * DIGEST_SIZE)
+    haves = {bytes(blob[i:i + DIGEST_SIZE]) for i in range(0, len(blob), DIGEST_SIZE)}
+    with _haves_lock:
+        _haves.setdefault(sock, {})[msg['path']] = haves
+
+
+def take_chunk_haves(sock, relpath):
+    """取出对端为该文件发来的已有块（没有则返回 None）"""
+    with _haves_lock:
+        return _haves.get(sock, {}).pop(relpath, None)
+
+
+def send_file_chunked(sock, base_dir, relpath, haves):
+    """按块发送文件，对端已有的块和文件内重复的块只发送引用，返回 (复用字节数, 发送字节数)"""
+    path = Path(base_dir) / Path(relpath)
+    reused = sent = 0
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        chunks = get_chunk_index(base_dir).chunks_of(relpath, st)
+        mm = mmap.mmap(f.fileno(), st.st_size, access=mmap.ACCESS_READ) if st.st_size else None
+        try:
+            header = {'type': 'file', 'path': relpath, 'size': st.st_size,
+                      'mtime_ns': st.st_mtime_ns, 'chunked': True}
+            file_digest = start_send_digest(sock, base_dir, path, st, header)
+            send_json(sock, header)
+            seen = set(haves)
+            out = bytearray()
+            with memoryview(mm if mm is not None else b'') as view:
+                for offset, length, digest in chunks:
+                    if file_digest is not None:
+                        # 整个文件的摘要也覆盖只发送引用的块
+                        with view[offset:offset + length] as chunk:
+                            file_digest.update(chunk)
+                    if digest in seen:
+                        out += OP_REUSE + CHUNK_ENTRY.pack(length, digest)
+                        reused += length
+                        if len(out) >= _FLUSH_SIZE:
+                            sock.sendall(out)
+                            out.clear()
+                        continue
+                    out += OP_DATA + CHUNK_ENTRY.pack(length, digest)
+                    sock.sendall(out)
+                    out.clear()
+                    with view[offset:offset + length] as chunk:
+                        sock.sendall(chunk)
+                    seen.add(digest)
+                    sent += length
+            out += OP_END
+            sock.sendall(out)
+            if file_digest is not None:
+                file_digest.finish(sock)
+        finally:
+            if mm is not None:
+                mm.close()
+    return reused, sent
+
+
+# 接收方
+
+def receive_chunk_list(sock, msg):
+    """读取对端发来的块列表，返回 [(长度, 摘要), ...]"""
+    blob = _read(get_reader(sock), msg['count'] * CHUNK_ENTRY.size)
+    return list(CHUNK_ENTRY.iter_unpack(blob))
+
+
+def send_chunk_haves(sock, base_dir, rel, chunks, log_func):
+    """查询本地块索引，告诉对端该文件中哪些块本地已有，返回可复用的字节数"""
+    index = get_chunk_index(base_dir)
+    haves = {}
+    for length, digest in chunks:
+        if digest not in haves and index.has(digest):
+            haves[digest] = length
+    send_json(sock, {'type': 'chunk_have', 'path': rel, 'count': len(haves)})
+    sock.sendall(b''.join(haves))
+    return sum(haves.values())
+
+
+def receive_file_chunked(sock, base_dir, header):
+    """从本地已有块和接收到的块组装文件，全部校验通过时替换，返回是否成功"""
+    logger = logging.getLogger(__name__)
+    reader = get_reader(sock)
+    rel = header['path']
+    rel_path = Path(rel)
+    unsafe = rel_path.is_absolute() or '..' in rel_path.parts
+    if unsafe:
+        logger.error('Rejected unsafe path from peer: %s', rel)
+    out_path = Path(base_dir) / rel_path
+    temp_path = str(out_path) + '.tmp'
+    index = None if unsafe else get_chunk_index(base_dir)
+
+    file_digest = start_receive_digest(header)
+    chunks = []
+    # 本文件中已写入的块：摘要 -> 偏移
+    written = {}
+    ok = True
+    reused = 0
+    f = None
+    pos = 0
+    try:
+        if not unsafe:
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(temp_path, 'w+b')
+        while True:
+            op = _read(reader, 1)
+            if op == OP_END:
+                break
+            if op not in (OP_DATA, OP_REUSE):
+                raise ValueError('Unknown chunk instruction: %r' % op)
+            length, digest = CHUNK_ENTRY.unpack(_read(reader, CHUNK_ENTRY.size))
+            if op == OP_DATA:
+                data = _read(reader, length)
+                if _digest(data) != digest:
+                    ok = False
+            elif f is None:
+                continue
+            elif digest in written:
+                f.flush()
+                data = os.pread(f.fileno(), length, written[digest])
+                reused += length
+            else:
+                data = index.read_chunk(digest, length)
+                if data is None:
+                    # 本地文件在查询索引后被修改或删除
+                    ok = False
+                    data = bytes(length)
+                reused += length
+            if f is not None:
+                f.write(data)
+                if file_digest is not None:
+                    file_digest.update(data)
+            written.setdefault(digest, pos)
+            chunks.append((pos, length, digest))
+            pos += length
+    except OSError:
+        if f is not None:
+            f.close()
+            f = None
+            if ok:
+                # 连接中断：块按文件顺序写入且都已校验，保留前缀供下次续传
+                save_partial(base_dir, header, temp_path, pos)
+        raise
+    finally:
+        if f is not None:
+            f.close()
+
+    if unsafe:
+        discard_digest(sock, header)
+        return False
+    if not verify_received(sock, header, temp_path, file_digest):
+        return False
+    if not ok or pos != header['size']:
+        logger.error('Chunked transfer of %s failed verification, keeping local file', rel)
+        os.remove(temp_path)
+        return False
+    os.replace(temp_path, out_path)
+    apply_file_mtime(out_path, header)
+    record_received(base_dir, out_path, header, file_digest)
+    index.record(rel, out_path.stat(), chunks)
+    logger.info('Chunk-deduplicated file: %s (%d bytes reused, %d bytes received)',
+                rel, reused, pos - reused)
+    return True
+
+
+def exchange_chunk_lists(sock, base_dir, paths, log_func):
+    """双方互相请求需求文件的块列表（双向同步），返回 {相对路径: 块列表}，失败返回 None
+
+    块列表可能很大，回复在后台线程发送，双方同时回复时不会互相阻塞。
+    """
+    send_json(sock, {'type': 'chunk_request', 'paths': paths})
+    lists = {}
+    replying = None
+    errors = []
+
+    def reply(requested):
+        try:
+            send_chunk_lists(sock, base_dir, requested, log_func)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        while replying is None or len(lists) < len(paths):
+            msg = recv_json(sock)
+            if msg is None:
+                log_func('Connection closed during chunk list exchange')
+                return None
+            t = msg.get('type')
+            if t == 'chunk_request' and replying is None:
+                replying = threading.Thread(target=reply, args=(msg.get('paths', []),), daemon=True)
+                replying.start()
+            elif t == 'chunk_list':
+                lists[msg['path']] = receive_chunk_list(sock, msg)
+            else:
+                log_func('Unexpected message during chunk list exchange: %s', t)
+                return None
+    finally:
+        if replying is not None:
+            replying.join()
+    if errors:
+        log_func('Failed to send chunk lists: %s', errors[0])
+        return None
+    return lists
+
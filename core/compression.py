@@ -0,0 +1,171 @@
+"""分帧流式压缩模块 - 按文件抽样决定是否压缩，压缩数据自带帧边界
+
+旧的 compressed 标志逐块调用 zlib.compress，接收方在流式协议下按原始块大小
+读取，因此压缩只能和长度前缀协议一起使用，而且对已压缩的文件（JPEG、压缩包）
+也照样压缩。分帧压缩用一个 zlib.compressobj 压缩整个文件，输出切成带长度
+前缀的帧，以长度为0的帧结束，与使用哪种协议无关。
+
+是否压缩按文件决定：从文件开头、中间和结尾各取一段样本试压缩，得到压缩比和
+压缩速度，再按当前估计的链路速度比较压缩后发送和直接发送的时间，只在能节省
+时间时压缩。链路速度先取配置值，之后按本连接实际的发送速度更新。
+
+文件头：{'type': 'file', ..., 'compression': 'zlib'} 后跟若干帧（4字节长度 + 数据）。
+"""
+
+import time
+import zlib
+import struct
+import threading
+import weakref
+
+from .helpers import (
+    get_compression_level, get_compression_sample_size, get_link_speed_mbps, get_socket_buffer_size
+)
+
+CODEC_ZLIB = 'zlib'
+# 本端支持的压缩编码，按优先顺序
+CODECS = [CODEC_ZLIB]
+_LENGTH = struct.Struct('>I')
+# 压缩后的预计时间低于直接发送的该比例时才压缩，抵消估计误差
+_MIN_GAIN = 0.9
+# 样本段数（开头、中间、结尾）
+_SAMPLES = 3
+# 链路速度的平滑系数
+_SMOOTHING = 0.3
+
+_meters = weakref.WeakKeyDictionary()
+_meters_lock = threading.Lock()
+
+
+class LinkMeter:
+    """按实际发送的字节数和耗时估计链路速度（字节/秒）"""
+
+    def __init__(self):
+        self.speed = get_link_speed_mbps() * 125000
+        self._lock = threading.Lock()
+
+    def record(self, nbytes, seconds):
+        """记录一次发送；数据量不超过套接字缓冲区数倍时只反映内存复制速度，忽略"""
+        if seconds <= 0 or nbytes < 4 * get_socket_buffer_size():
+            return
+        with self._lock:
+            self.speed += _SMOOTHING * (nbytes / seconds - self.speed)
+
+
+def supported_codecs():
+    """握手时告知对端的压缩编码"""
+    return list(CODECS)
+
+
+def enable_framed_compression(sock):
+    """协商出共同的压缩编码时调用，之后在该连接上按文件决定是否压缩"""
+    with _meters_lock:
+        _meters.setdefault(sock, LinkMeter())
+
+
+def get_link_meter(sock):
+    """返回连接的链路速度估计；没有共同的压缩编码时返回 None"""
+    with _meters_lock:
+        return _meters.get(sock)
+
+
+def _read_samples(path, size, sample_size):
+    """读取文件开头、中间和结尾的样本"""
+    if size <= sample_size * _SAMPLES:
+        offsets = [0]
+        sample_size = size
+    else:
+        offsets = [0, (size - sample_size) // 2, size - sample_size]
+    parts = []
+    with open(path, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            parts.append(f.read(sample_size))
+    return b''.join(parts)
+
+
+def worth_compressing(path, size, link_speed):
+    """试压缩样本，返回压缩后发送是否比直接发送快
+
+    发送方先压缩再发送，预计每字节耗时为 1/压缩速度 + 压缩比/链路速度；
+    接收方解压比压缩快得多，不计入。
+    """
+    sample = _read_samples(path, size, get_compression_sample_size())
+    if not sample:
+        return False
+    start = time.perf_counter()
+    compressed = zlib.compress(sample, get_compression_level())
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    ratio = len(compressed) / len(sample)
+    compress_speed = len(sample) / elapsed
+    return 1 / compress_speed + ratio / link_speed < _MIN_GAIN / link_speed
+
+
+def send_compressed(sock, path, chunk_size, meter=None, digest=None):
+    """用一个压缩流发送整个文件，返回发送的压缩数据字节数；digest 用压缩前的数据更新"""
+    compressor = zlib.compressobj(get_compression_level())
+    wire = 0
+    sending = 0.0
+
+    def send_frame(data):
+        nonlocal wire, sending
+        if not data:
+            return
+        start = time.perf_counter()
+        sock.sendall(_LENGTH.pack(len(data)))
+        sock.sendall(data)
+        sending += time.perf_counter() - start
+        wire += len(data)
+
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            send_frame(compressor.compress(chunk))
+    send_frame(compressor.flush())
+    sock.sendall(_LENGTH.pack(0))
+    if meter is not None:
+        # 只计发送耗时，压缩耗时不属于链路
+        meter.record(wire, sending)
+    return wire
+
+
+def receive_compressed(reader, f, size, digest=None):
+    """读取压缩帧并把解压后的数据写入 f，返回写入的字节数
+
+    解压输出不会超过文件头给出的大小，数据不完整或超出时抛出异常。
+    digest 用解压后的数据更新。
+    """
+    decompressor = zlib.decompressobj()
+    written = 0
+
+    def write(data):
+        nonlocal written
+        written += len(data)
+        if written > size:
+            raise ValueError('Compressed file data exceeds the declared size')
+        if digest is not None:
+            digest.update(data)
+        f.write(data)
+
+    while True:
+        length = reader.read_exact(_LENGTH.size)
+        if not length:
+            raise ConnectionError('Unexpected EOF during compressed file transfer')
+        (length,) = _LENGTH.unpack(length)
+        if length == 0:
+            break
+        data = reader.read_exact(length)
+        if data is None:
+            raise ConnectionError('Unexpected EOF during compressed file transfer')
+        # 限制每次的解压输出，异常数据不会一次展开到内存
+        while data:
+            write(decompressor.decompress(data, size - written + 1))
+            data = decompressor.unconsumed_tail
+    write(decompressor.flush())
+    if not decompressor.eof or written != size:
+        raise ConnectionError('Compressed file data is incomplete (%d of %d bytes)' % (written, size))
+    return written
@@ -0,0 +1,331 @@
+"""增量传输模块 - 只发送大文件中变化的部分（rsync 算法）
+
+接收方在需求列表之前，为本地已有版本的大文件发送块签名（adler32 弱校验和 +
+blake2b 强摘要）；发送方用滚动校验和在新文件中查找这些块，把文件编码为
+"复制旧块"和"字面数据"两种指令，接收方按指令从旧文件和数据流重建到 .tmp，
+校验整个文件的摘要后再原子替换。
+
+签名消息：{'type': 'signatures', 'path', 'block_size', 'count'} 后跟 count 条
+(4字节弱校验和 + 16字节强摘要)。
+指令流（文件头带 'delta' 字段）：
+    b'C' + 起始块号(4字节) + 块数(4字节)
+    b'L' + 长度(4字节) + 数据
+    b'E' + 新文件的 blake2b-256 摘要
+"""
+
+import os
+import math
+import mmap
+import stat
+import zlib
+import struct
+import hashlib
+import logging
+import threading
+import weakref
+from pathlib import Path
+
+from .helpers import send_json, get_delta_threshold, apply_file_mtime
+from .socket_reader import get_reader
+
+SIGNATURE = struct.Struct('>I16s')
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+OP_END = b'E'
+_COPY = struct.Struct('>II')
+_LENGTH = struct.Struct('>I')
+_ADLER_MOD = 65521
+FILE_DIGEST_SIZE = 32
+# 单条字面数据指令的最大长度
+MAX_LITERAL = 1024 * 1024
+# 指令缓冲达到该大小时发送
+_FLUSH_SIZE = 256 * 1024
+# 连续找不到匹配时改为按块跳跃，跳过若干块后重新逐字节查找一个块的范围；
+# 每次查找失败间隔加倍，直到上限
+_PROBE_INTERVAL = 16
+_MAX_PROBE_INTERVAL = 256
+
+_pending = weakref.WeakKeyDictionary()
+_pending_lock = threading.Lock()
+
+
+def block_size_for(size):
+    """块大小约为文件大小的平方根（rsync 的取法），取1KB的整数倍，限制在2KB到1MB之间"""
+    return max(2048, min(int(math.sqrt(size)) // 1024 * 1024, 1024 * 1024))
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def compute_signatures(path, block_size):
+    """计算文件所有完整块的签名（末尾不足一块的部分不参与匹配）"""
+    out = bytearray()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                return bytes(out)
+            out += SIGNATURE.pack(zlib.adler32(block), _strong(block))
+
+
+# 接收方
+
+def send_signatures(sock, base_dir, files, log_func):
+    """为本地已有且达到阈值的需求文件发送块签名，返回发送的文件数"""
+    threshold = get_delta_threshold()
+    sent = 0
+    base_dir = os.fspath(base_dir)
+    for rel in files:
+        # 需求列表中大多是本地不存在的文件或小文件，只做一次 stat，不构造 Path
+        path = os.path.join(base_dir, rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st.st_size < threshold or not stat.S_ISREG(st.st_mode):
+            continue
+        block_size = block_size_for(st.st_size)
+        try:
+            blob = compute_signatures(path, block_size)
+        except OSError as e:
+            log_func('Cannot read %s for delta transfer: %s', rel, e)
+            continue
+        send_json(sock, {'type': 'signatures', 'path': rel, 'block_size': block_size,
+                         'count': len(blob) // SIGNATURE.size})
+        sock.sendall(blob)
+        sent += 1
+    if sent:
+        log_func('Sent block signatures for %d files', sent)
+    return sent
+
+
+def _read(reader, n):
+    data = reader.read_exact(n)
+    if data is None:
+        raise ConnectionError('Unexpected EOF during delta transfer')
+    return data
+
+
+class _HashingWriter:
+    """写入文件的同时计算摘要"""
+
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.f.write(data) if self.f is not None else len(data)
+
+
+def receive_file_delta(sock, base_dir, header):
+    """按增量指令从本地旧版本重建文件，摘要一致时替换，返回是否成功"""
+    logger = logging.getLogger(__name__)
+    reader = get_reader(sock)
+    rel = header['path']
+    block_size = header['delta']['block_size']
+    rel_path = Path(rel)
+    unsafe = rel_path.is_absolute() or '..' in rel_path.parts
+    if unsafe:
+        logger.error('Rejected unsafe path from peer: %s', rel)
+    out_path = Path(base_dir) / rel_path
+    temp_path = str(out_path) + '.tmp'
+
+    digest = hashlib.blake2b(digest_size=FILE_DIGEST_SIZE)
+    basis = None
+    f = None
+    try:
+        if not unsafe:
+            try:
+                basis = open(out_path, 'rb')
+            except OSError as e:
+                logger.error('Basis file for delta transfer unavailable: %s (%s)', rel, e)
+            f = open(temp_path, 'wb')
+        writer = _HashingWriter(f, digest)
+        while True:
+            op = _read(reader, 1)
+            if op == OP_COPY:
+                start, count = _COPY.unpack(_read(reader, _COPY.size))
+                if basis is not None:
+                    basis.seek(start * block_size)
+                    remaining = count * block_size
+                    while remaining:
+                        chunk = basis.read(min(remaining, MAX_LITERAL))
+                        if not chunk:
+                            # 旧文件在签名后被截断，最终摘要不会一致
+                            break
+                        writer.write(chunk)
+                        remaining -= len(chunk)
+            elif op == OP_LITERAL:
+                (length,) = _LENGTH.unpack(_read(reader, _LENGTH.size))
+                reader.read_into_file(writer, length)
+            elif op == OP_END:
+                expected = _read(reader, FILE_DIGEST_SIZE)
+                break
+            else:
+                raise ValueError('Unknown delta instruction: %r' % op)
+    finally:
+        if basis is not None:
+            basis.close()
+        if f is not None:
+            f.close()
+
+    if unsafe:
+        return False
+    if basis is None or digest.digest() != expected:
+        # 旧文件在签名后发生了变化，保留本地文件，下次同步再传
+        logger.error('Delta reconstruction of %s failed verification, keeping local file', rel)
+        os.remove(temp_path)
+        return False
+    os.replace(temp_path, out_path)
+    apply_file_mtime(out_path, header)
+    logger.info('Delta received file: %s (%d bytes)', rel, header['size'])
+    return True
+
+
+# 发送方
+
+class _Signatures:
+    def __init__(self, block_size, blob):
+        self.block_size = block_size
+        self.strong = []
+        self.weak = {}
+        for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(blob)):
+            self.strong.append(strong)
+            self.weak.setdefault(weak, []).append(index)
+
+    def find(self, weak, data, pos):
+        """弱校验和命中时再比较强摘要，返回匹配的块号"""
+        candidates = self.weak.get(weak)
+        if candidates is None:
+            return None
+        strong = _strong(data[pos:pos + self.block_size])
+        for index in candidates:
+            if self.strong[index] == strong:
+                return index
+        return None
+
+
+def receive_signatures(sock, msg):
+    """读取对端发来的块签名，保存到发送该文件时使用"""
+    blob = get_reader(sock).read_exact(msg['count'] * SIGNATURE.size)
+    if blob is None:
+        raise ConnectionError('Connection closed while receiving block signatures')
+    signatures = _Signatures(msg['block_size'], blob)
+    with _pending_lock:
+        _pending.setdefault(sock, {})[msg['path']] = signatures
+
+
+def take_signatures(sock, relpath):
+    """取出对端为该文件发来的签名（没有则返回 None）"""
+    with _pending_lock:
+        return _pending.get(sock, {}).pop(relpath, None)
+
+
+def iter_delta(data, signatures):
+    """产出 ('copy', 块号) 和 ('literal', 起点, 终点) 指令
+
+    对齐位置用 zlib.adler32 计算；不匹配时逐字节滚动查找（最多两个块的范围，
+    足以找回插入或删除后错开的对齐）。仍然找不到时按块跳跃，只检查对齐位置，
+    每隔若干块重新滚动查找一次，间隔逐次加倍，完全不同的文件也不会逐字节遍历。
+    """
+    block_size = signatures.block_size
+    n = len(data)
+    pos = literal_start = 0
+    a = b = 0
+    rolling = False
+    scanned = 0
+    limit = 2 * block_size
+    jumps = 0
+    interval = _PROBE_INTERVAL
+    while pos + block_size <= n:
+        if rolling:
+            weak = a | (b << 16)
+        else:
+            weak = zlib.adler32(data[pos:pos + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        index = signatures.find(weak, data, pos)
+        if index is not None:
+            if literal_start < pos:
+                yield 'literal', literal_start, pos
+            yield 'copy', index
+            pos += block_size
+            literal_start = pos
+            rolling = False
+            scanned = jumps = 0
+            limit = 2 * block_size
+            interval = _PROBE_INTERVAL
+        elif scanned < limit and pos + block_size < n:
+            out_byte = data[pos]
+            a = (a - out_byte + data[pos + block_size]) % _ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+            pos += 1
+            scanned += 1
+            rolling = True
+        else:
+            pos += block_size
+            rolling = False
+            jumps += 1
+            if jumps == interval:
+                scanned = jumps = 0
+                limit = block_size
+                interval = min(interval * 2, _MAX_PROBE_INTERVAL)
+    if literal_start < n:
+        yield 'literal', literal_start, n
+
+
+def send_file_delta(sock, base_dir, relpath, signatures):
+    """按对端签名发送增量指令，返回 (复制的字节数, 字面数据字节数)"""
+    path = Path(base_dir) / Path(relpath)
+    st = path.stat()
+    size = st.st_size
+    block_size = signatures.block_size
+    send_json(sock, {'type': 'file', 'path': relpath, 'size': size, 'mtime_ns': st.st_mtime_ns,
+                     'delta': {'block_size': block_size}})
+    copied = literal = 0
+    out = bytearray()
+    run_start = run_count = 0
+
+    def flush_run():
+        if run_count:
+            out.extend(OP_COPY + _COPY.pack(run_start, run_count))
+
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        try:
+            data = memoryview(mm) if mm is not None else memoryview(b'')
+            try:
+                for op in iter_delta(data, signatures):
+                    if op[0] == 'copy':
+                        index = op[1]
+                        copied += block_size
+                        if run_count and index == run_start + run_count:
+                            run_count += 1
+                            continue
+                        flush_run()
+                        run_start, run_count = index, 1
+                        if len(out) >= _FLUSH_SIZE:
+                            sock.sendall(out)
+                            out.clear()
+                        continue
+                    flush_run()
+                    run_count = 0
+                    start, end = op[1], op[2]
+                    literal += end - start
+                    while start < end:
+                        piece = min(end - start, MAX_LITERAL)
+                        out.extend(OP_LITERAL + _LENGTH.pack(piece))
+                        sock.sendall(out)
+                        out.clear()
+                        sock.sendall(data[start:start + piece])
+                        start += piece
+                flush_run()
+                out.extend(OP_END + hashlib.blake2b(data, digest_size=FILE_DIGEST_SIZE).digest())
+                sock.sendall(out)
+            finally:
+                data.release()
+        finally:
+            if mm is not None:
+                mm.close()
+    return copied, literal
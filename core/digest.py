@@ -0,0 +1,92 @@
+"""摘要算法模块 - 支持 sha256/blake2b/blake2s，并协商双方最快的共同算法"""
+
+import hashlib
+from functools import partial
+
+from .helpers import CHUNK_SIZE, get_digest_algorithms, get_digest_size
+
+# 旧版本对端只支持 sha256，协商失败时回退到它
+DEFAULT_DIGEST = 'sha256'
+# 按速度从快到慢排列（x86-64 上 blake2b 约为 sha256 的两倍）
+ALGORITHM_SPEED_ORDER = ('blake2b', 'blake2s', 'sha256')
+MAX_DIGEST_SIZE = {'blake2b': 64, 'blake2s': 32, 'sha256': 32}
+MIN_DIGEST_SIZE = 16
+
+
+def digest_id(name, digest_size=None):
+    """生成算法标识，如 sha256、blake2b-256（位数）"""
+    if name == 'sha256':
+        return name
+    max_size = MAX_DIGEST_SIZE[name]
+    size = max_size if digest_size is None else max(MIN_DIGEST_SIZE, min(digest_size, max_size))
+    return '%s-%d' % (name, size * 8)
+
+
+def parse_digest_id(algorithm):
+    """解析算法标识，返回 (算法名, 摘要字节数)"""
+    name, _, bits = algorithm.partition('-')
+    if name not in MAX_DIGEST_SIZE or (name == 'sha256' and bits):
+        raise ValueError('Unsupported digest algorithm: %s' % algorithm)
+    if not bits:
+        return name, MAX_DIGEST_SIZE[name]
+    if not bits.isdigit() or int(bits) % 8:
+        raise ValueError('Unsupported digest algorithm: %s' % algorithm)
+    size = int(bits) // 8
+    if not MIN_DIGEST_SIZE <= size <= MAX_DIGEST_SIZE[name]:
+        raise ValueError('Unsupported digest size: %s' % algorithm)
+    return name, size
+
+
+def new_hash(algorithm):
+    """创建对应算法的哈希对象"""
+    name, size = parse_digest_id(algorithm)
+    if name == 'sha256':
+        return hashlib.sha256()
+    return getattr(hashlib, name)(digest_size=size)
+
+
+def compute_digest(path, algorithm=DEFAULT_DIGEST):
+    """按指定算法计算文件摘要"""
+    h = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def digest_func(algorithm):
+    """返回可交给线程池/进程池的单参数摘要函数"""
+    return partial(compute_digest, algorithm=algorithm)
+
+
+def supported_digests():
+    """本端支持的算法标识，按配置顺序排列（总是包含 sha256）"""
+    ids = []
+    for name in get_digest_algorithms():
+        if name not in MAX_DIGEST_SIZE:
+            continue
+        # 同时提供配置长度和默认长度，兼容摘要长度配置不同的对端
+        for algorithm in (digest_id(name, get_digest_size()), digest_id(name)):
+            if algorithm not in ids:
+                ids.append(algorithm)
+    if DEFAULT_DIGEST not in ids:
+        ids.append(DEFAULT_DIGEST)
+    return ids
+
+
+def _speed_rank(algorithm):
+    name, size = parse_digest_id(algorithm)
+    return ALGORITHM_SPEED_ORDER.index(name), size
+
+
+def negotiate_digest(peer_digests):
+    """选出双方都支持的最快算法；对端未提供列表（旧版本）时使用 sha256"""
+    if not peer_digests:
+        return DEFAULT_DIGEST
+    common = [a for a in supported_digests() if a in peer_digests]
+    if not common:
+        return DEFAULT_DIGEST
+    return min(common, key=_speed_rank)
@@ -0,0 +1,224 @@
+"""小文件批量传输模块 - 多个小文件打包成一条消息发送，接收方并行写入
+
+每个文件单独发送时，一个几KB的文件也要一次 stat、一个JSON头、若干次 sendall
+和结束标记，大量小文件时吞吐量被这些固定开销限制。批量消息只有一个JSON头
+（文件表），后跟所有文件内容的拼接；接收方一次读入，用线程池写入各个文件。
+
+消息：{'type': 'file_batch', 'files': [[路径, 大小, mtime_ns], ...]} 后跟各文件内容。
+启用传输摘要时消息带 'digest_algorithm'，文件表每项末尾再加该文件的摘要，接收方
+写入前逐个校验。
+"""
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .helpers import (
+    send_json, apply_file_mtime, get_batch_file_threshold, get_batch_max_bytes,
+    get_batch_write_workers
+)
+from .socket_reader import get_reader
+from .file_transfer import send_file_by_rel
+from .read_ahead import FilePrefetcher
+from .transfer_digest import get_transfer_algorithm
+from .digest import new_hash
+
+# 单个批次的最多文件数（文件表大小的上限）
+MAX_BATCH_FILES = 4096
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, get_batch_write_workers()),
+                                           thread_name_prefix='batch-writer')
+        return _executor
+
+
+class _Batch:
+    """正在累积的批次；algorithm 不为 None 时每项带文件摘要"""
+
+    def __init__(self, algorithm=None):
+        # 复制空的哈希对象比每次按名称创建便宜
+        self._hash = new_hash(algorithm) if algorithm is not None else None
+        self.entries = []
+        self.payload = []
+        self.size = 0
+
+    def add(self, rel, st, data):
+        entry = [rel, len(data), st.st_mtime_ns]
+        if self._hash is not None:
+            h = self._hash.copy()
+            h.update(data)
+            entry.append(h.hexdigest())
+        self.entries.append(entry)
+        self.payload.append(data)
+        self.size += len(data)
+
+    def full(self):
+        return self.size >= get_batch_max_bytes() or len(self.entries) >= MAX_BATCH_FILES
+
+
+def _read_small(path, threshold):
+    """文件不超过阈值时返回 (stat结果, 内容)，否则返回 None
+
+    直接使用 os.open/os.read：每个文件只有 open、fstat、read、close 四次系统调用。
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        st = os.fstat(fd)
+        if st.st_size > threshold:
+            return None
+        data = os.read(fd, st.st_size) if st.st_size else b''
+    finally:
+        os.close(fd)
+    if len(data) != st.st_size:
+        raise OSError('File changed while reading: %s' % path)
+    return st, data
+
+
+def send_files(sock, base_dir, files, log_func, batched=True, manifest=None):
+    """发送文件列表，batched为True时小文件打包成批发送；返回 (成功发送的文件数, 无法发送的路径)
+
+    大文件仍逐个经 send_file_by_rel 发送（可能走增量、块去重或并行数据连接）。
+    给出本地清单时，清单中超过阈值的文件直接逐个发送，不再先打开读取一次。
+    """
+    threshold = get_batch_file_threshold() if batched else -1
+    algorithm = get_transfer_algorithm(sock)
+    batch = _Batch(algorithm)
+    sent = 0
+    failed = []
+    prefetcher = FilePrefetcher(base_dir, files)
+
+    def flush():
+        nonlocal batch, sent
+        if batch.entries:
+            header = {'type': 'file_batch', 'files': batch.entries}
+            if algorithm is not None:
+                header['digest_algorithm'] = algorithm
+            send_json(sock, header)
+            sock.sendall(b''.join(batch.payload))
+            sent += len(batch.entries)
+            log_func('Sent batch of %d files to peer (%d bytes)', len(batch.entries), batch.size)
+            batch = _Batch(algorithm)
+
+    for index, rel in enumerate(files):
+        meta = manifest.get(rel) if manifest is not None else None
+        if threshold >= 0 and (meta is None or meta['size'] <= threshold):
+            try:
+                small = _read_small(os.path.join(base_dir, rel), threshold)
+            except OSError as e:
+                log_func('Failed to send file %s: %s', rel, e)
+                failed.append(rel)
+                continue
+            if small is not None:
+                batch.add(rel, *small)
+                if batch.full():
+                    flush()
+                continue
+        # 发送大文件期间，内核在后台读入随后几个文件
+        prefetcher.before_send(index)
+        try:
+            send_file_by_rel(sock, base_dir, rel)
+            sent += 1
+            log_func('Sent file to peer: %s', rel)
+        except (FileNotFoundError, PermissionError) as e:
+            # 文件头发出前失败，不影响后续数据流
+            log_func('Failed to send file %s: %s', rel, e)
+            failed.append(rel)
+    flush()
+    return sent, failed
+
+
+def _unsafe_path(rel):
+    """与 Path(rel).is_absolute() 或 '..' in Path(rel).parts 等价的字符串检查（不构造 Path）"""
+    if os.path.isabs(rel):
+        return True
+    if os.altsep:
+        rel = rel.replace(os.altsep, os.sep)
+    return '..' in rel.split(os.sep)
+
+
+def receive_file_batch(sock, base_dir, header):
+    """读取批量消息并用线程池写入各个文件，返回写入成功的路径列表"""
+    logger = logging.getLogger(__name__)
+    entries = header['files']
+    algorithm = header.get('digest_algorithm')
+    total = sum(entry[1] for entry in entries)
+    payload = get_reader(sock).read_exact(total)
+    if payload is None:
+        raise ConnectionError('Unexpected EOF during file batch')
+    view = memoryview(payload)
+    base_dir = os.fspath(base_dir)
+    created = set()
+    jobs = []
+    offset = 0
+    for entry in entries:
+        rel, size, mtime_ns = entry[:3]
+        expected = entry[3] if algorithm else None
+        data = view[offset:offset + size]
+        offset += size
+        if _unsafe_path(rel):
+            logger.error('Rejected unsafe path from peer: %s', rel)
+            continue
+        out_path = os.path.join(base_dir, rel)
+        # 目录在提交前创建，工作线程只写文件
+        parent = os.path.dirname(out_path)
+        if parent not in created:
+            os.makedirs(parent, exist_ok=True)
+            created.add(parent)
+        jobs.append((rel, out_path, data, mtime_ns, expected))
+
+    # 每个工作线程一个任务，处理一组文件；每个文件一个任务时提交和等待的开销与写入相当
+    workers = max(1, get_batch_write_workers())
+    futures = [_get_executor().submit(_write_files, jobs[i::workers], algorithm)
+               for i in range(min(workers, len(jobs)))]
+    written = []
+    for future in futures:
+        for rel, error in future.result():
+            if error is None:
+                written.append(rel)
+            elif isinstance(error, OSError):
+                logger.error('Failed to write %s from file batch: %s', rel, error)
+            else:
+                logger.error('Digest mismatch for %s in file batch, discarding it', rel)
+    return written
+
+
+def _write_files(jobs, algorithm):
+    """工作线程：依次写入一组文件，返回 [(路径, 错误)]，摘要不一致时错误为 False"""
+    results = []
+    for rel, out_path, data, mtime_ns, expected in jobs:
+        try:
+            results.append((rel, None if _write_file(out_path, data, mtime_ns, algorithm, expected) else False))
+        except OSError as e:
+            results.append((rel, e))
+    return results
+
+
+def _write_file(out_path, data, mtime_ns, algorithm=None, expected=None):
+    """校验摘要后写入 .tmp，在同一个文件描述符上设置修改时间后替换；摘要不一致时返回 False"""
+    if expected is not None:
+        h = new_hash(algorithm)
+        h.update(data)
+        if h.hexdigest() != expected:
+            return False
+    temp_path = out_path + '.tmp'
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        if os.utime in os.supports_fd:
+            os.utime(fd, ns=(mtime_ns, mtime_ns))
+    finally:
+        os.close(fd)
+    if os.utime not in os.supports_fd:
+        apply_file_mtime(temp_path, {'mtime_ns': mtime_ns})
+    os.replace(temp_path, out_path)
+    return True
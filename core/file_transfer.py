@@ -5,16 +5,58 @@ import struct
 import logging
 from pathlib import Path
 
-from .helpers import recvn, send_json, get_chunk_size, get_socket_buffer_size, should_disable_nagle
+from .helpers import (
+    send_json, get_chunk_size, get_socket_buffer_size, should_disable_nagle, apply_file_mtime,
+    get_resume_min_bytes
+)
+from .socket_reader import get_reader
+from .multi_stream import get_stream_pool
+from .protocol import uses_stream_protocol
+from .delta_transfer import take_signatures, send_file_delta, receive_file_delta
+from .chunk_store import take_chunk_haves, send_file_chunked, receive_file_chunked
+from .resume import take_resume_offset, send_file_resumed, receive_file_resumed, save_partial, discard_partial
+from .sparse import should_send_sparse, send_file_sparse, receive_file_sparse
+from .transfer_digest import (
+    start_send_digest, start_receive_digest, verify_received, discard_digest, record_received
+)
 from .file_transfer_optimized import send_file_by_rel_optimized, receive_file_optimized
 
 def send_file_by_rel(sock, base_dir, relpath):
     """发送文件（带JSON头信息）- 支持优化模式"""
     # 检查是否启用优化
-    from .helpers import should_use_stream_protocol, should_use_memory_mapping
+    from .helpers import should_use_memory_mapping
     
-    if should_use_stream_protocol() or should_use_memory_mapping():
-        # 使用优化版本
+    signatures = take_signatures(sock, relpath)
+    if signatures is not None:
+        # 对端发来了旧版本的块签名，只发送变化部分
+        copied, literal = send_file_delta(sock, base_dir, relpath, signatures)
+        logging.info('Delta sent file: %s (%d bytes reused, %d bytes sent)', relpath, copied, literal)
+        return
+    
+    offset = take_resume_offset(sock, base_dir, relpath)
+    if offset:
+        # 对端保存了该文件未变化的前缀，只发送剩余部分
+        take_chunk_haves(sock, relpath)
+        sent = send_file_resumed(sock, base_dir, relpath, offset)
+        logging.info('Resumed sending file: %s (from offset %d, %d bytes sent)', relpath, offset, sent)
+        return
+    
+    if should_send_sparse(sock, Path(base_dir) / relpath):
+        # 有空洞的文件只发送数据区段，不读取和发送空洞中的零字节
+        take_chunk_haves(sock, relpath)
+        size, sent = send_file_sparse(sock, base_dir, relpath)
+        logging.info('Sparse sent file: %s (%d bytes, %d bytes of data)', relpath, size, sent)
+        return
+    
+    haves = take_chunk_haves(sock, relpath)
+    if haves is not None and (haves or get_stream_pool(sock) is None):
+        # 对端查询过块列表，本地已有的块只发送引用；对端一块都没有且有并行数据连接时照常发送
+        reused, sent = send_file_chunked(sock, base_dir, relpath, haves)
+        logging.info('Chunked sent file: %s (%d bytes reused, %d bytes sent)', relpath, reused, sent)
+        return
+    
+    if uses_stream_protocol(sock) or should_use_memory_mapping() or get_stream_pool(sock) is not None:
+        # 使用优化版本（并行数据连接只由优化版本使用）
         return send_file_by_rel_optimized(sock, base_dir, relpath)
     else:
         # 使用传统版本
@@ -23,8 +65,10 @@ def send_file_by_rel(sock, base_dir, relpath):
 def _send_file_by_rel_legacy(sock, base_dir, relpath):
     """传统文件发送实现"""
     path = Path(base_dir) / Path(relpath)
-    size = path.stat().st_size
-    header = {'type': 'file', 'path': relpath, 'size': size}
+    st = path.stat()
+    size = st.st_size
+    header = {'type': 'file', 'path': relpath, 'size': size, 'mtime_ns': st.st_mtime_ns}
+    digest = start_send_digest(sock, base_dir, path, st, header)
     send_json(sock, header)
     
     chunk_size = get_chunk_size()
@@ -34,19 +78,36 @@ def _send_file_by_rel_legacy(sock, base_dir, relpath):
             chunk = f.read(chunk_size)
             if not chunk:
                 break
+            if digest is not None:
+                digest.update(chunk)
             sock.sendall(struct.pack('>I', len(chunk)))
             sock.sendall(chunk)
     
     sock.sendall(struct.pack('>I', 0))
+    if digest is not None:
+        digest.finish(sock)
     logging.info('Sent file: %s (%d bytes)', relpath, size)
 
 def receive_file(sock, base_dir, header):
     """接收文件（期望头信息已被接收线程读取）- 支持优化模式"""
+    if 'resume' in header:
+        return receive_file_resumed(sock, base_dir, header)
+    result = _receive_file(sock, base_dir, header)
+    if header['size'] >= get_resume_min_bytes():
+        # 已完整接收，之前中断留下的部分文件不再需要
+        discard_partial(base_dir, header['path'])
+    return result
+
+def _receive_file(sock, base_dir, header):
     # 检查是否启用优化
-    from .helpers import should_use_stream_protocol
-    
-    if should_use_stream_protocol():
-        # 使用优化版本
+    if 'delta' in header:
+        return receive_file_delta(sock, base_dir, header)
+    if 'chunked' in header:
+        return receive_file_chunked(sock, base_dir, header)
+    if 'sparse' in header:
+        return receive_file_sparse(sock, base_dir, header)
+    if uses_stream_protocol(sock) or 'stream_id' in header or 'compression' in header:
+        # 使用优化版本（含经并行数据连接到达的文件和分帧压缩的文件）
         return receive_file_optimized(sock, base_dir, header)
     else:
         # 使用传统版本
@@ -56,20 +117,22 @@ def _receive_file_legacy(sock, base_dir, header):
     """传统文件接收实现"""
     rel = header['path']
     size = header['size']
+    reader = get_reader(sock)
+    digest = start_receive_digest(header)
 
     rel_path = Path(rel)
     if rel_path.is_absolute() or '..' in rel_path.parts:
         logging.error('Rejected unsafe path from peer: %s', rel)
         while True:
-            ln_b = recvn(sock, 4)
+            ln_b = reader.read_exact(4)
             if not ln_b:
                 raise ConnectionError('Unexpected EOF during file transfer')
             (ln,) = struct.unpack('>I', ln_b)
             if ln == 0:
                 break
-            chunk = recvn(sock, ln)
-            if not chunk:
+            if not reader.discard(ln):
                 raise ConnectionError('Unexpected EOF during file transfer chunk')
+        discard_digest(sock, header)
         return
 
     out_path = Path(base_dir) / rel_path
@@ -78,24 +141,31 @@ def _receive_file_legacy(sock, base_dir, header):
     
     logging.info('Saving file to: %s', out_path)
     
-    with open(str(out_path) + '.tmp', 'wb') as f:
-        while True:
-            ln_b = recvn(sock, 4)
-            if not ln_b:
-                raise ConnectionError('Unexpected EOF during file transfer')
-            (ln,) = struct.unpack('>I', ln_b)
-            if ln == 0:
-                break
-            chunk = recvn(sock, ln)
-            if not chunk:
-                raise ConnectionError('Unexpected EOF during file transfer chunk')
-            f.write(chunk)
-            received += len(chunk)
+    try:
+        with open(str(out_path) + '.tmp', 'wb') as f:
+            while True:
+                ln_b = reader.read_exact(4)
+                if not ln_b:
+                    raise ConnectionError('Unexpected EOF during file transfer')
+                (ln,) = struct.unpack('>I', ln_b)
+                if ln == 0:
+                    break
+                # 块数据经读取器缓冲区直接写入文件
+                received += reader.read_into_file(f, ln, digest)
+        verified = verify_received(sock, header, str(out_path) + '.tmp', digest)
+    except OSError:
+        # 连接中断：保留已收到的前缀供下次续传
+        save_partial(base_dir, header, str(out_path) + '.tmp')
+        raise
+    if not verified:
+        return
     
     logging.info('Temporary file created, size: %d bytes', received)
     
     try:
         os.replace(str(out_path) + '.tmp', out_path)
+        apply_file_mtime(out_path, header)
+        record_received(base_dir, out_path, header, digest)
         logging.info('File successfully saved: %s (%d bytes)', rel, received)
     except Exception as e:
         logging.error('Failed to rename file %s: %s', out_path, e)
@@ -5,16 +5,57 @@ import struct
 import logging
 import mmap
 import zlib
+import time
+import threading
+from contextlib import closing
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .helpers import (
-    recvn, send_json, get_chunk_size, get_socket_buffer_size, 
+    send_json, get_chunk_size, get_socket_buffer_size, 
     should_disable_nagle, should_use_memory_mapping, 
-    should_use_stream_protocol, calculate_optimal_chunk_size,
-    calculate_optimal_threads, should_enable_compression,
-    get_compression_threshold
+    calculate_optimal_chunk_size,
+    should_enable_compression,
+    get_compression_threshold, apply_file_mtime, should_use_sendfile,
+    get_multi_stream_threshold
 )
+from .socket_reader import get_reader
+from .multi_stream import get_stream_pool, IncompleteTransfer
+from .protocol import uses_stream_protocol, get_chunk_limit
+from .resume import save_partial
+from .compression import (
+    CODEC_ZLIB, get_link_meter, worth_compressing, send_compressed, receive_compressed
+)
+from .write_behind import WriteBehind, use_write_behind
+from .read_ahead import read_chunks, read_ahead_depth, advise_mapped
+from .transfer_digest import (
+    start_send_digest, start_receive_digest, hash_received_file, verify_received, discard_digest, record_received
+)
+
+# 平台提供 os.sendfile 时 socket.sendfile 才是真正的零拷贝
+SENDFILE_AVAILABLE = hasattr(os, 'sendfile')
+
+# 发送路径统计：路径名 -> {'files': 文件数, 'bytes': 字节数}
+_transfer_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record_send_path(name, size):
+    with _stats_lock:
+        stats = _transfer_stats.setdefault(name, {'files': 0, 'bytes': 0})
+        stats['files'] += 1
+        stats['bytes'] += size
+
+
+def get_transfer_stats():
+    """返回各发送路径（multi_stream/zlib/sendfile/mmap/file_io）处理的文件数和字节数"""
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _transfer_stats.items()}
+
+
+def reset_transfer_stats():
+    with _stats_lock:
+        _transfer_stats.clear()
+
 
 class OptimizedFileTransfer:
     """优化的文件传输类"""
@@ -25,121 +66,140 @@ class OptimizedFileTransfer:
     def send_file_optimized(self, sock, base_dir, relpath):
         """优化的文件发送方法"""
         path = Path(base_dir) / Path(relpath)
-        file_size = path.stat().st_size
+        st = path.stat()
+        file_size = st.st_size
         
         # 计算最优参数
-        optimal_chunk_size = calculate_optimal_chunk_size(file_size)
-        optimal_threads = calculate_optimal_threads(file_size)
+        optimal_chunk_size = calculate_optimal_chunk_size(file_size, get_chunk_limit(sock))
         
         header = {
             'type': 'file', 
             'path': relpath, 
             'size': file_size,
+            'mtime_ns': st.st_mtime_ns,
             'chunk_size': optimal_chunk_size,
             'compressed': False
         }
         
+        # 对端支持时，数据之后发送摘要（在发送循环中计算，缓存中已有时直接使用）
+        digest = start_send_digest(sock, base_dir, path, st, header)
+        
+        pool = get_stream_pool(sock)
+        if pool is not None and file_size >= get_multi_stream_threshold():
+            # 大文件经并行数据连接分块发送，控制连接上只有文件头和摘要
+            if digest is not None:
+                digest.hash_file()
+            pool.send_file(sock, header, path)
+            if digest is not None:
+                digest.finish(sock)
+            _record_send_path('multi_stream', file_size)
+            self.logger.info('Optimized sent file: %s (%d bytes, %d data connections, path: multi_stream)',
+                             relpath, file_size, len(pool.socks))
+            return
+        
         # 检查是否需要压缩
+        meter = get_link_meter(sock)
         if should_enable_compression() and file_size > get_compression_threshold():
-            header['compressed'] = True
+            if meter is None:
+                # 对端不支持分帧压缩：旧的逐块压缩只能用于长度前缀协议
+                header['compressed'] = not uses_stream_protocol(sock)
+            elif worth_compressing(path, file_size, meter.speed):
+                header['compression'] = CODEC_ZLIB
         
         send_json(sock, header)
         
-        # 根据文件大小选择传输策略
-        if file_size < 10 * 1024 * 1024:  # 小文件使用单线程
-            self._send_single_thread(sock, path, file_size, optimal_chunk_size, header['compressed'])
-        else:  # 大文件使用多线程
-            self._send_multi_thread(sock, path, file_size, optimal_chunk_size, optimal_threads, header['compressed'])
+        if header.get('compression'):
+            # 压缩数据自带帧边界，两种协议下格式相同
+            wire = send_compressed(sock, path, optimal_chunk_size, meter, digest)
+            if digest is not None:
+                digest.finish(sock)
+            _record_send_path('zlib', file_size)
+            self.logger.info('Optimized sent file: %s (%d bytes, %d compressed, path: zlib)',
+                             relpath, file_size, wire)
+            return
+        
+        start = time.perf_counter()
+        # 未压缩的文件优先走内核零拷贝
+        if not header['compressed'] and file_size > 0 and should_use_sendfile() and SENDFILE_AVAILABLE:
+            send_path = 'sendfile'
+            if digest is not None:
+                # 数据不经过用户空间：后台线程另行读取文件计算摘要（多数读取命中页缓存）
+                digest.hash_file()
+            self._send_with_sendfile(sock, path, file_size, optimal_chunk_size)
+        else:
+            send_path = self._send_single_thread(sock, path, file_size, optimal_chunk_size, header['compressed'],
+                                                 digest)
+        if not uses_stream_protocol(sock):
+            # 传统协议的接收方以长度为0的块作为文件结束
+            sock.sendall(struct.pack('>I', 0))
+        if digest is not None:
+            digest.finish(sock)
+        if meter is not None and not header['compressed']:
+            meter.record(file_size, time.perf_counter() - start)
+        _record_send_path(send_path, file_size)
         
-        self.logger.info('Optimized sent file: %s (%d bytes, chunks: %d, threads: %d)', 
-                        relpath, file_size, optimal_chunk_size, optimal_threads)
+        self.logger.info('Optimized sent file: %s (%d bytes, chunks: %d, path: %s)', 
+                        relpath, file_size, optimal_chunk_size, send_path)
     
-    def _send_single_thread(self, sock, path, file_size, chunk_size, compressed):
-        """单线程发送"""
+    def _send_single_thread(self, sock, path, file_size, chunk_size, compressed, digest=None):
+        """单线程发送，返回所用的发送路径；digest 用发送的原始数据更新"""
         if should_use_memory_mapping() and file_size > 0:
             # 使用内存映射优化
-            self._send_with_memory_mapping(sock, path, file_size, chunk_size, compressed)
-        else:
-            # 传统文件读取
-            self._send_with_file_io(sock, path, file_size, chunk_size, compressed)
-    
-    def _send_multi_thread(self, sock, path, file_size, chunk_size, thread_count, compressed):
-        """多线程发送"""
-        chunks = []
-        offset = 0
-        
-        # 计算块信息
-        while offset < file_size:
-            current_chunk_size = min(chunk_size, file_size - offset)
-            chunks.append((offset, current_chunk_size))
-            offset += current_chunk_size
-        
-        # 使用线程池并行发送
-        with ThreadPoolExecutor(max_workers=thread_count) as executor:
-            futures = []
-            for chunk_offset, chunk_size in chunks:
-                future = executor.submit(
-                    self._send_chunk, sock, path, chunk_offset, chunk_size, compressed
-                )
-                futures.append(future)
-            
-            # 等待所有块发送完成
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    self.logger.error('Error sending chunk: %s', e)
-                    raise
-    
-    def _send_chunk(self, sock, path, offset, chunk_size, compressed):
-        """发送单个块"""
+            self._send_with_memory_mapping(sock, path, file_size, chunk_size, compressed, digest)
+            return 'mmap'
+        # 传统文件读取
+        self._send_with_file_io(sock, path, file_size, chunk_size, compressed, digest)
+        return 'file_io'
+
+    def _send_with_sendfile(self, sock, path, file_size, chunk_size):
+        """使用 socket.sendfile 发送未压缩文件，数据不经过用户空间"""
+        framed = not uses_stream_protocol(sock)
         with open(path, 'rb') as f:
-            f.seek(offset)
-            chunk_data = f.read(chunk_size)
-            
-            if compressed:
-                chunk_data = zlib.compress(chunk_data, level=1)  # 快速压缩
-            
-            # 流式协议：只发送数据，不发送长度前缀
-            if should_use_stream_protocol():
-                sock.sendall(chunk_data)
-            else:
-                # 传统协议：长度前缀 + 数据
-                sock.sendall(struct.pack('>I', len(chunk_data)))
-                sock.sendall(chunk_data)
+            if not framed:
+                sock.sendfile(f, 0, file_size)
+                return
+            # 传统协议：每块前发送长度前缀，块数据仍由内核直接发送
+            offset = 0
+            while offset < file_size:
+                count = min(chunk_size, file_size - offset)
+                sock.sendall(struct.pack('>I', count))
+                sock.sendfile(f, offset, count)
+                offset += count
     
-    def _send_with_memory_mapping(self, sock, path, file_size, chunk_size, compressed):
-        """使用内存映射发送文件"""
+    def _send_with_memory_mapping(self, sock, path, file_size, chunk_size, compressed, digest=None):
+        """使用内存映射发送文件；提前提示内核读入之后的块"""
+        ahead = read_ahead_depth(chunk_size) * chunk_size
         with open(path, 'rb') as f:
-            with mmap.mmap(f.fileno(), file_size, access=mmap.ACCESS_READ) as mm:
+            with mmap.mmap(f.fileno(), file_size, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                advise_mapped(mm, 0, min(ahead, file_size))
                 offset = 0
                 while offset < file_size:
                     current_chunk_size = min(chunk_size, file_size - offset)
-                    chunk_data = mm[offset:offset + current_chunk_size]
-                    
-                    if compressed:
-                        chunk_data = zlib.compress(chunk_data, level=1)
-                    
-                    if should_use_stream_protocol():
-                        sock.sendall(chunk_data)
-                    else:
-                        sock.sendall(struct.pack('>I', len(chunk_data)))
-                        sock.sendall(chunk_data)
-                    
+                    if ahead and offset + ahead < file_size:
+                        advise_mapped(mm, offset + ahead, min(chunk_size, file_size - offset - ahead))
+                    # memoryview 切片不复制数据；切片须在映射关闭前释放
+                    with view[offset:offset + current_chunk_size] as chunk:
+                        if digest is not None:
+                            digest.update(chunk)
+                        chunk_data = zlib.compress(chunk, level=1) if compressed else chunk
+
+                        if uses_stream_protocol(sock):
+                            sock.sendall(chunk_data)
+                        else:
+                            sock.sendall(struct.pack('>I', len(chunk_data)))
+                            sock.sendall(chunk_data)
+                        del chunk_data
+
                     offset += current_chunk_size
     
-    def _send_with_file_io(self, sock, path, file_size, chunk_size, compressed):
-        """使用文件IO发送文件"""
-        with open(path, 'rb') as f:
-            while True:
-                chunk_data = f.read(chunk_size)
-                if not chunk_data:
-                    break
-                
+    def _send_with_file_io(self, sock, path, file_size, chunk_size, compressed, digest=None):
+        """使用文件IO发送文件；多块的文件由后台线程预读，读盘和发送重叠"""
+        with open(path, 'rb') as f, closing(read_chunks(f, file_size, chunk_size, digest)) as chunks:
+            for chunk_data in chunks:
                 if compressed:
                     chunk_data = zlib.compress(chunk_data, level=1)
                 
-                if should_use_stream_protocol():
+                if uses_stream_protocol(sock):
                     sock.sendall(chunk_data)
                 else:
                     sock.sendall(struct.pack('>I', len(chunk_data)))
@@ -151,79 +211,150 @@ class OptimizedFileTransfer:
         file_size = header['size']
         chunk_size = header.get('chunk_size', get_chunk_size())
         compressed = header.get('compressed', False)
+        framed = header.get('compression')
+        if framed and framed != CODEC_ZLIB:
+            raise ValueError('Unsupported compression from peer: %s' % framed)
+        if compressed and not framed and uses_stream_protocol(sock):
+            # 流式协议下的压缩数据必须分帧，否则无法确定数据的结尾
+            raise ValueError('Compressed data without frames under stream protocol')
+        
+        # 带传输编号的文件内容经并行数据连接到达
+        pool = get_stream_pool(sock) if 'stream_id' in header else None
+        if 'stream_id' in header and pool is None:
+            raise ConnectionError('Peer sent a multi-stream file without data connections')
+        
+        # 文件头注明摘要算法时，数据之后跟发送方的摘要
+        digest = start_receive_digest(header)
         
         rel_path = Path(rel)
         if rel_path.is_absolute() or '..' in rel_path.parts:
             self.logger.error('Rejected unsafe path from peer: %s', rel)
-            self._consume_file_stream(sock, chunk_size, compressed)
+            if pool is not None:
+                pool.receive_file(header, None)
+            else:
+                self._consume_file_stream(sock, file_size, compressed, framed)
+            discard_digest(sock, header)
             return
         
         out_path = Path(base_dir) / rel_path
         out_path.parent.mkdir(parents=True, exist_ok=True)
         
-        optimal_threads = calculate_optimal_threads(file_size)
-        
-        if file_size < 10 * 1024 * 1024:
-            self._receive_single_thread(sock, out_path, file_size, chunk_size, compressed)
+        if pool is not None:
+            temp_path = str(out_path) + '.tmp'
+            try:
+                pool.receive_file(header, temp_path)
+            except IncompleteTransfer as e:
+                # 块可能乱序到达，只保留连续写入的前缀
+                save_partial(base_dir, header, temp_path, e.prefix)
+                raise
+            # 块不按顺序写入，写完后再读一遍 .tmp 计算摘要
+            digest = hash_received_file(header, temp_path)
+            if not verify_received(sock, header, temp_path, digest):
+                return
+            os.replace(temp_path, out_path)
         else:
-            self._receive_multi_thread(sock, out_path, file_size, chunk_size, optimal_threads, compressed)
+            temp_path = str(out_path) + '.tmp'
+            try:
+                if framed:
+                    with open(temp_path, 'wb') as f:
+                        receive_compressed(get_reader(sock), f, file_size, digest)
+                else:
+                    self._receive_single_thread(sock, temp_path, file_size, chunk_size, compressed, digest)
+                verified = verify_received(sock, header, temp_path, digest)
+            except OSError as e:
+                # 连接中断：保留已写入的前缀供下次续传（预分配的文件按实际写入的长度）
+                save_partial(base_dir, header, temp_path, getattr(e, 'prefix', None))
+                raise
+            if not verified:
+                return
+            os.replace(temp_path, out_path)
+        apply_file_mtime(out_path, header)
+        record_received(base_dir, out_path, header, digest)
         
         self.logger.info('Optimized received file: %s (%d bytes)', rel, file_size)
     
-    def _receive_single_thread(self, sock, out_path, file_size, chunk_size, compressed):
-        """单线程接收"""
+    def _receive_single_thread(self, sock, temp_path, file_size, chunk_size, compressed, digest=None):
+        """单线程接收到 temp_path；digest 用写入的数据更新"""
+        reader = get_reader(sock)
         received = 0
-        temp_path = str(out_path) + '.tmp'
         
+        stream = uses_stream_protocol(sock)
         with open(temp_path, 'wb') as f:
-            while received < file_size:
-                if should_use_stream_protocol():
+            if not compressed and use_write_behind(file_size):
+                # 大文件：本线程只读套接字，写文件交给后台线程
+                self._receive_write_behind(reader, f, file_size, stream, digest)
+                return
+            if stream and not compressed:
+                # 流式协议：数据经读取器缓冲区直接写入文件，不为每块分配新对象
+                received = reader.read_into_file(f, file_size, digest)
+            # 传统协议读到长度为0的结束块为止
+            while received < file_size or not stream:
+                if stream:
                     # 流式协议接收
                     remaining = file_size - received
                     current_chunk_size = min(chunk_size, remaining)
-                    chunk_data = recvn(sock, current_chunk_size)
+                    chunk_data = reader.read_exact(current_chunk_size)
                 else:
                     # 传统协议接收
-                    ln_b = recvn(sock, 4)
+                    ln_b = reader.read_exact(4)
                     if not ln_b:
                         raise ConnectionError('Unexpected EOF during file transfer')
                     (ln,) = struct.unpack('>I', ln_b)
                     if ln == 0:
                         break
-                    chunk_data = recvn(sock, ln)
+                    if not compressed:
+                        received += reader.read_into_file(f, ln, digest)
+                        continue
+                    chunk_data = reader.read_exact(ln)
                 
                 if not chunk_data:
                     raise ConnectionError('Unexpected EOF during file transfer')
                 
                 if compressed:
                     chunk_data = zlib.decompress(chunk_data)
+                if digest is not None:
+                    digest.update(chunk_data)
                 
                 f.write(chunk_data)
                 received += len(chunk_data)
-        
-        os.replace(temp_path, out_path)
     
-    def _receive_multi_thread(self, sock, out_path, file_size, chunk_size, thread_count, compressed):
-        """多线程接收（需要协议支持）"""
-        # 简化实现：使用单线程接收大文件
-        self._receive_single_thread(sock, out_path, file_size, chunk_size, compressed)
+    def _receive_write_behind(self, reader, f, file_size, stream, digest):
+        """经后台写入接收未压缩的文件；中断时抛出带已写入前缀长度的 IncompleteTransfer"""
+        pipeline = WriteBehind(f, file_size, digest)
+        try:
+            if stream:
+                pipeline.receive(reader, file_size)
+            else:
+                while True:
+                    ln_b = reader.read_exact(4)
+                    if not ln_b:
+                        raise ConnectionError('Unexpected EOF during file transfer')
+                    (ln,) = struct.unpack('>I', ln_b)
+                    if ln == 0:
+                        break
+                    pipeline.receive(reader, ln)
+            pipeline.finish()
+        except OSError as e:
+            pipeline.abort(e)
     
-    def _consume_file_stream(self, sock, chunk_size, compressed):
+    def _consume_file_stream(self, sock, file_size, compressed, framed=None):
         """消耗文件流（用于拒绝不安全路径时）"""
-        if should_use_stream_protocol():
-            # 流式协议需要特殊处理
-            raise NotImplementedError("Stream protocol consumption not implemented")
+        reader = get_reader(sock)
+        if uses_stream_protocol(sock) and not framed:
+            if compressed:
+                # 压缩数据在流式协议下没有边界信息，无法跳过
+                raise ValueError('Compressed data without frames under stream protocol')
+            reader.discard(file_size)
         else:
             # 传统协议消耗
             while True:
-                ln_b = recvn(sock, 4)
+                ln_b = reader.read_exact(4)
                 if not ln_b:
                     return
                 (ln,) = struct.unpack('>I', ln_b)
                 if ln == 0:
                     break
-                chunk = recvn(sock, ln)
-                if not chunk:
+                if not reader.discard(ln):
                     return
 
 # 向后兼容的函数
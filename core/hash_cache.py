@@ -0,0 +1,200 @@
+"""持久化哈希缓存模块 - 按 (算法, 设备, inode, 大小, mtime_ns) 缓存文件摘要"""
+
+import os
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+
+from .helpers import SYNC_META_DIR
+
+CACHE_FILE_NAME = 'hash_cache.jsonl'
+XATTR_PREFIX = 'user.lan_sync.'
+# 旧版本缓存记录没有算法字段，均为 sha256
+LEGACY_ALGORITHM = 'sha256'
+
+# mtime 距今小于该窗口的文件不缓存，避免同一时间粒度内的再次修改被漏判
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+# 日志记录数超过存活记录数的倍数（且超过最小值）时触发压缩
+COMPACT_RATIO = 2
+COMPACT_MIN_RECORDS = 1024
+
+
+# 每个同步根目录共享一个缓存实例，避免同一会话中重复加载
+_caches = {}
+
+
+def get_hash_cache(base_dir, use_xattr=False):
+    """获取（必要时创建）同步根目录对应的缓存实例"""
+    root = str(Path(base_dir).resolve())
+    cache = _caches.get(root)
+    if cache is None:
+        cache = _caches[root] = HashCache(root, use_xattr=use_xattr)
+    else:
+        cache.use_xattr = use_xattr and hasattr(os, 'setxattr')
+    return cache
+
+
+def cache_key(st):
+    """由 stat 结果生成缓存键（不含算法）"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashCache:
+    """同步根目录下的摘要缓存
+
+    每种摘要算法单独记录。记录以 JSON Lines 形式追加写入 ``<根目录>/.lan_sync/hash_cache.jsonl``，
+    崩溃时最多丢失最后一行；压缩时先写临时文件再原子替换。
+    启用 xattr 时摘要直接写入文件的扩展属性，失败则回退到缓存文件。
+    各方法加锁，传输线程记录摘要时可以与清单扫描同时进行。
+    """
+
+    def __init__(self, base_dir, use_xattr=False):
+        self.base_dir = Path(base_dir)
+        self.path = self.base_dir / SYNC_META_DIR / CACHE_FILE_NAME
+        self.use_xattr = use_xattr and hasattr(os, 'setxattr')
+        self.logger = logging.getLogger(__name__)
+        self._entries = {}
+        self._pending = []
+        self._seen = set()
+        self._log_records = 0
+        self._needs_newline = False
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        """加载缓存文件，忽略损坏的记录"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                line = ''
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        key = (rec.get('a', LEGACY_ALGORITHM),) + tuple(rec['k'])
+                        digest = rec['d']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    self._entries[key] = digest
+                    self._log_records += 1
+                # 最后一行不完整时，下次追加前先补换行
+                self._needs_newline = bool(line) and not line.endswith('\n')
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning('Failed to load hash cache %s: %s', self.path, e)
+
+    def lookup(self, path, st, algorithm=LEGACY_ALGORITHM):
+        """查询缓存摘要，未命中返回None"""
+        if self.use_xattr:
+            digest = self._xattr_get(path, st, algorithm)
+            if digest is not None:
+                return digest
+        key = cache_key(st)
+        with self._lock:
+            digest = self._entries.get((algorithm,) + key)
+            if digest is not None:
+                self._seen.add(key)
+        return digest
+
+    def touch(self, st):
+        """标记记录仍然存活（只扫描不取摘要时使用）"""
+        with self._lock:
+            self._seen.add(cache_key(st))
+
+    def store(self, path, st, digest, algorithm=LEGACY_ALGORITHM):
+        """记录新计算的摘要"""
+        if time.time_ns() - st.st_mtime_ns < RACY_WINDOW_NS:
+            return
+        if self.use_xattr and self._xattr_set(path, st, digest, algorithm):
+            return
+        key = cache_key(st)
+        with self._lock:
+            self._seen.add(key)
+            key = (algorithm,) + key
+            if self._entries.get(key) != digest:
+                self._entries[key] = digest
+                self._pending.append(key)
+
+    def save(self, evict=True):
+        """持久化缓存；evict为True时淘汰本次扫描未见到的记录"""
+        with self._lock:
+            if evict:
+                stale = [key for key in self._entries if key[1:] not in self._seen]
+                for key in stale:
+                    del self._entries[key]
+            live = len(self._entries)
+            total = self._log_records + len(self._pending)
+            try:
+                if total > COMPACT_MIN_RECORDS and total > COMPACT_RATIO * live:
+                    self._compact()
+                elif self._pending:
+                    self._append()
+            except OSError as e:
+                self.logger.warning('Failed to save hash cache %s: %s', self.path, e)
+            self._pending = []
+            if evict:
+                self._seen = set()
+
+    def _append(self):
+        """追加新记录并刷盘"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if self._needs_newline:
+                f.write('\n')
+            for key in self._pending:
+                f.write(self._encode(key))
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_records += len(self._pending)
+        self._needs_newline = False
+
+    def _compact(self):
+        """重写缓存文件，只保留存活记录"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = str(self.path) + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for key in self._entries:
+                f.write(self._encode(key))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._fsync_dir(self.path.parent)
+        self._log_records = len(self._entries)
+        self._needs_newline = False
+        self.logger.info('Compacted hash cache to %d entries', self._log_records)
+
+    def _encode(self, key):
+        return json.dumps({'a': key[0], 'k': list(key[1:]), 'd': self._entries[key]}) + '\n'
+
+    @staticmethod
+    def _fsync_dir(path):
+        """刷新目录项，保证替换操作落盘（Windows不支持，忽略）"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _xattr_get(self, path, st, algorithm):
+        try:
+            value = os.getxattr(path, XATTR_PREFIX + algorithm).decode('ascii')
+            size, mtime_ns, digest = value.split(':')
+        except (OSError, ValueError):
+            return None
+        if int(size) != st.st_size or int(mtime_ns) != st.st_mtime_ns:
+            return None
+        return digest
+
+    def _xattr_set(self, path, st, digest, algorithm):
+        value = '%d:%d:%s' % (st.st_size, st.st_mtime_ns, digest)
+        try:
+            os.setxattr(path, XATTR_PREFIX + algorithm, value.encode('ascii'))
+            return True
+        except OSError:
+            return False
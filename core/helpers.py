@@ -2,9 +2,12 @@
 
 import os
 import json
+import logging
 import struct
 import hashlib
 import sys
+import queue
+import threading
 from pathlib import Path
 
 # 添加项目根目录到Python路径
@@ -13,14 +16,22 @@ if str(project_root) not in sys.path:
     sys.path.insert(0, str(project_root))
 
 from config_manager import ConfigManager
+from .socket_reader import get_reader
 
 # 全局配置管理器实例
 _config_manager = ConfigManager()
 
+# 同步根目录下的元数据目录（哈希缓存等），不参与同步
+SYNC_META_DIR = '.lan_sync'
+
 def get_performance_config():
     """获取性能配置"""
     return _config_manager.get_performance_config()
 
+def set_performance_option(key, value):
+    """在内存中覆盖单个性能配置项（如命令行参数）"""
+    _config_manager.get_performance_config()[key] = value
+
 def get_chunk_size():
     """获取动态块大小"""
     config = get_performance_config()
@@ -41,12 +52,217 @@ def get_thread_count():
     config = get_performance_config()
     return config.get('thread_count', 4)
 
+def get_hash_workers():
+    """获取清单哈希并行数（0表示按CPU核数自动选择）"""
+    config = get_performance_config()
+    return config.get('hash_workers', 0)
+
+def should_use_process_hash_pool():
+    """清单哈希是否使用进程池（默认线程池）"""
+    config = get_performance_config()
+    return config.get('hash_use_processes', False)
+
+def should_use_lazy_hashing():
+    """是否启用懒哈希（先交换大小/修改时间，只对有歧义的文件计算摘要）"""
+    config = get_performance_config()
+    return config.get('lazy_hashing', True)
+
+def get_hash_verify_policy():
+    """摘要校验策略：lazy 仅校验大小相同但修改时间不同的文件，always 校验所有共同文件"""
+    config = get_performance_config()
+    return config.get('hash_verify_policy', 'lazy')
+
+def get_digest_algorithms():
+    """获取允许协商的摘要算法（blake2b/blake2s/sha256）"""
+    config = get_performance_config()
+    return config.get('digest_algorithms', ['blake2b', 'blake2s', 'sha256'])
+
+def get_digest_size():
+    """获取 blake2 系列算法的摘要字节数"""
+    config = get_performance_config()
+    return config.get('digest_size', 32)
+
+def should_stream_manifest():
+    """是否启用流式清单（边扫描边发送清单批次）"""
+    config = get_performance_config()
+    return config.get('stream_manifest', True)
+
+def should_use_merkle_tree():
+    """是否启用 Merkle 目录摘要比较（优先于流式清单）"""
+    config = get_performance_config()
+    return config.get('merkle_tree', True)
+
+def should_use_sync_journal():
+    """是否按对端记录同步日志，下次只交换变化的清单条目"""
+    config = get_performance_config()
+    return config.get('sync_journal', True)
+
+def get_watch_debounce():
+    """监视模式的防抖时间（秒），期间的事件合并后一起推送"""
+    config = get_performance_config()
+    return config.get('watch_debounce', 0.5)
+
+def get_watch_rescan_interval():
+    """监视模式的完整扫描间隔（秒），补上 inotify 漏报的变化"""
+    config = get_performance_config()
+    return config.get('watch_rescan_interval', 300)
+
+def should_use_sqlite_manifest():
+    """清单是否存放在 SQLite 磁盘存储中（超大目录树，内存占用不随规模增长）"""
+    config = get_performance_config()
+    return config.get('manifest_store', 'memory') == 'sqlite'
+
+def should_use_binary_manifest():
+    """是否使用二进制清单编码（对端不支持时回退到JSON）"""
+    config = get_performance_config()
+    return config.get('binary_manifest', True)
+
+def should_compress_manifest():
+    """二进制清单是否再做 zlib 压缩"""
+    config = get_performance_config()
+    return config.get('manifest_compression', True)
+
+def get_manifest_batch_size():
+    """获取流式清单每批条目数"""
+    config = get_performance_config()
+    return config.get('manifest_batch_size', 1000)
+
+def get_walk_workers():
+    """获取目录遍历并行数（网络盘/机械盘可调大）"""
+    config = get_performance_config()
+    return config.get('walk_workers', 1)
+
 # 新增性能优化函数
 def should_use_memory_mapping():
     """是否使用内存映射"""
     config = get_performance_config()
     return config.get('use_memory_mapping', True)
 
+def should_use_sendfile():
+    """未压缩文件是否使用 sendfile 零拷贝发送（平台不支持时自动回退）"""
+    config = get_performance_config()
+    return config.get('use_sendfile', True)
+
+def get_multi_stream_count():
+    """大文件并行传输使用的数据连接数（小于2时不使用并行连接）"""
+    config = get_performance_config()
+    return config.get('multi_stream_count', 4)
+
+def get_multi_stream_threshold():
+    """文件大小达到该值时经并行数据连接发送"""
+    config = get_performance_config()
+    return config.get('multi_stream_threshold', 64 * 1024 * 1024)
+
+def should_use_delta_transfer():
+    """对端已有旧版本的大文件是否只传输变化部分"""
+    config = get_performance_config()
+    return config.get('delta_transfer', True)
+
+def get_delta_threshold():
+    """本地旧版本达到该大小时请求增量传输"""
+    config = get_performance_config()
+    return config.get('delta_threshold', 4 * 1024 * 1024)
+
+def should_use_chunk_dedup():
+    """是否按内容定义的块传输大文件，只发送接收方本地没有的块"""
+    config = get_performance_config()
+    return config.get('chunk_dedup', False)
+
+def get_chunk_threshold():
+    """文件大小达到该值时按块去重传输"""
+    config = get_performance_config()
+    return config.get('chunk_threshold', 1024 * 1024)
+
+def should_batch_small_files():
+    """是否把多个小文件打包成一条批量消息发送"""
+    config = get_performance_config()
+    return config.get('file_batch', True)
+
+def get_batch_file_threshold():
+    """不超过该大小的文件参与批量发送"""
+    config = get_performance_config()
+    return config.get('batch_file_threshold', 64 * 1024)
+
+def get_batch_max_bytes():
+    """单个批量消息的内容大小上限"""
+    config = get_performance_config()
+    return config.get('batch_max_bytes', 4 * 1024 * 1024)
+
+def get_batch_write_workers():
+    """接收方写入批量消息中文件的线程数"""
+    config = get_performance_config()
+    return config.get('batch_write_workers', 4)
+
+def should_resume_transfers():
+    """是否保存中断的大文件并在下次同步时续传"""
+    config = get_performance_config()
+    return config.get('resumable_transfers', True)
+
+def get_resume_min_bytes():
+    """中断时已收到至少这么多字节才保存部分文件"""
+    config = get_performance_config()
+    return config.get('resume_min_bytes', 8388608)  # 8MB
+
+def get_write_behind_depth():
+    """接收大文件时在读取线程和写入线程之间排队的缓冲区数，0表示不使用"""
+    config = get_performance_config()
+    return config.get('write_behind_depth', 8)
+
+def get_write_behind_buffer_size():
+    """后台写入的每个缓冲区大小"""
+    config = get_performance_config()
+    return config.get('write_behind_buffer_size', 1048576)  # 1MB
+
+def get_write_behind_threshold():
+    """使用后台写入的文件大小阈值"""
+    config = get_performance_config()
+    return config.get('write_behind_threshold', 4194304)  # 4MB
+
+def get_read_ahead_depth():
+    """发送时后台预读的块数，0表示不预读"""
+    config = get_performance_config()
+    return config.get('read_ahead_depth', 4)
+
+def get_read_ahead_memory():
+    """预读缓冲区的内存上限"""
+    config = get_performance_config()
+    return config.get('read_ahead_memory', 16777216)  # 16MB
+
+def get_read_ahead_files():
+    """发送大文件时提示内核预读的后续文件数"""
+    config = get_performance_config()
+    return config.get('read_ahead_files', 2)
+
+def should_use_sparse_transfer():
+    """是否只传输稀疏文件的数据区段"""
+    config = get_performance_config()
+    return config.get('sparse_transfer', True)
+
+def get_sparse_threshold():
+    """按稀疏文件传输的最小文件大小"""
+    config = get_performance_config()
+    return config.get('sparse_threshold', 1048576)  # 1MB
+
+def should_hash_transfers():
+    """是否在传输时顺带计算摘要，接收方替换前校验并记入哈希缓存"""
+    config = get_performance_config()
+    return config.get('hash_while_transfer', True)
+
+def get_want_policy():
+    """需求文件的发送顺序：smallest/largest/newest/manifest"""
+    config = get_performance_config()
+    return config.get('want_policy', 'smallest')
+
+def get_want_in_flight():
+    """最多同时请求（尚未收到）的文件数，0表示一次请求全部"""
+    config = get_performance_config()
+    return config.get('want_in_flight', 1024)
+
+def get_want_chunk_size():
+    """每条需求消息的文件数"""
+    config = get_performance_config()
+    return config.get('want_chunk_size', 256)
+
 def should_use_stream_protocol():
     """是否使用流式协议"""
     config = get_performance_config()
@@ -77,18 +293,33 @@ def should_enable_compression():
     config = get_performance_config()
     return config.get('enable_compression', False)
 
+def get_compression_level():
+    """分帧压缩的 zlib 压缩级别"""
+    config = get_performance_config()
+    return config.get('compression_level', 1)
+
+def get_compression_sample_size():
+    """决定是否压缩时每段样本的大小"""
+    config = get_performance_config()
+    return config.get('compression_sample_size', 65536)  # 64KB
+
+def get_link_speed_mbps():
+    """链路速度的初始估计（Mbps），之后按实际发送速度更新"""
+    config = get_performance_config()
+    return config.get('link_speed_mbps', 1000)
+
 def should_use_adaptive_threading():
     """是否使用自适应线程数"""
     config = get_performance_config()
     return config.get('adaptive_threading', True)
 
-def calculate_optimal_chunk_size(file_size):
-    """计算最优块大小"""
+def calculate_optimal_chunk_size(file_size, max_size=None):
+    """计算最优块大小；max_size 为连接上协商的最大块大小（默认按配置）"""
     if not should_use_dynamic_chunk_size():
         return get_chunk_size()
     
     min_size = get_min_chunk_size()
-    max_size = get_max_chunk_size()
+    max_size = max_size or get_max_chunk_size()
     
     # 根据文件大小动态调整块大小
     if file_size < 10 * 1024 * 1024:  # 小于10MB
@@ -113,6 +344,16 @@ def calculate_optimal_threads(file_size):
     else:  # 大于50MB
         return min(base_threads * 2, 16)  # 最多16线程
 
+def should_use_hash_cache():
+    """是否启用持久化哈希缓存"""
+    config = get_performance_config()
+    return config.get('use_hash_cache', True)
+
+def should_use_xattr_hash_cache():
+    """是否将哈希缓存写入扩展属性（仅Linux）"""
+    config = get_performance_config()
+    return config.get('hash_cache_xattr', False)
+
 # 保持向后兼容性
 CHUNK_SIZE = get_chunk_size()
 
@@ -128,25 +369,146 @@ def compute_sha256(path):
     return h.hexdigest()
 
 
-def build_manifest(base_dir):
-    """构建文件清单"""
+def _open_hash_cache(base_dir, use_cache):
+    """按配置打开同步根目录的哈希缓存"""
+    if use_cache is None:
+        use_cache = should_use_hash_cache()
+    if not use_cache:
+        return None
+    from .hash_cache import get_hash_cache
+    return get_hash_cache(base_dir, use_xattr=should_use_xattr_hash_cache())
+
+
+def _hash_pending(manifest, pending, cache, algorithm, drop_missing):
+    """并行计算未命中缓存的文件摘要并写回清单"""
+    if not pending:
+        return
+    from .digest import digest_func
+    from .parallel_hash import ParallelHasher
+    hasher = ParallelHasher(digest_func(algorithm), workers=get_hash_workers(),
+                            use_processes=should_use_process_hash_pool())
+    jobs = [(rel, str(fpath), st.st_size) for rel, (fpath, st) in pending.items()]
+    for rel, digest in hasher.hash_files(jobs):
+        if digest is None:
+            # 扫描后被删除或无法读取的文件
+            if drop_missing:
+                del manifest[rel]
+            continue
+        manifest[rel][algorithm] = digest
+        if cache:
+            cache.store(*pending[rel], digest, algorithm)
+
+
+def _walk_tree(base_dir):
+    """遍历同步目录（跳过元数据目录），产出 (相对路径, 路径, stat结果)"""
+    from .walker import walk_tree
+    return walk_tree(base_dir, workers=get_walk_workers(), skip_root_dirs=(SYNC_META_DIR,))
+
+
+def build_manifest(base_dir, use_cache=None, with_digests=True, algorithm='sha256'):
+    """构建文件清单（未变化的文件复用哈希缓存，其余并行计算）
+
+    条目中的摘要以算法标识为键（默认 sha256，与旧版本格式一致）。
+    with_digests为False时只收集大小和修改时间，摘要由fill_digests按需补齐。
+    """
     manifest = {}
     base_dir = Path(base_dir)
-    for root, dirs, files in os.walk(base_dir):
-        for fname in files:
-            fpath = Path(root) / fname
-            rel = str(fpath.relative_to(base_dir)).replace('\\', '/')
-            try:
-                st = fpath.stat()
-            except OSError:
-                continue
-            size = st.st_size
-            mtime = int(st.st_mtime)
-            sha = compute_sha256(fpath)
-            manifest[rel] = {'size': size, 'mtime': mtime, 'sha256': sha}
+    cache = _open_hash_cache(base_dir, use_cache)
+    pending = {}
+    for rel, fpath, st in _walk_tree(base_dir):
+        manifest[rel] = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+        if not with_digests:
+            if cache:
+                cache.touch(st)
+            continue
+        digest = cache.lookup(fpath, st, algorithm) if cache else None
+        if digest is None:
+            pending[rel] = (fpath, st)
+        else:
+            manifest[rel][algorithm] = digest
+    _hash_pending(manifest, pending, cache, algorithm, drop_missing=True)
+    if cache:
+        cache.save()
     return manifest
 
 
+def iter_manifest_batches(base_dir, batch_size, with_digests=False, algorithm='sha256', use_cache=None):
+    """边遍历边产出清单批次（流式清单）"""
+    base_dir = Path(base_dir)
+    cache = _open_hash_cache(base_dir, use_cache)
+    batch = {}
+    for rel, fpath, st in _walk_tree(base_dir):
+        batch[rel] = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+        if cache:
+            cache.touch(st)
+        if len(batch) >= batch_size:
+            if with_digests:
+                fill_digests(base_dir, batch, list(batch), algorithm, use_cache)
+            yield batch
+            batch = {}
+    if batch:
+        if with_digests:
+            fill_digests(base_dir, batch, list(batch), algorithm, use_cache)
+        yield batch
+    if cache:
+        cache.save()
+
+
+def stat_entry(base_dir, rel):
+    """读取单个文件的清单条目，不存在时返回None"""
+    try:
+        st = (Path(base_dir) / rel).stat()
+    except OSError:
+        return None
+    return {'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+def fill_digests(base_dir, manifest, paths, algorithm='sha256', use_cache=None):
+    """为清单中指定的路径补齐摘要（懒哈希）"""
+    base_dir = Path(base_dir)
+    cache = _open_hash_cache(base_dir, use_cache)
+    pending = {}
+    for rel in paths:
+        meta = manifest.get(rel)
+        if meta is None or algorithm in meta:
+            continue
+        fpath = base_dir / rel
+        try:
+            st = fpath.stat()
+        except OSError:
+            continue
+        digest = cache.lookup(fpath, st, algorithm) if cache else None
+        if digest is None:
+            pending[rel] = (fpath, st)
+        else:
+            meta[algorithm] = digest
+    _hash_pending(manifest, pending, cache, algorithm, drop_missing=False)
+    if cache:
+        cache.save(evict=False)
+
+
+def preallocate_file(fd, size):
+    """预先分配文件空间，减少碎片和写入时的块分配停顿；不支持时只设置文件大小"""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+def apply_file_mtime(path, header):
+    """按发送方的修改时间设置接收到的文件，使下次同步可以直接比较大小和时间"""
+    mtime_ns = header.get('mtime_ns')
+    if mtime_ns is None:
+        return
+    try:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    except OSError as e:
+        logging.warning('Failed to set mtime of %s: %s', path, e)
+
+
 def send_json(sock, obj):
     """发送JSON数据"""
     data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
@@ -156,22 +518,58 @@ def send_json(sock, obj):
 
 def recv_json(sock):
     """接收JSON数据"""
-    header = recvn(sock, 4)
+    reader = get_reader(sock)
+    header = reader.read_exact(4)
     if not header:
         return None
     (length,) = struct.unpack('>I', header)
-    data = recvn(sock, length)
+    data = reader.read_exact(length)
     if not data:
         return None
     return json.loads(data.decode('utf-8'))
 
 
+class BackgroundSender:
+    """后台线程按顺序发送消息，调用线程同时读取对端的消息
+
+    双方同时发送大消息、都要发完才开始读取时，套接字缓冲区填满后两边都阻塞在发送上；
+    经由后台线程发送时双方都在读取，不会互相等待。
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._send_loop, name='background-send', daemon=True)
+        self._thread.start()
+
+    def _send_loop(self):
+        while True:
+            send_func = self._queue.get()
+            if send_func is None:
+                return
+            if self.error is None:
+                try:
+                    send_func()
+                except Exception as e:
+                    # 出错后丢弃之后的消息，由 close 返回错误
+                    self.error = e
+
+    def send_json(self, obj):
+        """排队发送一条JSON消息"""
+        self._queue.put(lambda: send_json(self.sock, obj))
+
+    def submit(self, send_func):
+        """排队执行一个发送函数（在后台线程中调用）"""
+        self._queue.put(send_func)
+
+    def close(self):
+        """等待排队的消息发送完毕，发送失败时返回异常，否则返回 None"""
+        self._queue.put(None)
+        self._thread.join()
+        return self.error
+
+
 def recvn(sock, n):
-    """接收指定数量的字节"""
-    buf = b''
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            return None
-        buf += chunk
-    return buf
\ No newline at end of file
+    """接收指定数量的字节（经过套接字的缓冲读取器），连接关闭时返回 None"""
+    return get_reader(sock).read_exact(n)
\ No newline at end of file
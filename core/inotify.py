@@ -0,0 +1,162 @@
+"""目录监视模块 - 通过 ctypes 调用 Linux inotify，不依赖第三方库"""
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# 文件写完或移入即视为变化；目录的创建/移入需要补充监视
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None and os.name == 'posix':
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            return None
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+def inotify_available():
+    """当前平台是否支持 inotify"""
+    return _load_libc() is not None
+
+
+class Inotify:
+    """inotify 文件描述符的最小封装"""
+
+    def __init__(self):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self, timeout):
+        """等待最多 timeout 秒，返回 [(wd, mask, cookie, name), ...]"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class DirectoryWatcher:
+    """递归监视同步目录，汇总发生变化的相对路径
+
+    新建或移入的目录会补充监视，并把其中已有的文件一并报告为变化。
+    事件队列溢出时 poll 返回 overflow=True，调用方应做一次完整扫描。
+    """
+
+    def __init__(self, base_dir, skip_root_dirs=()):
+        self.base_dir = os.fspath(base_dir)
+        self.skip_root_dirs = set(skip_root_dirs)
+        self.logger = logging.getLogger(__name__)
+        self._inotify = Inotify()
+        self._dirs = {}
+        self._add_tree('')
+
+    def _add_tree(self, rel_dir):
+        """监视目录及其所有子目录，返回其中已有的文件"""
+        full = os.path.join(self.base_dir, rel_dir) if rel_dir else self.base_dir
+        files = []
+        for dirpath, dirnames, filenames in os.walk(full):
+            rel_parent = os.path.relpath(dirpath, self.base_dir).replace(os.sep, '/')
+            if rel_parent == '.':
+                rel_parent = ''
+                dirnames[:] = [d for d in dirnames if d not in self.skip_root_dirs]
+            self._add_dir(rel_parent)
+            prefix = rel_parent + '/' if rel_parent else ''
+            files.extend(prefix + name for name in filenames)
+        return files
+
+    def _add_dir(self, rel_dir):
+        path = os.path.join(self.base_dir, rel_dir) if rel_dir else self.base_dir
+        try:
+            wd = self._inotify.add_watch(path)
+        except OSError as e:
+            self.logger.warning('Cannot watch %s: %s', path, e)
+            return
+        self._dirs[wd] = rel_dir
+
+    def poll(self, timeout):
+        """等待事件，返回 (变化的相对路径集合, 是否溢出)"""
+        changed = set()
+        overflow = False
+        for wd, mask, cookie, name in self._inotify.read_events(timeout):
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            rel_dir = self._dirs.get(wd)
+            if rel_dir is None or not name:
+                continue
+            if not rel_dir and name in self.skip_root_dirs:
+                continue
+            rel = rel_dir + '/' + name if rel_dir else name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self._add_tree(rel))
+                continue
+            changed.add(rel)
+        return changed, overflow
+
+    def close(self):
+        self._inotify.close()
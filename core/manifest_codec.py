@@ -0,0 +1,181 @@
+"""二进制清单编码模块 - 排序、前缀压缩路径、原始字节摘要与变长整数
+
+二进制清单紧跟在 JSON 消息头之后，以若干帧发送：每帧为4字节长度加数据，
+长度为0的帧表示结束。帧内容（可选 zlib 压缩后）是连续的条目记录：
+
+    varint 与上一路径相同的前缀字节数
+    varint 剩余路径字节数 + 路径字节（UTF-8）
+    varint 大小
+    varint 修改时间（zigzag 编码，允许负数）
+    varint 摘要字节数（0 表示无摘要） + 摘要原始字节
+
+编码和解码都按帧逐步进行，不需要一次性构造整个清单的字节串。
+"""
+
+import os
+import zlib
+import struct
+
+from .helpers import send_json, recvn
+
+BINARY_ENCODING = 'binary'
+# 单帧未压缩数据的目标大小
+FRAME_SIZE = 64 * 1024
+
+
+def _put_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(buf, pos):
+    """解码变长整数，数据不完整时抛出 IndexError"""
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _path_bytes(rel):
+    return rel.encode('utf-8', 'surrogateescape')
+
+
+def iter_encoded_frames(manifest, algorithm, compress=False):
+    """按路径排序编码清单，逐帧产出（已压缩）数据"""
+    paths = sorted(_path_bytes(rel) for rel in manifest)
+    items = ((path, manifest[path.decode('utf-8', 'surrogateescape')]) for path in paths)
+    return iter_encoded_sorted(items, algorithm, compress)
+
+
+def iter_encoded_sorted(items, algorithm, compress=False):
+    """编码已按路径字节排序的 (路径字节, 条目) 序列，逐帧产出数据"""
+    compressor = zlib.compressobj() if compress else None
+    out = bytearray()
+    prev = b''
+    for path, meta in items:
+        shared = len(os.path.commonprefix([prev, path]))
+        _put_varint(out, shared)
+        _put_varint(out, len(path) - shared)
+        out += path[shared:]
+        _put_varint(out, meta['size'])
+        _put_varint(out, _zigzag(meta['mtime']))
+        digest = meta.get(algorithm)
+        raw = bytes.fromhex(digest) if digest else b''
+        _put_varint(out, len(raw))
+        out += raw
+        prev = path
+        if len(out) >= FRAME_SIZE:
+            data = compressor.compress(bytes(out)) if compressor else bytes(out)
+            out = bytearray()
+            if data:
+                yield data
+    data = bytes(out)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def iter_decoded_entries(frames, algorithm):
+    """从帧数据流中逐条解码，产出 (相对路径, 条目)"""
+    buf = b''
+    pos = 0
+    prev = b''
+    for frame in frames:
+        buf = buf[pos:] + frame
+        pos = 0
+        while pos < len(buf):
+            try:
+                shared, p = _get_varint(buf, pos)
+                length, p = _get_varint(buf, p)
+                if p + length > len(buf):
+                    break
+                path = prev[:shared] + buf[p:p + length]
+                p += length
+                size, p = _get_varint(buf, p)
+                mtime, p = _get_varint(buf, p)
+                digest_len, p = _get_varint(buf, p)
+                if p + digest_len > len(buf):
+                    break
+                raw = buf[p:p + digest_len]
+                p += digest_len
+            except IndexError:
+                break
+            meta = {'size': size, 'mtime': _unzigzag(mtime)}
+            if raw:
+                meta[algorithm] = raw.hex()
+            prev = path
+            pos = p
+            yield path.decode('utf-8', 'surrogateescape'), meta
+    if pos != len(buf):
+        raise ValueError('Truncated binary manifest')
+
+
+def _iter_socket_frames(sock, compressed):
+    """读取清单帧直到结束帧，必要时解压"""
+    decompressor = zlib.decompressobj() if compressed else None
+    while True:
+        header = recvn(sock, 4)
+        if not header:
+            raise ConnectionError('Connection closed during binary manifest')
+        (length,) = struct.unpack('>I', header)
+        if length == 0:
+            break
+        data = recvn(sock, length)
+        if data is None:
+            raise ConnectionError('Connection closed during binary manifest')
+        if decompressor:
+            data = decompressor.decompress(data)
+        if data:
+            yield data
+    if decompressor:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+def send_manifest_message(sock, msg, key, manifest, algorithm, binary=False, compress=False):
+    """发送携带清单的消息；binary为False时清单作为JSON字段 key 发送"""
+    if not binary:
+        send_json(sock, dict(msg, **{key: manifest}))
+        return
+    send_sorted_manifest(sock, msg, iter_encoded_frames(manifest, algorithm, compress),
+                         len(manifest), algorithm, compress)
+
+
+def send_sorted_manifest(sock, msg, frames, count, algorithm, compress=False):
+    """发送二进制清单消息头和已编码的帧"""
+    send_json(sock, dict(msg, encoding=BINARY_ENCODING, compressed=compress,
+                         algorithm=algorithm, count=count))
+    for frame in frames:
+        sock.sendall(struct.pack('>I', len(frame)))
+        sock.sendall(frame)
+    sock.sendall(struct.pack('>I', 0))
+
+
+def iter_manifest_entries(sock, msg, key):
+    """逐条产出消息携带的清单；二进制清单边从套接字读取边解码"""
+    if msg.get('encoding') != BINARY_ENCODING:
+        return iter(msg.get(key, {}).items())
+    frames = _iter_socket_frames(sock, msg.get('compressed', False))
+    return iter_decoded_entries(frames, msg.get('algorithm', 'sha256'))
+
+
+def recv_manifest_entries(sock, msg, key):
+    """取出消息携带的清单；二进制清单从套接字继续读取"""
+    return dict(iter_manifest_entries(sock, msg, key))
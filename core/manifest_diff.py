@@ -0,0 +1,110 @@
+"""清单比较模块 - 判断文件差异，并按需交换摘要（懒哈希）"""
+
+from .helpers import send_json, recv_json, fill_digests, get_hash_verify_policy, BackgroundSender
+from .digest import DEFAULT_DIGEST, parse_digest_id
+
+
+def differs(a, b, algorithm='sha256'):
+    """两个清单条目的内容是否不同"""
+    if a['size'] != b['size']:
+        return True
+    da, db = a.get(algorithm), b.get(algorithm)
+    if da and db:
+        return da != db
+    # 大小和修改时间都相同时视为未变化；缺少摘要时保守地认为不同
+    return a['mtime'] != b['mtime']
+
+
+def is_newer(theirs, mine, algorithm='sha256'):
+    """对端条目是否应覆盖本地条目（双向同步：较新的版本胜出）"""
+    if mine is None:
+        return True
+    return theirs['mtime'] > mine['mtime'] and differs(theirs, mine, algorithm)
+
+
+def digest_paths(my_manifest, peer_manifest):
+    """需要比较摘要的共同路径：大小相同但修改时间不同，或策略要求全部校验"""
+    verify_all = get_hash_verify_policy() == 'always'
+    paths = []
+    for rel, meta in peer_manifest.items():
+        mine = my_manifest.get(rel)
+        if mine is None or mine['size'] != meta['size']:
+            continue
+        if verify_all or mine['mtime'] != meta['mtime']:
+            paths.append(rel)
+    return paths
+
+
+def build_digest_reply(base_dir, manifest, msg):
+    """按请求中的算法计算摘要，返回 digests 消息"""
+    algorithm = msg.get('algorithm', DEFAULT_DIGEST)
+    paths = msg.get('paths', [])
+    try:
+        parse_digest_id(algorithm)
+    except ValueError:
+        algorithm = DEFAULT_DIGEST
+    fill_digests(base_dir, manifest, paths, algorithm)
+    # 本地不存在的路径返回None，便于对端结束等待
+    digests = {rel: manifest.get(rel, {}).get(algorithm) for rel in paths}
+    return {'type': 'digests', 'algorithm': algorithm, 'digests': digests}
+
+
+def answer_digest_request(sock, base_dir, manifest, msg):
+    """计算对端请求的摘要并发送"""
+    send_json(sock, build_digest_reply(base_dir, manifest, msg))
+
+
+def merge_digests(manifest, msg):
+    """将对端发来的摘要合并到对端清单"""
+    algorithm = msg.get('algorithm', DEFAULT_DIGEST)
+    for rel, digest in msg.get('digests', {}).items():
+        if digest and rel in manifest:
+            manifest[rel][algorithm] = digest
+
+
+def exchange_digests(sock, base_dir, my_manifest, peer_manifest, algorithm, log_func):
+    """双方互相请求有歧义文件的摘要，成功返回True"""
+    request = digest_paths(my_manifest, peer_manifest)
+    return run_digest_exchange(
+        sock, {'type': 'digest_request', 'algorithm': algorithm, 'paths': request},
+        lambda: fill_digests(base_dir, my_manifest, request, algorithm),
+        lambda msg: build_digest_reply(base_dir, my_manifest, msg),
+        lambda msg: merge_digests(peer_manifest, msg), log_func)
+
+
+def run_digest_exchange(sock, request, prepare, answer, merge, log_func):
+    """发送摘要请求并响应对端的请求，直到双方都完成，成功返回True
+
+    请求和回复由后台线程发送，双方同时发送大量路径或摘要时都在读取，不会互相阻塞。
+    prepare() 在请求发出后计算本地摘要，answer(msg) 返回对端请求的回复，
+    merge(msg) 合并对端的摘要；三者都在调用线程中执行。
+    """
+    sender = BackgroundSender(sock)
+    try:
+        sender.send_json(request)
+        log_func('Requested %s digests for %d ambiguous files', request['algorithm'], len(request['paths']))
+        prepare()
+
+        answered = False
+        received = False
+        while not (answered and received):
+            msg = recv_json(sock)
+            if msg is None:
+                log_func('Connection closed during digest exchange')
+                return False
+            t = msg.get('type')
+            if t == 'digest_request':
+                sender.send_json(answer(msg))
+                answered = True
+            elif t == 'digests':
+                merge(msg)
+                received = True
+            else:
+                log_func('Unexpected message during digest exchange: %s', t)
+                return False
+    finally:
+        error = sender.close()
+    if error is not None:
+        log_func('Failed to send during digest exchange: %s', error)
+        return False
+    return True
@@ -0,0 +1,185 @@
+"""SQLite 清单存储模块 - 本地和对端清单存放在磁盘上，内存占用与目录规模无关
+
+条目按 (side, 路径字节) 建立主键索引，比较和差异计算都在 SQL 中完成，
+只有需求列表和需要比较摘要的路径会读入内存。
+"""
+
+import sqlite3
+import tempfile
+from itertools import islice
+from pathlib import Path
+
+from .helpers import (
+    send_json, iter_manifest_batches, fill_digests, get_manifest_batch_size,
+    get_hash_verify_policy
+)
+from .manifest_codec import (
+    iter_encoded_sorted, send_sorted_manifest, iter_manifest_entries
+)
+from .manifest_diff import build_digest_reply, run_digest_exchange
+
+LOCAL = 0
+PEER = 1
+
+# 单次 executemany / 查询的行数
+_BATCH = 1000
+
+
+def _encode_path(rel):
+    return rel.encode('utf-8', 'surrogateescape')
+
+
+def _decode_path(path):
+    return path.decode('utf-8', 'surrogateescape')
+
+
+class ManifestStore:
+    """本地与对端清单的磁盘存储（会话期间有效，关闭后自动删除）
+
+    每个会话只使用一种摘要算法，摘要单独存放在 digest 列中。
+    """
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        # 空文件名：SQLite 创建私有的临时磁盘数据库，关闭时删除
+        self.db = sqlite3.connect('')
+        self.db.execute('PRAGMA journal_mode=OFF')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('''
+            CREATE TABLE entries (
+                side INTEGER NOT NULL,
+                path BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                digest TEXT,
+                PRIMARY KEY (side, path)
+            ) WITHOUT ROWID
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def add(self, side, items):
+        """写入 (相对路径, 条目) 序列，返回写入条数"""
+        total = 0
+        items = iter(items)
+        while True:
+            rows = [(side, _encode_path(rel), meta['size'], meta['mtime'], meta.get(self.algorithm))
+                    for rel, meta in islice(items, _BATCH)]
+            if not rows:
+                return total
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+            total += len(rows)
+
+    def count(self, side):
+        return self.db.execute('SELECT COUNT(*) FROM entries WHERE side = ?', (side,)).fetchone()[0]
+
+    def get_many(self, side, paths):
+        """读取指定路径的条目，返回 {相对路径: 条目}（只用于少量路径）"""
+        result = {}
+        for rel in paths:
+            row = self.db.execute('SELECT size, mtime, digest FROM entries WHERE side = ? AND path = ?',
+                                  (side, _encode_path(rel))).fetchone()
+            if row is not None:
+                result[rel] = self._meta(row[0], row[1], row[2])
+        return result
+
+    def set_digests(self, side, digests):
+        self.db.executemany('UPDATE entries SET digest = ? WHERE side = ? AND path = ?',
+                            [(digest, side, _encode_path(rel)) for rel, digest in digests.items() if digest])
+
+    def iter_sorted(self, side):
+        """按路径字节顺序产出 (路径字节, 条目)，供二进制编码使用"""
+        cursor = self.db.execute('SELECT path, size, mtime, digest FROM entries WHERE side = ? ORDER BY path',
+                                 (side,))
+        for path, size, mtime, digest in cursor:
+            yield path, self._meta(size, mtime, digest)
+
+    def digest_paths(self):
+        """需要比较摘要的共同路径（与 manifest_diff.digest_paths 规则一致）"""
+        verify_all = get_hash_verify_policy() == 'always'
+        cursor = self.db.execute('''
+            SELECT l.path FROM entries l JOIN entries p ON p.side = ? AND p.path = l.path
+            WHERE l.side = ? AND l.size = p.size AND (? OR l.mtime != p.mtime)
+        ''', (PEER, LOCAL, verify_all))
+        return [_decode_path(row[0]) for row in cursor]
+
+    def newer(self, src, dst):
+        """src 中应覆盖 dst 的路径（与 manifest_diff.is_newer 规则一致）"""
+        cursor = self.db.execute('''
+            SELECT s.path FROM entries s LEFT JOIN entries d ON d.side = ? AND d.path = s.path
+            WHERE s.side = ? AND (
+                d.path IS NULL OR (s.mtime > d.mtime AND (
+                    s.size != d.size OR s.digest IS NULL OR d.digest IS NULL OR s.digest != d.digest)))
+        ''', (dst, src))
+        return [_decode_path(row[0]) for row in cursor]
+
+    def _meta(self, size, mtime, digest):
+        meta = {'size': size, 'mtime': mtime}
+        if digest:
+            meta[self.algorithm] = digest
+        return meta
+
+
+def build_local_store(base_dir, store, with_digests):
+    """边遍历边把本地清单写入存储，返回条目数"""
+    total = 0
+    for batch in iter_manifest_batches(base_dir, get_manifest_batch_size(),
+                                       with_digests=with_digests, algorithm=store.algorithm):
+        total += store.add(LOCAL, batch.items())
+    return total
+
+
+def send_local_store(sock, store, binary, compress):
+    """发送本地清单；二进制编码时从存储中按序读取，不在内存中构造完整清单"""
+    if not binary:
+        manifest = {_decode_path(path): meta for path, meta in store.iter_sorted(LOCAL)}
+        send_json(sock, {'type': 'manifest', 'algorithm': store.algorithm, 'manifest': manifest})
+        return
+    frames = iter_encoded_sorted(store.iter_sorted(LOCAL), store.algorithm, compress)
+    send_sorted_manifest(sock, {'type': 'manifest'}, frames, store.count(LOCAL),
+                         store.algorithm, compress)
+
+
+class _SpoolWriter:
+    """提供 sendall 接口，把要发送的数据写入临时文件"""
+
+    def __init__(self, f):
+        self.sendall = f.write
+
+
+def spool_local_store(store, binary, compress):
+    """把完整的本地清单消息写入临时文件并返回（已回到开头）
+
+    发送可以放到后台线程进行，而不必在另一个线程中读取 SQLite 连接。
+    """
+    spool = tempfile.TemporaryFile()
+    send_local_store(_SpoolWriter(spool), store, binary, compress)
+    spool.seek(0)
+    return spool
+
+
+def ingest_peer_manifest(sock, store, msg):
+    """把对端清单逐条写入存储，返回条目数"""
+    return store.add(PEER, iter_manifest_entries(sock, msg, 'manifest'))
+
+
+def exchange_store_digests(sock, base_dir, store, log_func):
+    """与 manifest_diff.exchange_digests 相同的摘要交换，摘要读写存储"""
+    base_dir = Path(base_dir)
+    algorithm = store.algorithm
+    request = store.digest_paths()
+
+    def prepare():
+        mine = store.get_many(LOCAL, request)
+        fill_digests(base_dir, mine, request, algorithm)
+        store.set_digests(LOCAL, {rel: meta.get(algorithm) for rel, meta in mine.items()})
+
+    def merge(msg):
+        if msg.get('algorithm', algorithm) == algorithm:
+            store.set_digests(PEER, msg.get('digests', {}))
+
+    return run_digest_exchange(
+        sock, {'type': 'digest_request', 'algorithm': algorithm, 'paths': request}, prepare,
+        lambda msg: build_digest_reply(base_dir, store.get_many(LOCAL, msg.get('paths', [])), msg),
+        merge, log_func)
@@ -0,0 +1,179 @@
+"""Merkle 目录摘要模块 - 先比较根摘要，只深入摘要不同的子目录"""
+
+from .helpers import send_json, recv_json, BackgroundSender
+from .digest import new_hash
+
+# 目录摘要只覆盖元数据，与协商的文件摘要算法无关，固定算法便于单向模式直接比较
+TREE_DIGEST = 'blake2b-128'
+# 每条 tree_nodes 消息最多包含的条目数，大目录的列表拆成多条发送
+TREE_REPLY_ENTRIES = 5000
+
+
+def _join(dir_path, name):
+    return dir_path + '/' + name if dir_path else name
+
+
+class MerkleTree:
+    """由清单构建的目录树，每个目录的摘要覆盖其所有子项
+
+    文件按 (名称, 大小, 修改时间) 参与计算，与是否已有内容摘要无关，
+    因此懒哈希清单也能直接比较。根目录的路径为空字符串。
+    """
+
+    def __init__(self, manifest):
+        self.nodes = {'': {'files': {}, 'dirs': {}}}
+        for rel, meta in manifest.items():
+            dir_path, _, name = rel.rpartition('/')
+            self._node(dir_path)['files'][name] = meta
+        self.digests = {}
+        # 先计算深层目录，父目录才能引用子目录摘要
+        for dir_path in sorted(self.nodes, key=lambda d: d.count('/') + bool(d), reverse=True):
+            self._compute(dir_path)
+
+    def _node(self, dir_path):
+        node = self.nodes.get(dir_path)
+        if node is None:
+            node = self.nodes[dir_path] = {'files': {}, 'dirs': {}}
+            parent, _, name = dir_path.rpartition('/')
+            self._node(parent)['dirs'][name] = None
+        return node
+
+    def _compute(self, dir_path):
+        node = self.nodes[dir_path]
+        for name in node['dirs']:
+            node['dirs'][name] = self.digests[_join(dir_path, name)]
+        children = [(name, 'f', meta) for name, meta in node['files'].items()]
+        children += [(name, 'd', digest) for name, digest in node['dirs'].items()]
+        h = new_hash(TREE_DIGEST)
+        for name, kind, value in sorted(children, key=lambda c: c[0]):
+            if kind == 'f':
+                line = 'f\0%s\0%d\0%d\n' % (name, value['size'], value['mtime'])
+            else:
+                line = 'd\0%s\0%s\n' % (name, value)
+            h.update(line.encode('utf-8', 'surrogateescape'))
+        self.digests[dir_path] = h.hexdigest()
+
+    @property
+    def root_digest(self):
+        return self.digests['']
+
+    def listing(self, dir_path):
+        """目录的直接子项：文件条目和子目录摘要"""
+        node = self.nodes.get(dir_path)
+        if node is None:
+            return {'files': {}, 'dirs': {}}
+        return {'files': node['files'], 'dirs': node['dirs']}
+
+
+def exchange_tree(sock, my_tree, peer_root, log_func, serve_peer=True):
+    """沿摘要不同的目录逐层向对端请求目录列表，返回对端的部分清单
+
+    每层只需一次往返；根摘要相同时不发送任何请求。serve_peer为True时同时
+    响应对端的请求，直到双方都发送 tree_done（双向同步）。请求和回复都由后台
+    线程发送，双方同时发送大目录列表时不会互相阻塞。失败返回None。
+    """
+    sender = BackgroundSender(sock)
+    try:
+        peer_manifest, rounds = _exchange_tree(sender, sock, my_tree, peer_root, log_func, serve_peer)
+    finally:
+        error = sender.close()
+    if error is not None:
+        log_func('Failed to send during tree comparison: %s', error)
+        return None
+    if peer_manifest is not None:
+        log_func('Tree comparison finished in %d round trips (%d peer entries)',
+                 rounds, len(peer_manifest))
+    return peer_manifest
+
+
+def _exchange_tree(sender, sock, my_tree, peer_root, log_func, serve_peer):
+    peer_manifest = {}
+    if peer_root == my_tree.root_digest:
+        pending_dirs = []
+    else:
+        pending_dirs = ['']
+    rounds = 0
+    outstanding = 0
+    my_done = False
+    peer_done = not serve_peer
+
+    while True:
+        if pending_dirs:
+            sender.send_json({'type': 'tree_request', 'dirs': pending_dirs})
+            pending_dirs = []
+            rounds += 1
+            outstanding += 1
+        elif not outstanding and not my_done:
+            my_done = True
+            if serve_peer:
+                sender.send_json({'type': 'tree_done'})
+        if my_done and peer_done:
+            break
+
+        msg = recv_json(sock)
+        if msg is None:
+            log_func('Connection closed during tree comparison')
+            return None, rounds
+        t = msg.get('type')
+        if t == 'tree_request' and serve_peer:
+            dirs = msg.get('dirs', [])
+            sender.submit(lambda dirs=dirs: _send_tree_replies(sock, my_tree, dirs))
+        elif t == 'tree_nodes':
+            # 拆分的回复只有最后一条不带 more
+            if not msg.get('more'):
+                outstanding -= 1
+            for dir_path, node in msg.get('nodes', {}).items():
+                for name, meta in node.get('files', {}).items():
+                    peer_manifest[_join(dir_path, name)] = meta
+                for name, digest in node.get('dirs', {}).items():
+                    child = _join(dir_path, name)
+                    if my_tree.digests.get(child) != digest:
+                        pending_dirs.append(child)
+        elif t == 'tree_done':
+            peer_done = True
+        else:
+            log_func('Unexpected message during tree comparison: %s', t)
+            return None, rounds
+
+    return peer_manifest, rounds
+
+
+def _tree_replies(my_tree, dirs):
+    """产出请求目录的列表，每条消息最多 TREE_REPLY_ENTRIES 个条目，最后一条之外都带 'more': True"""
+    nodes = {}
+    count = 0
+    for dir_path in dirs:
+        listing = my_tree.listing(dir_path)
+        node = nodes[dir_path] = {'files': {}, 'dirs': {}}
+        for kind in ('files', 'dirs'):
+            for name, value in listing[kind].items():
+                if count >= TREE_REPLY_ENTRIES:
+                    yield {'type': 'tree_nodes', 'nodes': nodes, 'more': True}
+                    nodes = {}
+                    node = nodes[dir_path] = {'files': {}, 'dirs': {}}
+                    count = 0
+                node[kind][name] = value
+                count += 1
+    yield {'type': 'tree_nodes', 'nodes': nodes}
+
+
+def _send_tree_replies(sock, my_tree, dirs):
+    for msg in _tree_replies(my_tree, dirs):
+        send_json(sock, msg)
+
+
+def compare_trees(sock, my_tree, log_func):
+    """双向同步：交换根摘要并逐层比较，返回对端的部分清单（失败返回None）"""
+    send_json(sock, {'type': 'tree_root', 'digest': my_tree.root_digest})
+    msg = recv_json(sock)
+    if not msg or msg.get('type') != 'tree_root':
+        log_func('Expected tree root from peer, got: %s', msg)
+        return None
+    if msg.get('digest') == my_tree.root_digest:
+        log_func('Directory trees are identical')
+    return exchange_tree(sock, my_tree, msg.get('digest'), log_func)
+
+
+def answer_tree_request(sock, my_tree, msg):
+    """响应对端的目录列表请求（单向发送方使用）"""
+    _send_tree_replies(sock, my_tree, msg.get('dirs', []))
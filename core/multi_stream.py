@@ -0,0 +1,342 @@
+"""多连接传输模块 - 大文件分块经多条并行 TCP 连接发送，接收方按偏移写入
+
+控制连接握手后，由连接方向监听方再建立若干条数据连接（以会话令牌认领）。
+大文件的头信息仍经控制连接发送并带有传输编号，文件内容被切成带偏移的块，
+由每条数据连接各自的发送线程取块发送；接收方每条数据连接有一个读取线程，
+把块读入缓冲区后交给写入线程池，用 os.pwrite 写入预分配文件的对应位置，读取线程
+随即用另一个缓冲区接收下一块（每条连接 WRITE_BUFFERS 个缓冲区）。偏移或长度
+超出文件范围、长度超过协商块大小的帧视为协议错误，关闭该连接。
+
+数据帧：4字节传输编号 + 8字节文件偏移 + 4字节长度 + 数据。
+每条连接上的帧按发送顺序到达；同一方向上文件依次发送，接收方在处理下一个
+文件头之前会等当前文件的所有块写完，因此不会出现互相等待。
+续传时只发送从起始偏移开始的块；传输中断时接收方得到已连续写入的前缀长度。
+"""
+
+import os
+import uuid
+import queue
+import socket
+import struct
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from .helpers import send_json, recv_json, get_multi_stream_count, preallocate_file
+from .socket_reader import get_reader
+from .protocol import get_chunk_limit
+
+STREAM_FRAME = struct.Struct('>IQI')
+# 数据连接建立和认领的超时（秒）
+ATTACH_TIMEOUT = 10
+# 每条数据连接的接收缓冲区数：一块在写入时读取线程接收下一块
+WRITE_BUFFERS = 2
+
+_pools = weakref.WeakKeyDictionary()
+_pools_lock = threading.Lock()
+
+
+def get_stream_pool(sock):
+    """返回控制连接上已建立的数据连接池，没有则返回 None"""
+    with _pools_lock:
+        return _pools.get(sock)
+
+
+def close_stream_pool(sock):
+    """关闭控制连接的数据连接池（如有）"""
+    with _pools_lock:
+        pool = _pools.pop(sock, None)
+    if pool is not None:
+        pool.close()
+
+
+def new_stream_session():
+    """监听方为本次会话生成数据连接令牌"""
+    return uuid.uuid4().hex
+
+
+def setup_stream_pool(sock, peer_streams, log_func, listener=None, session=None):
+    """按双方的数据连接参数建立连接池并关联到控制连接
+
+    监听方（给出了 listener 和 session）接受连接；连接方按对端给出的令牌发起连接。
+    peer_streams 为对端握手中的 {'count', 'session'}；返回连接池，未建立时返回 None。
+    """
+    if not peer_streams:
+        return None
+    count = min(get_multi_stream_count(), peer_streams.get('count', 0))
+    if count < 1:
+        return None
+    if listener is not None and session:
+        socks = _accept_streams(listener, session, count, log_func)
+    elif peer_streams.get('session'):
+        socks = _open_streams(sock.getpeername()[:2], peer_streams['session'], count, log_func)
+    else:
+        return None
+    if not socks:
+        log_func('No data connections established, using the control connection only')
+        return None
+    log_func('Established %d parallel data connections', len(socks))
+    pool = StreamPool(socks, log_func, get_chunk_limit(sock))
+    with _pools_lock:
+        _pools[sock] = pool
+    return pool
+
+
+def _accept_streams(listener, session, count, log_func):
+    socks = []
+    previous = listener.gettimeout()
+    listener.settimeout(ATTACH_TIMEOUT)
+    try:
+        while len(socks) < count:
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                log_func('Timed out waiting for data connections (%d of %d)', len(socks), count)
+                break
+            try:
+                conn.settimeout(ATTACH_TIMEOUT)
+                msg = recv_json(conn)
+                if not msg or msg.get('type') != 'stream_attach' or msg.get('session') != session:
+                    log_func('Rejected unexpected connection while waiting for data connections')
+                    conn.close()
+                    continue
+                send_json(conn, {'type': 'stream_ready'})
+                conn.settimeout(None)
+            except OSError as e:
+                log_func('Data connection failed: %s', e)
+                conn.close()
+                continue
+            socks.append(conn)
+    finally:
+        listener.settimeout(previous)
+    return socks
+
+
+def _open_streams(address, session, count, log_func):
+    from .network_services import create_socket_with_performance_settings
+    socks = []
+    for index in range(count):
+        conn = create_socket_with_performance_settings()
+        try:
+            conn.settimeout(ATTACH_TIMEOUT)
+            conn.connect(address)
+            send_json(conn, {'type': 'stream_attach', 'session': session, 'index': index})
+            msg = recv_json(conn)
+            if not msg or msg.get('type') != 'stream_ready':
+                raise ConnectionError('peer did not accept the data connection')
+            conn.settimeout(None)
+        except OSError as e:
+            log_func('Data connection %d failed: %s', index, e)
+            conn.close()
+            break
+        socks.append(conn)
+    return socks
+
+
+class IncompleteTransfer(ConnectionError):
+    """数据连接在文件传输中途关闭；prefix 为从文件开头起已连续写入的字节数"""
+
+    def __init__(self, message, prefix):
+        super().__init__(message)
+        self.prefix = prefix
+
+
+class _Incoming:
+    """正在接收的文件；fd 为 None 时丢弃数据（如拒绝的不安全路径）"""
+
+    def __init__(self, fd, size, start=0):
+        self.fd = fd
+        self.size = size
+        self.start = start
+        self.received = 0
+        self.error = None
+        # 已写入的块：偏移 -> 长度，用于计算中断时的连续前缀
+        self.written = {}
+
+    def prefix(self):
+        """从文件开头起已连续写入的字节数"""
+        offset = self.start
+        while offset in self.written:
+            offset += self.written[offset]
+        return offset
+
+
+class StreamPool:
+    """一组并行数据连接，每条连接一个读取线程，发送时每条连接一个发送任务
+
+    chunk_limit 为协商的块大小，对端发来的块不能超过它。
+    """
+
+    def __init__(self, socks, log_func, chunk_limit):
+        self.socks = socks
+        self.log_func = log_func
+        self.chunk_limit = chunk_limit
+        self._next_id = 0
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._incoming = {}
+        self._closed = False
+        # 仍在读取的数据连接数；对端发完后正常关闭连接，全部关闭才算结束
+        self._live = len(socks)
+        self._executor = ThreadPoolExecutor(max_workers=len(socks))
+        self._writers = ThreadPoolExecutor(max_workers=len(socks), thread_name_prefix='stream-writer')
+        for s in socks:
+            threading.Thread(target=self._read_loop, args=(s,), daemon=True).start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for s in self.socks:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+        self._executor.shutdown(wait=False)
+        self._writers.shutdown(wait=False)
+
+    # 发送
+
+    def send_file(self, sock, header, path, start=0):
+        """经控制连接发送文件头，再把文件内容（从 start 开始）分块经各数据连接发送"""
+        size = header['size']
+        with self._send_lock:
+            self._next_id += 1
+            transfer_id = self._next_id
+            send_json(sock, dict(header, stream_id=transfer_id, compressed=False))
+            chunk_size = get_chunk_limit(sock)
+            offsets = iter(range(start, size, chunk_size))
+            offsets_lock = threading.Lock()
+
+            def next_chunk():
+                with offsets_lock:
+                    offset = next(offsets, None)
+                return None if offset is None else (offset, min(chunk_size, size - offset))
+
+            futures = [self._executor.submit(self._send_chunks, s, path, transfer_id, next_chunk)
+                       for s in self.socks]
+            for future in futures:
+                future.result()
+
+    @staticmethod
+    def _send_chunks(s, path, transfer_id, next_chunk):
+        """一条数据连接的发送任务：不断取下一个块发送，直到文件发完"""
+        with open(path, 'rb') as f:
+            while True:
+                chunk = next_chunk()
+                if chunk is None:
+                    return
+                offset, count = chunk
+                s.sendall(STREAM_FRAME.pack(transfer_id, offset, count))
+                # 平台不支持 os.sendfile 时 socket.sendfile 自动回退为读取+发送
+                sent = s.sendfile(f, offset, count)
+                if sent != count:
+                    raise ConnectionError('File changed while sending: %s' % path)
+
+    # 接收
+
+    def receive_file(self, header, temp_path, start=0):
+        """等待文件的所有块写入 temp_path；temp_path 为 None 时丢弃数据
+
+        start 不为0时（续传）保留 temp_path 中已有的前缀，只接收之后的块。
+        """
+        size = header['size']
+        fd = None
+        if temp_path is not None:
+            flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+            fd = os.open(temp_path, flags if start else flags | os.O_TRUNC, 0o644)
+            preallocate_file(fd, size)
+        incoming = _Incoming(fd, size, start)
+        expected = size - start
+        try:
+            with self._cond:
+                self._incoming[header['stream_id']] = incoming
+                self._cond.notify_all()
+                # 写入出错时也要等所有块到达，之后的块才不会等不到对应的文件
+                while incoming.received < expected and not self._closed:
+                    self._cond.wait()
+                del self._incoming[header['stream_id']]
+        finally:
+            if fd is not None:
+                os.close(fd)
+        if incoming.error is not None:
+            raise incoming.error
+        if incoming.received < expected:
+            raise IncompleteTransfer('Data connections closed during file transfer', incoming.prefix())
+
+    def _wait_incoming(self, transfer_id):
+        """等待控制连接上的对应文件头被处理"""
+        with self._cond:
+            while transfer_id not in self._incoming and not self._closed:
+                self._cond.wait()
+            return self._incoming.get(transfer_id)
+
+    def _read_loop(self, s):
+        reader = get_reader(s)
+        free = queue.Queue()
+        for _ in range(WRITE_BUFFERS):
+            free.put(bytearray(self.chunk_limit))
+        clean = False
+        try:
+            while True:
+                frame = reader.read_exact(STREAM_FRAME.size)
+                if frame is None:
+                    # 在帧边界处关闭：这条连接上已没有未到达的块
+                    clean = True
+                    return
+                transfer_id, offset, count = STREAM_FRAME.unpack(frame)
+                incoming = self._wait_incoming(transfer_id)
+                if incoming is None:
+                    return
+                if count > self.chunk_limit or offset < incoming.start or offset + count > incoming.size:
+                    raise ValueError('Invalid data frame from peer: %d+%d of %d bytes'
+                                     % (offset, count, incoming.size))
+                buf = free.get()
+                view = memoryview(buf)[:count]
+                submitted = False
+                try:
+                    if not reader.read_into(view):
+                        return
+                    self._writers.submit(self._write_chunk, incoming, offset, view, buf, free)
+                    submitted = True
+                except RuntimeError:
+                    # 连接池已关闭
+                    return
+                finally:
+                    if not submitted:
+                        view.release()
+                        free.put(buf)
+        except (OSError, ValueError) as e:
+            if not self._closed:
+                self.log_func('Data connection error: %s', e)
+        finally:
+            # 等待已提交的块写完，接收方才能关闭文件
+            for _ in range(WRITE_BUFFERS):
+                free.get()
+            with self._cond:
+                self._live -= 1
+                if not clean or not self._live:
+                    self._closed = True
+                self._cond.notify_all()
+
+    def _write_chunk(self, incoming, offset, view, buf, free):
+        """写入线程：把块写到文件的对应偏移并记账，然后把缓冲区交还读取线程"""
+        try:
+            count = len(view)
+            if incoming.fd is not None and incoming.error is None:
+                try:
+                    written = 0
+                    while written < count:
+                        written += os.pwrite(incoming.fd, view[written:], offset + written)
+                except OSError as e:
+                    incoming.error = e
+            with self._cond:
+                if incoming.error is None:
+                    incoming.written[offset] = count
+                incoming.received += count
+                if incoming.received >= incoming.size - incoming.start:
+                    self._cond.notify_all()
+        finally:
+            view.release()
+            free.put(buf)
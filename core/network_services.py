@@ -14,29 +14,7 @@ if str(project_root) not in sys.path:
 from .helpers import get_socket_buffer_size, should_disable_nagle, get_thread_count
 from .file_transfer import send_file_by_rel, receive_file
 from .unidirectional import handle_unidirectional_send, handle_unidirectional_receive
-
-
-def run_send(host, port, base_dir, log_callback=None):
-    """运行发送方模式：主动连接接收方并发送文件"""
-    log_func = log_callback or logging.info
-    log_func('Connecting to receiver %s:%d ...', host, port)
-    with socket.create_connection((host, port), timeout=30) as sock:
-        log_func('Connected to receiver %s:%d', host, port)
-        handle_unidirectional_send(sock, base_dir, log_callback)
-
-
-def run_receive(port, base_dir, log_callback=None, bind='0.0.0.0'):
-    """运行接收方模式：启动监听服务等待发送方连接"""
-    log_func = log_callback or logging.info
-    log_func('Listening for sender on %s:%d', bind, port)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((bind, port))
-        s.listen(1)
-        conn, addr = s.accept()
-        log_func('Accepted connection from sender %s:%d', addr[0], addr[1])
-        with conn:
-            handle_unidirectional_receive(conn, base_dir, log_callback)
+from .multi_stream import close_stream_pool
 
 
 def create_socket_with_performance_settings():
@@ -57,37 +35,34 @@ def create_socket_with_performance_settings():
     
     return sock
 
-def run_send(host, port, folder, log_callback):
-    """发送文件到接收方（使用性能配置）"""
-    try:
-        sock = create_socket_with_performance_settings()
+
+def run_send(host, port, base_dir, log_callback=None):
+    """运行发送方模式：主动连接接收方并发送文件（使用性能配置）"""
+    log_func = log_callback or logging.info
+    log_func('Connecting to receiver %s:%d ...', host, port)
+    with create_socket_with_performance_settings() as sock:
+        sock.settimeout(30)
         sock.connect((host, port))
-        log_callback(f'已连接到 {host}:{port}')
-        
-        # 发送文件夹信息
-        send_folder_info(sock, folder, log_callback)
-        
-        sock.close()
-        log_callback('发送完成')
-    except Exception as e:
-        log_callback(f'发送错误: {e}')
+        sock.settimeout(None)
+        log_func('Connected to receiver %s:%d', host, port)
+        try:
+            handle_unidirectional_send(sock, base_dir, log_callback)
+        finally:
+            close_stream_pool(sock)
 
-def run_receive(port, folder, log_callback, bind_host='0.0.0.0'):
-    """接收文件（使用性能配置）"""
-    try:
-        sock = create_socket_with_performance_settings()
-        sock.bind((bind_host, port))
-        sock.listen(1)
-        log_callback(f'监听端口 {port}，等待连接...')
-        
-        conn, addr = sock.accept()
-        log_callback(f'接收到来自 {addr[0]}:{addr[1]} 的连接')
-        
-        # 接收文件夹信息
-        receive_folder_info(conn, folder, log_callback)
-        
-        conn.close()
-        sock.close()
-        log_callback('接收完成')
-    except Exception as e:
-        log_callback(f'接收错误: {e}')
\ No newline at end of file
+
+def run_receive(port, base_dir, log_callback=None, bind='0.0.0.0'):
+    """运行接收方模式：启动监听服务等待发送方连接（使用性能配置）"""
+    log_func = log_callback or logging.info
+    log_func('Listening for sender on %s:%d', bind, port)
+    with create_socket_with_performance_settings() as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((bind, port))
+        s.listen(1)
+        conn, addr = s.accept()
+        log_func('Accepted connection from sender %s:%d', addr[0], addr[1])
+        with conn:
+            try:
+                handle_unidirectional_receive(conn, base_dir, log_callback, listener=s)
+            finally:
+                close_stream_pool(conn)
@@ -0,0 +1,88 @@
+"""并行哈希模块 - 多核计算清单摘要"""
+
+import os
+import logging
+from collections import deque
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+)
+
+# 超过该大小的文件交给专用的大文件工作线程，避免拖慢小文件
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024
+# 每个工作线程允许排队的任务数，限制磁盘队列深度
+QUEUE_DEPTH_PER_WORKER = 2
+
+
+def resolve_worker_count(workers):
+    """0或None表示按CPU核数自动选择"""
+    if not workers or workers < 1:
+        return os.cpu_count() or 1
+    return workers
+
+
+class ParallelHasher:
+    """将文件分派到线程池/进程池并行计算摘要
+
+    小文件与大文件使用两个独立的执行器，各自限制在途任务数，
+    因此磁盘队列深度有上限，大文件也不会占满所有工作线程。
+    """
+
+    def __init__(self, hash_func, workers=None, use_processes=False,
+                 large_file_threshold=LARGE_FILE_THRESHOLD):
+        self.hash_func = hash_func
+        self.workers = resolve_worker_count(workers)
+        self.large_workers = max(1, self.workers // 4)
+        self.use_processes = use_processes
+        self.large_file_threshold = large_file_threshold
+        self.logger = logging.getLogger(__name__)
+
+    def hash_files(self, jobs):
+        """并行计算摘要
+
+        jobs 为 (key, path, size) 序列；按完成顺序产出 (key, digest)，
+        读取失败的文件产出 (key, None)。
+        """
+        if self.workers == 1:
+            for key, path, _ in jobs:
+                yield key, self._hash_one(path)
+            return
+
+        small = deque()
+        large = deque()
+        for job in jobs:
+            (large if job[2] >= self.large_file_threshold else small).append(job)
+
+        executor_cls = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with executor_cls(max_workers=self.workers) as small_pool, \
+                executor_cls(max_workers=self.large_workers) as large_pool:
+            lanes = [
+                (small, small_pool, self.workers * QUEUE_DEPTH_PER_WORKER, set()),
+                (large, large_pool, self.large_workers * QUEUE_DEPTH_PER_WORKER, set()),
+            ]
+            futures = {}
+            while True:
+                for queue, pool, depth, inflight in lanes:
+                    while queue and len(inflight) < depth:
+                        key, path, _ = queue.popleft()
+                        future = pool.submit(self.hash_func, path)
+                        futures[future] = (key, path, inflight)
+                        inflight.add(future)
+                if not futures:
+                    break
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, path, inflight = futures.pop(future)
+                    inflight.discard(future)
+                    try:
+                        digest = future.result()
+                    except OSError as e:
+                        self.logger.warning('Failed to hash %s: %s', path, e)
+                        digest = None
+                    yield key, digest
+
+    def _hash_one(self, path):
+        try:
+            return self.hash_func(path)
+        except OSError as e:
+            self.logger.warning('Failed to hash %s: %s', path, e)
+            return None
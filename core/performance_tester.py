@@ -1,5 +1,6 @@
 """性能测试模块"""
 
+import os
 import time
 import threading
 import statistics
@@ -53,6 +54,251 @@ class PerformanceTester:
         
         return avg_speed, std_dev
     
+    @staticmethod
+    def create_synthetic_tree(root, file_count=1000000, files_per_dir=1000, dirs_per_level=32):
+        """创建包含大量小文件的合成目录树（已存在则复用）"""
+        root = Path(root)
+        marker = root / f'.synthetic_{file_count}'
+        if marker.exists():
+            return root
+        dir_count = (file_count + files_per_dir - 1) // files_per_dir
+        created = 0
+        for d in range(dir_count):
+            sub = root / f'd{d // dirs_per_level:04d}' / f'd{d % dirs_per_level:02d}'
+            sub.mkdir(parents=True, exist_ok=True)
+            for i in range(min(files_per_dir, file_count - created)):
+                with open(sub / f'f{i:04d}', 'wb') as f:
+                    f.write(b'x')
+                created += 1
+        marker.touch()
+        return root
+
+    def test_walk_speed(self, root, file_count=1000000, walk_workers=(1, 8)):
+        """比较 os.walk + Path.stat 与 scandir 遍历器的速度
+
+        walk_workers 大于1只对高延迟的存储（网络盘、机械盘）有帮助；在本地 SSD 或页缓存
+        中的目录树上，线程池的调度开销通常使多线程遍历比单线程慢。
+        """
+        from core.walker import walk_tree
+        self.create_synthetic_tree(root, file_count)
+        # 合成目录树的标记文件不计入文件数
+        is_marker = lambda rel: rel.startswith('.synthetic_')
+
+        def legacy_walk():
+            base_dir = Path(root)
+            count = 0
+            for dirpath, dirs, files in os.walk(base_dir):
+                for fname in files:
+                    fpath = Path(dirpath) / fname
+                    rel = str(fpath.relative_to(base_dir)).replace('\\', '/')
+                    fpath.stat()
+                    if not is_marker(rel):
+                        count += 1
+            return count
+
+        timings = {}
+        start_time = time.time()
+        count = legacy_walk()
+        timings['os.walk + Path.stat'] = time.time() - start_time
+
+        for workers in walk_workers:
+            start_time = time.time()
+            scanned = sum(1 for rel, _, _ in walk_tree(root, workers=workers) if not is_marker(rel))
+            timings[f'scandir (workers={workers})'] = time.time() - start_time
+            if scanned != count:
+                raise RuntimeError(f"遍历结果不一致: {scanned} != {count}")
+
+        self.results['walk_speed'] = {'file_count': count, 'timings': timings}
+        return timings
+
+    def test_receive_cpu(self, total_mb=1024, chunk_size=1048576):
+        """回环连接上比较逐块拼接（旧 recvn）与缓冲读取器接收分块数据的CPU时间"""
+        import socket
+        import struct
+        from core.socket_reader import SocketReader
+
+        def legacy_recvn(sock, n):
+            buf = b''
+            while len(buf) < n:
+                chunk = sock.recv(n - len(buf))
+                if not chunk:
+                    return None
+                buf += chunk
+            return buf
+
+        def legacy_receive(sock, sink):
+            while True:
+                (ln,) = struct.unpack('>I', legacy_recvn(sock, 4))
+                if ln == 0:
+                    return
+                sink.write(legacy_recvn(sock, ln))
+
+        def reader_receive(sock, sink):
+            reader = SocketReader(sock)
+            while True:
+                (ln,) = struct.unpack('>I', reader.read_exact(4))
+                if ln == 0:
+                    return
+                reader.read_into_file(sink, ln)
+
+        payload = os.urandom(chunk_size)
+        chunks = total_mb * 1024 * 1024 // chunk_size
+
+        def send_all(sock):
+            for _ in range(chunks):
+                sock.sendall(struct.pack('>I', chunk_size))
+                sock.sendall(payload)
+            sock.sendall(struct.pack('>I', 0))
+
+        cpu_per_gb = {}
+        for name, receive in (('recvn (bytes +=)', legacy_receive), ('SocketReader (recv_into)', reader_receive)):
+            a, b = socket.socketpair()
+            sender = threading.Thread(target=send_all, args=(a,), daemon=True)
+            with a, b, open(os.devnull, 'wb') as sink:
+                sender.start()
+                start_cpu = time.thread_time()
+                receive(b, sink)
+                cpu = time.thread_time() - start_cpu
+                sender.join()
+            cpu_per_gb[name] = cpu * 1024 / total_mb
+
+        self.results['receive_cpu'] = {'total_mb': total_mb, 'chunk_size': chunk_size, 'cpu_per_gb': cpu_per_gb}
+        return cpu_per_gb
+
+    def test_small_files(self, file_count=20000, file_size=2048):
+        """回环连接上比较小文件逐个发送与批量发送的单向同步速度（文件/秒）"""
+        import socket
+        import shutil
+        import tempfile
+        from core import helpers
+        from core.unidirectional import handle_unidirectional_send, handle_unidirectional_receive
+
+        work = Path(tempfile.mkdtemp(prefix='lan_sync_small_'))
+        try:
+            source = work / 'source'
+            for i in range(file_count):
+                sub = source / f'd{i // 1000:03d}'
+                if i % 1000 == 0:
+                    sub.mkdir(parents=True)
+                with open(sub / f'f{i:06d}', 'wb') as f:
+                    f.write(os.urandom(file_size))
+
+            files_per_second = {}
+            original = helpers.get_performance_config().get('file_batch', True)
+            try:
+                for name, batched in (('逐个发送', False), ('批量发送', True)):
+                    helpers.set_performance_option('file_batch', batched)
+                    target = work / f'target_{int(batched)}'
+                    target.mkdir()
+                    a, b = socket.socketpair()
+                    quiet = lambda *args: None
+                    sender = threading.Thread(target=handle_unidirectional_send, args=(a, source, quiet),
+                                              daemon=True)
+                    with a, b:
+                        start_time = time.time()
+                        sender.start()
+                        handle_unidirectional_receive(b, target, quiet)
+                        duration = time.time() - start_time
+                        sender.join()
+                    files_per_second[name] = file_count / duration
+            finally:
+                helpers.set_performance_option('file_batch', original)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+        self.results['small_files'] = {'file_count': file_count, 'file_size': file_size,
+                                       'files_per_second': files_per_second}
+        return files_per_second
+
+    def test_write_behind(self, total_mb=1024, target_dir=None):
+        """回环连接上比较单线程接收与后台写入接收大文件的速度（MB/s）"""
+        import socket
+        import tempfile
+        from core import helpers
+        from core.file_transfer_optimized import OptimizedFileTransfer
+
+        size = total_mb * 1024 * 1024
+        payload = os.urandom(1024 * 1024)
+
+        def send_all(sock):
+            remaining = size
+            while remaining:
+                n = min(len(payload), remaining)
+                sock.sendall(payload[:n])
+                remaining -= n
+
+        transfer = OptimizedFileTransfer()
+        mb_per_second = {}
+        original = helpers.get_performance_config().get('write_behind_depth', 8)
+        try:
+            for name, depth in (('单线程接收', 0), ('后台写入', original or 8)):
+                helpers.set_performance_option('write_behind_depth', depth)
+                fd, temp_path = tempfile.mkstemp(prefix='lan_sync_recv_', dir=target_dir)
+                os.close(fd)
+                a, b = socket.socketpair()
+                sender = threading.Thread(target=send_all, args=(a,), daemon=True)
+                try:
+                    with a, b:
+                        start_time = time.time()
+                        sender.start()
+                        transfer._receive_single_thread(b, temp_path, size, 1024 * 1024, False)
+                        duration = time.time() - start_time
+                        sender.join()
+                finally:
+                    os.remove(temp_path)
+                mb_per_second[name] = total_mb / duration
+        finally:
+            helpers.set_performance_option('write_behind_depth', original)
+
+        self.results['write_behind'] = {'total_mb': total_mb, 'mb_per_second': mb_per_second}
+        return mb_per_second
+
+    def test_read_ahead(self, total_mb=1024, source_dir=None):
+        """回环连接上比较逐块读取发送与后台预读发送的速度（MB/s），每次前先把文件移出页缓存"""
+        import socket
+        import tempfile
+        from core import helpers
+        from core.socket_reader import SocketReader
+        from core.file_transfer_optimized import OptimizedFileTransfer
+
+        size = total_mb * 1024 * 1024
+        chunk_size = 1024 * 1024
+        fd, path = tempfile.mkstemp(prefix='lan_sync_send_', dir=source_dir)
+        with os.fdopen(fd, 'wb') as f:
+            for _ in range(total_mb):
+                f.write(os.urandom(chunk_size))
+            f.flush()
+            os.fsync(f.fileno())
+
+        def drain(sock):
+            SocketReader(sock).discard(size)
+
+        transfer = OptimizedFileTransfer()
+        mb_per_second = {}
+        original = helpers.get_performance_config().get('read_ahead_depth', 4)
+        try:
+            for name, depth in (('逐块读取', 0), ('后台预读', original or 4)):
+                helpers.set_performance_option('read_ahead_depth', depth)
+                if hasattr(os, 'posix_fadvise'):
+                    fd = os.open(path, os.O_RDONLY)
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                    os.close(fd)
+                a, b = socket.socketpair()
+                receiver = threading.Thread(target=drain, args=(b,), daemon=True)
+                with a, b:
+                    receiver.start()
+                    start_time = time.time()
+                    transfer._send_with_file_io(a, path, size, chunk_size, False)
+                    receiver.join()
+                    duration = time.time() - start_time
+                mb_per_second[name] = total_mb / duration
+        finally:
+            helpers.set_performance_option('read_ahead_depth', original)
+            os.remove(path)
+
+        self.results['read_ahead'] = {'total_mb': total_mb, 'mb_per_second': mb_per_second}
+        return mb_per_second
+
     def generate_report(self):
         """生成性能报告"""
         report = "# LAN Sync 性能优化报告\n\n"
@@ -75,12 +321,109 @@ class PerformanceTester:
             else:
                 report += "**性能评级: 需要优化** 🔧\n"
         
+        if 'walk_speed' in self.results:
+            walk_data = self.results['walk_speed']
+            baseline = walk_data['timings'].get('os.walk + Path.stat')
+            report += f"\n## 目录遍历测试 ({walk_data['file_count']} 个文件)\n"
+            for name, duration in walk_data['timings'].items():
+                report += f"- {name}: {duration:.2f} 秒 ({walk_data['file_count'] / duration:.0f} 文件/秒)"
+                if baseline and name != 'os.walk + Path.stat':
+                    report += f"，加速 {baseline / duration:.2f}x"
+                report += "\n"
+            single = walk_data['timings'].get('scandir (workers=1)')
+            slower = [name for name, duration in walk_data['timings'].items()
+                      if single and name.startswith('scandir') and duration > single]
+            if slower:
+                report += f"- 注意: {', '.join(slower)} 比单线程慢，该存储延迟较低，应保持 walk_workers 为1\n"
+        
+        if 'receive_cpu' in self.results:
+            recv_data = self.results['receive_cpu']
+            baseline = recv_data['cpu_per_gb'].get('recvn (bytes +=)')
+            report += f"\n## 接收CPU测试 ({recv_data['total_mb']} MB, 块大小 {recv_data['chunk_size'] // 1024} KB)\n"
+            for name, cpu in recv_data['cpu_per_gb'].items():
+                report += f"- {name}: {cpu:.3f} CPU秒/GB"
+                if baseline and name != 'recvn (bytes +=)':
+                    report += f"，减少 {(1 - cpu / baseline) * 100:.0f}%"
+                report += "\n"
+        
+        if 'small_files' in self.results:
+            small_data = self.results['small_files']
+            baseline = small_data['files_per_second'].get('逐个发送')
+            report += f"\n## 小文件传输测试 ({small_data['file_count']} 个 {small_data['file_size']} 字节的文件)\n"
+            for name, rate in small_data['files_per_second'].items():
+                report += f"- {name}: {rate:.0f} 文件/秒"
+                if baseline and name != '逐个发送':
+                    report += f"，加速 {rate / baseline:.1f}x"
+                report += "\n"
+        
+        if 'write_behind' in self.results:
+            write_data = self.results['write_behind']
+            baseline = write_data['mb_per_second'].get('单线程接收')
+            report += f"\n## 大文件接收测试 ({write_data['total_mb']} MB)\n"
+            for name, rate in write_data['mb_per_second'].items():
+                report += f"- {name}: {rate:.1f} MB/s"
+                if baseline and name != '单线程接收':
+                    report += f"，加速 {rate / baseline:.2f}x"
+                report += "\n"
+        
+        if 'read_ahead' in self.results:
+            read_data = self.results['read_ahead']
+            baseline = read_data['mb_per_second'].get('逐块读取')
+            report += f"\n## 大文件发送测试 ({read_data['total_mb']} MB)\n"
+            for name, rate in read_data['mb_per_second'].items():
+                report += f"- {name}: {rate:.1f} MB/s"
+                if baseline and name != '逐块读取':
+                    report += f"，加速 {rate / baseline:.2f}x"
+                report += "\n"
+        
+        from core.file_transfer_optimized import get_transfer_stats
+        transfer_stats = get_transfer_stats()
+        if transfer_stats:
+            report += "\n## 发送路径统计\n"
+            for name, stats in sorted(transfer_stats.items()):
+                report += f"- {name}: {stats['files']} 个文件, {stats['bytes'] / (1024 * 1024):.2f} MB\n"
+        
         return report
 
 # 使用示例
 if __name__ == "__main__":
+    import sys
     tester = PerformanceTester()
     
+    # 目录遍历基准: python -m core.performance_tester --walk [目录] [文件数]
+    if len(sys.argv) > 1 and sys.argv[1] == '--walk':
+        walk_root = sys.argv[2] if len(sys.argv) > 2 else 'walk_benchmark_tree'
+        walk_count = int(sys.argv[3]) if len(sys.argv) > 3 else 1000000
+        tester.test_walk_speed(walk_root, walk_count)
+        print(tester.generate_report())
+        sys.exit(0)
+    
+    # 接收CPU基准: python -m core.performance_tester --recv [MB]
+    if len(sys.argv) > 1 and sys.argv[1] == '--recv':
+        tester.test_receive_cpu(int(sys.argv[2]) if len(sys.argv) > 2 else 1024)
+        print(tester.generate_report())
+        sys.exit(0)
+    
+    # 小文件批量传输基准: python -m core.performance_tester --small [文件数]
+    if len(sys.argv) > 1 and sys.argv[1] == '--small':
+        tester.test_small_files(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+        print(tester.generate_report())
+        sys.exit(0)
+    
+    # 大文件后台写入基准: python -m core.performance_tester --write [MB] [目标目录]
+    if len(sys.argv) > 1 and sys.argv[1] == '--write':
+        tester.test_write_behind(int(sys.argv[2]) if len(sys.argv) > 2 else 1024,
+                                 sys.argv[3] if len(sys.argv) > 3 else None)
+        print(tester.generate_report())
+        sys.exit(0)
+    
+    # 大文件发送预读基准: python -m core.performance_tester --send [MB] [源目录]
+    if len(sys.argv) > 1 and sys.argv[1] == '--send':
+        tester.test_read_ahead(int(sys.argv[2]) if len(sys.argv) > 2 else 1024,
+                               sys.argv[3] if len(sys.argv) > 3 else None)
+        print(tester.generate_report())
+        sys.exit(0)
+    
     # 测试一个100MB的文件
     test_file = "test_100mb.bin"
     
@@ -0,0 +1,206 @@
+"""协议握手模块 - 协商双方共同支持的功能和传输参数
+
+握手信息中的 settings 给出本端可用的传输方式（流式/长度前缀）、压缩编码和
+偏好的块大小、套接字缓冲区大小，双方按同一规则选出共同设置，之后文件传输
+按连接上协商的设置进行，不再各自读取配置（配置不一致时数据流不会错位）。
+"""
+
+import os
+import socket
+import threading
+import weakref
+
+from .helpers import (
+    should_use_lazy_hashing, should_stream_manifest, should_use_merkle_tree,
+    should_use_binary_manifest, should_use_sync_journal, should_use_sqlite_manifest,
+    get_multi_stream_count, should_use_delta_transfer, should_use_chunk_dedup,
+    should_batch_small_files, get_want_in_flight, should_resume_transfers, should_hash_transfers, should_use_sparse_transfer, should_use_stream_protocol, get_max_chunk_size,
+    get_socket_buffer_size
+)
+from .digest import supported_digests, negotiate_digest
+from .compression import supported_codecs
+
+# 版本3起握手信息带有传输参数（settings）
+PROTOCOL_VERSION = 3
+SETTINGS_VERSION = 3
+
+# 传输方式：流式协议（文件内容直接跟在头后）或长度前缀分块
+TRANSPORT_STREAM = 'stream'
+TRANSPORT_FRAMED = 'framed'
+
+# 先交换大小/修改时间，再按需请求摘要
+FEATURE_LAZY_HASH = 'lazy_hash'
+# 边扫描边发送清单批次，对端收到即开始请求文件
+FEATURE_STREAM_MANIFEST = 'stream_manifest'
+# 先比较 Merkle 根摘要，只交换摘要不同的子目录
+FEATURE_MERKLE_TREE = 'merkle_tree'
+# 清单以二进制帧发送（排序、前缀压缩路径、原始摘要）
+FEATURE_BINARY_MANIFEST = 'binary_manifest'
+# 按对端记录上次同步的基线，只交换相对基线的变化
+FEATURE_SYNC_JOURNAL = 'sync_journal'
+# 监视模式：初始同步后保持连接，持续推送变化（由命令行启用，不受配置控制）
+FEATURE_WATCH = 'watch'
+# 大文件分块经多条并行数据连接发送（接收方需要 os.pwrite）
+FEATURE_MULTI_STREAM = 'multi_stream'
+# 接收方为已有旧版本的大文件发送块签名，发送方只发送变化部分
+FEATURE_DELTA_TRANSFER = 'delta_transfer'
+# 大文件按内容分块，接收方只请求本地块索引中没有的块
+FEATURE_CHUNK_DEDUP = 'chunk_dedup'
+# 多个小文件打包成一条批量消息发送
+FEATURE_FILE_BATCH = 'file_batch'
+# 需求分块发出并限制未完成的请求数，对端报告无法发送的文件
+FEATURE_WANT_PIPELINE = 'want_pipeline'
+# 接收方为中断过的大文件发送续传请求，发送方只发送剩余部分
+FEATURE_RESUME = 'resume'
+# 文件数据后跟发送方的摘要，接收方替换前校验
+FEATURE_TRANSFER_DIGEST = 'transfer_digest'
+# 稀疏文件只发送数据区段，接收方保留空洞
+FEATURE_SPARSE = 'sparse_files'
+
+
+def local_features():
+    """本端按配置启用的功能"""
+    features = []
+    # SQLite 清单存储走完整交换，不使用需要完整内存清单的功能
+    in_memory = not should_use_sqlite_manifest()
+    if should_use_lazy_hashing():
+        features.append(FEATURE_LAZY_HASH)
+    if should_stream_manifest() and in_memory:
+        features.append(FEATURE_STREAM_MANIFEST)
+    if should_use_merkle_tree() and in_memory:
+        features.append(FEATURE_MERKLE_TREE)
+    if should_use_binary_manifest():
+        features.append(FEATURE_BINARY_MANIFEST)
+    if should_use_sync_journal() and in_memory:
+        features.append(FEATURE_SYNC_JOURNAL)
+    if get_multi_stream_count() > 1 and hasattr(os, 'pwrite'):
+        features.append(FEATURE_MULTI_STREAM)
+    if should_use_delta_transfer():
+        features.append(FEATURE_DELTA_TRANSFER)
+    if should_use_chunk_dedup() and in_memory:
+        features.append(FEATURE_CHUNK_DEDUP)
+    if should_batch_small_files():
+        features.append(FEATURE_FILE_BATCH)
+    if get_want_in_flight() > 0:
+        features.append(FEATURE_WANT_PIPELINE)
+    if should_resume_transfers():
+        features.append(FEATURE_RESUME)
+    if should_hash_transfers():
+        features.append(FEATURE_TRANSFER_DIGEST)
+    if should_use_sparse_transfer():
+        features.append(FEATURE_SPARSE)
+    return features
+
+
+def build_hello(node_id=None, extra_features=(), stream_session=None):
+    """构建握手信息；node_id 标识本端同步目录，供对端查找同步日志
+
+    stream_session 为监听方给出的数据连接令牌，对端凭它建立并行数据连接。
+    """
+    features = local_features()
+    hello = {
+        'version': PROTOCOL_VERSION,
+        'features': features + list(extra_features),
+        'digests': supported_digests(),
+        'settings': local_settings()
+    }
+    if node_id:
+        hello['node_id'] = node_id
+    if FEATURE_MULTI_STREAM in features:
+        hello['streams'] = stream_params(stream_session)
+    return hello
+
+
+def stream_params(session=None):
+    """本端的并行数据连接参数"""
+    params = {'count': get_multi_stream_count()}
+    if session:
+        params['session'] = session
+    return params
+
+
+def negotiate_features(peer_hello):
+    """返回双方都启用的功能；旧版本对端（没有握手信息）返回空集合"""
+    if not peer_hello:
+        return set()
+    return set(local_features()) & set(peer_hello.get('features', []))
+
+
+def negotiate_digest_algorithm(peer_hello):
+    """协商清单摘要算法；旧版本对端回退到 sha256"""
+    return negotiate_digest(peer_hello.get('digests') if peer_hello else None)
+
+
+def local_settings():
+    """本端可用的传输方式、压缩编码和偏好的块大小/缓冲区大小"""
+    transports = [TRANSPORT_FRAMED]
+    if should_use_stream_protocol():
+        transports.insert(0, TRANSPORT_STREAM)
+    return {
+        'transports': transports,
+        'codecs': supported_codecs(),
+        'chunk_size': get_max_chunk_size(),
+        'buffer_size': get_socket_buffer_size()
+    }
+
+
+def negotiate_settings(peer_hello):
+    """按双方的 settings 选出共同设置；对端版本较旧（没有 settings）时返回 None
+
+    规则对双方对称，两端各自计算得到相同结果：双方都可用时使用流式协议，压缩编码
+    取本端列表中第一个对端也支持的，块大小和缓冲区取较大者（接收方按需扩展缓冲区，
+    由较快的一方决定上限）。
+    """
+    peer = (peer_hello or {}).get('settings')
+    if not peer or peer_hello.get('version', 0) < SETTINGS_VERSION:
+        return None
+    local = local_settings()
+    stream = TRANSPORT_STREAM in local['transports'] and TRANSPORT_STREAM in peer.get('transports', [])
+    codec = next((c for c in local['codecs'] if c in peer.get('codecs', [])), None)
+    return {
+        'version': min(PROTOCOL_VERSION, peer_hello['version']),
+        'transport': TRANSPORT_STREAM if stream else TRANSPORT_FRAMED,
+        'codec': codec,
+        'chunk_size': max(local['chunk_size'], peer.get('chunk_size', 0)),
+        'buffer_size': max(local['buffer_size'], peer.get('buffer_size', 0))
+    }
+
+
+_settings = weakref.WeakKeyDictionary()
+_settings_lock = threading.Lock()
+
+
+def apply_settings(sock, settings, log_func=None):
+    """把协商结果关联到连接，并把套接字缓冲区调整到协商的大小"""
+    with _settings_lock:
+        _settings[sock] = settings
+    if settings['buffer_size'] > get_socket_buffer_size():
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, settings['buffer_size'])
+            except OSError:
+                pass
+    if log_func is not None:
+        log_func('Negotiated protocol v%d: %s transport, compression %s, chunk %d, buffer %d',
+                 settings['version'], settings['transport'], settings['codec'] or 'off',
+                 settings['chunk_size'], settings['buffer_size'])
+
+
+def get_settings(sock):
+    """返回连接上协商的设置，没有协商（对端版本较旧）时返回 None"""
+    with _settings_lock:
+        return _settings.get(sock)
+
+
+def uses_stream_protocol(sock):
+    """连接是否使用流式协议；没有协商时按本端配置"""
+    settings = get_settings(sock)
+    if settings is None:
+        return should_use_stream_protocol()
+    return settings['transport'] == TRANSPORT_STREAM
+
+
+def get_chunk_limit(sock):
+    """连接上的最大块大小；没有协商时按本端配置"""
+    settings = get_settings(sock)
+    return settings['chunk_size'] if settings is not None else get_max_chunk_size()
@@ -0,0 +1,139 @@
+"""发送预读模块 - 后台线程提前读出后续的块，发送线程只管发送
+
+逐块读取再发送时，每次读盘（机械硬盘寻道、网络挂载的往返）期间套接字都空闲。
+预读线程按顺序把文件读入固定数量的缓冲区并放入队列，发送线程取出发送后交还
+缓冲区；缓冲区数为 read_ahead_depth，且总大小不超过 read_ahead_memory。
+内存映射发送不经过缓冲区，改为对之后的块调用 madvise(MADV_WILLNEED)。
+
+发送大文件时还会对请求队列中随后的几个文件调用 posix_fadvise(WILLNEED)，
+由内核在后台把它们的开头读入页缓存。
+"""
+
+import os
+import mmap
+import queue
+import threading
+
+from .helpers import get_read_ahead_depth, get_read_ahead_memory, get_read_ahead_files
+
+
+def read_ahead_depth(chunk_size):
+    """按配置和内存上限计算预读的块数，0表示不预读"""
+    depth = get_read_ahead_depth()
+    if depth <= 0:
+        return 0
+    return max(1, min(depth, get_read_ahead_memory() // max(chunk_size, 1)))
+
+
+class ReadAhead:
+    """后台顺序读取文件 f 的块；迭代得到每块数据（memoryview，下次迭代前有效）
+
+    digest 不为 None 时由预读线程用读出的数据更新（与发送并行）。
+    """
+
+    def __init__(self, f, chunk_size, depth, digest=None):
+        self.f = f
+        self.digest = digest
+        self.error = None
+        self._stop = False
+        self._free = queue.Queue()
+        for _ in range(depth):
+            self._free.put(memoryview(bytearray(chunk_size)))
+        self._filled = queue.Queue()
+        self._thread = threading.Thread(target=self._read_loop, name='read-ahead', daemon=True)
+        self._thread.start()
+
+    def _read_loop(self):
+        try:
+            while not self._stop:
+                buf = self._free.get()
+                if buf is None:
+                    break
+                n = self.f.readinto(buf)
+                if not n:
+                    break
+                if self.digest is not None:
+                    self.digest.update(buf[:n])
+                self._filled.put((buf, n))
+        except OSError as e:
+            self.error = e
+        finally:
+            self._filled.put(None)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._filled.get()
+                if item is None:
+                    break
+                buf, n = item
+                with buf[:n] as chunk:
+                    yield chunk
+                self._free.put(buf)
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """停止预读线程（发送出错提前结束时也会调用）"""
+        self._stop = True
+        self._free.put(None)
+        self._thread.join()
+
+
+def _read_serially(f, chunk_size, digest):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        if digest is not None:
+            digest.update(chunk)
+        yield chunk
+
+
+def read_chunks(f, file_size, chunk_size, digest=None):
+    """返回文件的块迭代器（带 close 方法）：多于一块且启用预读时由后台线程预读"""
+    depth = read_ahead_depth(chunk_size) if file_size > chunk_size else 0
+    if depth:
+        return ReadAhead(f, chunk_size, depth, digest)
+    return _read_serially(f, chunk_size, digest)
+
+
+def advise_mapped(mm, offset, length):
+    """提示内核预读映射中的一段（平台不支持时忽略）"""
+    if length > 0 and hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+        try:
+            mm.madvise(mmap.MADV_WILLNEED, offset - offset % mmap.PAGESIZE, length + offset % mmap.PAGESIZE)
+        except (OSError, ValueError):
+            pass
+
+
+class FilePrefetcher:
+    """按发送顺序提示内核预读之后的文件开头，每个文件只提示一次"""
+
+    def __init__(self, base_dir, files):
+        self.base_dir = base_dir
+        self.files = files
+        self.count = max(0, get_read_ahead_files()) if hasattr(os, 'posix_fadvise') else 0
+        self.length = get_read_ahead_memory() // max(self.count, 1)
+        self._next = 0
+
+    def before_send(self, index):
+        """发送第 index 个文件前调用，提示随后的 read_ahead_files 个文件"""
+        end = min(index + 1 + self.count, len(self.files))
+        for i in range(max(self._next, index + 1), end):
+            self._advise(os.path.join(self.base_dir, self.files[i]))
+        self._next = max(self._next, end)
+
+    def _advise(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, self.length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,273 @@
+"""断点续传模块 - 连接中断后从已收到的位置继续传输大文件
+
+接收大文件时连接中断，已写入 .tmp 的前缀连同边车文件保存到
+.lan_sync/partial/（不在同步目录中，不会出现在清单里）：边车记录已写入的字节数
+和源文件的大小、修改时间。下次同步请求该文件时，接收方先发送续传请求，带上
+前缀的摘要；发送方确认文件未变化且前缀摘要一致后只发送剩余部分，否则照常
+发送整个文件。
+
+续传请求：{'type': 'resume', 'path', 'offset', 'size', 'mtime_ns', 'digest'}。
+续传文件头带 'resume' 字段（起始偏移），后跟从该偏移到文件末尾的原始数据；启用传输
+摘要时随后的摘要覆盖整个文件，接收方替换前连同已有的前缀一起校验。
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import weakref
+from pathlib import Path
+
+from .helpers import (
+    SYNC_META_DIR, send_json, apply_file_mtime, get_resume_min_bytes, get_multi_stream_threshold
+)
+from .socket_reader import get_reader
+from .multi_stream import get_stream_pool, IncompleteTransfer
+from .transfer_digest import (
+    start_send_digest, hash_received_file, verify_received, discard_digest, record_received
+)
+
+PARTIAL_DIR = 'partial'
+_READ_SIZE = 1024 * 1024
+
+_pending = weakref.WeakKeyDictionary()
+_pending_lock = threading.Lock()
+
+
+def _partial_paths(base_dir, rel):
+    """部分文件和边车的路径（以路径的摘要命名）"""
+    key = hashlib.blake2b(rel.encode('utf-8'), digest_size=16).hexdigest()
+    root = Path(base_dir) / SYNC_META_DIR / PARTIAL_DIR
+    return root / (key + '.part'), root / (key + '.json')
+
+
+def _load_partial(base_dir, rel):
+    """返回 (部分文件路径, 边车内容)，没有可用的部分文件时返回 None"""
+    part, sidecar = _partial_paths(base_dir, rel)
+    try:
+        with open(sidecar, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        size = part.stat().st_size
+    except (OSError, ValueError):
+        return None
+    if info.get('path') != rel or size < info.get('offset', 0):
+        return None
+    return part, info
+
+
+def _write_sidecar(sidecar, info):
+    temp = str(sidecar) + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    os.replace(temp, sidecar)
+
+
+def prefix_digest(path, offset):
+    """文件前 offset 字节的 blake2b 摘要（十六进制）"""
+    digest = hashlib.blake2b(digest_size=32)
+    remaining = offset
+    with open(path, 'rb') as f:
+        while remaining:
+            block = f.read(min(remaining, _READ_SIZE))
+            if not block:
+                raise OSError('File is shorter than the resume offset: %s' % path)
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+# 接收方
+
+def save_partial(base_dir, header, temp_path, offset=None):
+    """传输中断后保存 .tmp 中已写入的前缀；太短或无法保存时删除 .tmp
+
+    offset 为可信的前缀长度（默认为 .tmp 的大小），之后的内容被截掉。
+    """
+    rel = header['path']
+    try:
+        size = os.path.getsize(temp_path)
+    except OSError:
+        return
+    offset = size if offset is None else min(offset, size)
+    try:
+        if offset < get_resume_min_bytes() or offset >= header['size']:
+            os.remove(temp_path)
+            return
+        if offset < size:
+            os.truncate(temp_path, offset)
+        part, sidecar = _partial_paths(base_dir, rel)
+        part.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(temp_path, part)
+        _write_sidecar(sidecar, {'path': rel, 'offset': offset, 'size': header['size'],
+                                 'mtime_ns': header.get('mtime_ns')})
+    except OSError as e:
+        logging.getLogger(__name__).warning('Cannot keep partial file %s: %s', rel, e)
+        return
+    logging.getLogger(__name__).info('Kept %d of %d bytes of %s for resuming', offset, header['size'], rel)
+
+
+def discard_partial(base_dir, rel):
+    """删除路径的部分文件和边车（如有）"""
+    for path in _partial_paths(base_dir, rel):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def send_resume_requests(sock, base_dir, files, metas, log_func):
+    """为有部分文件的需求文件发送续传请求，返回发送的请求数
+
+    metas 为 {路径: 对端条目}；部分文件与对端当前版本不符时删除。
+    """
+    sent = 0
+    # 没有任何部分文件时（通常情况）不必逐个文件查找
+    try:
+        with os.scandir(Path(base_dir) / SYNC_META_DIR / PARTIAL_DIR) as entries:
+            if not any(entries):
+                return 0
+    except OSError:
+        return 0
+    for rel in files:
+        loaded = _load_partial(base_dir, rel)
+        if loaded is None:
+            continue
+        part, info = loaded
+        meta = metas.get(rel)
+        if meta is not None and (meta.get('size') != info['size']
+                                 or info.get('mtime_ns') is None
+                                 or meta.get('mtime') != info['mtime_ns'] // 1000000000):
+            # 对端文件已经变化，前缀不再可用
+            discard_partial(base_dir, rel)
+            continue
+        try:
+            digest = prefix_digest(part, info['offset'])
+        except OSError as e:
+            log_func('Cannot read partial file of %s: %s', rel, e)
+            discard_partial(base_dir, rel)
+            continue
+        send_json(sock, {'type': 'resume', 'path': rel, 'offset': info['offset'], 'size': info['size'],
+                         'mtime_ns': info['mtime_ns'], 'digest': digest})
+        sent += 1
+    if sent:
+        log_func('Requested resuming %d partially received files', sent)
+    return sent
+
+
+def receive_file_resumed(sock, base_dir, header):
+    """把剩余部分追加到部分文件后替换，返回是否成功"""
+    logger = logging.getLogger(__name__)
+    reader = get_reader(sock)
+    rel = header['path']
+    offset = header['resume']
+    remaining = header['size'] - offset
+    # 剩余部分较大时经并行数据连接到达
+    pool = get_stream_pool(sock) if 'stream_id' in header else None
+    if 'stream_id' in header and pool is None:
+        raise ConnectionError('Peer sent a multi-stream file without data connections')
+    rel_path = Path(rel)
+    loaded = None
+    if rel_path.is_absolute() or '..' in rel_path.parts:
+        logger.error('Rejected unsafe path from peer: %s', rel)
+    else:
+        loaded = _load_partial(base_dir, rel)
+        if loaded is not None and loaded[1]['offset'] != offset:
+            loaded = None
+        if loaded is None:
+            logger.error('No partial file to resume %s from offset %d', rel, offset)
+    if loaded is None:
+        if pool is not None:
+            pool.receive_file(header, None, offset)
+        elif not reader.discard(remaining):
+            raise ConnectionError('Unexpected EOF during resumed transfer')
+        discard_digest(sock, header)
+        return False
+
+    part, info = loaded
+    try:
+        if pool is not None:
+            pool.receive_file(header, str(part), offset)
+            digest = hash_received_file(header, part)
+        else:
+            # 摘要覆盖整个文件：先读一遍已有的前缀，再用收到的数据继续计算
+            digest = hash_received_file(header, part, offset)
+            with open(part, 'r+b') as f:
+                f.truncate(offset)
+                f.seek(offset)
+                reader.read_into_file(f, remaining, digest)
+        verified = verify_received(sock, header, str(part), digest)
+    except OSError as e:
+        # 再次中断：记录新的位置，下次从这里继续
+        info['offset'] = e.prefix if isinstance(e, IncompleteTransfer) else os.path.getsize(part)
+        os.truncate(part, info['offset'])
+        _write_sidecar(_partial_paths(base_dir, rel)[1], info)
+        raise
+    if not verified:
+        # 前缀或剩余部分与源文件不一致，下次重新传输整个文件
+        discard_partial(base_dir, rel)
+        return False
+    out_path = Path(base_dir) / rel_path
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(part, out_path)
+    discard_partial(base_dir, rel)
+    apply_file_mtime(out_path, header)
+    record_received(base_dir, out_path, header, digest)
+    logger.info('Resumed file: %s (%d bytes already present, %d bytes received)', rel, offset, remaining)
+    return True
+
+
+# 发送方
+
+def receive_resume_request(sock, msg):
+    """保存对端的续传请求，发送该文件时使用"""
+    with _pending_lock:
+        _pending.setdefault(sock, {})[msg['path']] = msg
+
+
+def take_resume_offset(sock, base_dir, relpath):
+    """取出文件的续传请求并核对，可以续传时返回起始偏移，否则返回0"""
+    with _pending_lock:
+        request = _pending.get(sock, {}).pop(relpath, None)
+    if request is None:
+        return 0
+    path = Path(base_dir) / relpath
+    try:
+        st = path.stat()
+        offset = request['offset']
+        if (st.st_size != request['size'] or st.st_mtime_ns != request['mtime_ns']
+                or not 0 < offset < st.st_size):
+            return 0
+        if prefix_digest(path, offset) != request['digest']:
+            logging.getLogger(__name__).warning('Partial file of %s does not match, sending it again', relpath)
+            return 0
+    except OSError:
+        return 0
+    return offset
+
+
+def send_file_resumed(sock, base_dir, relpath, offset):
+    """发送续传文件头和从 offset 开始的剩余数据，返回发送的字节数"""
+    path = Path(base_dir) / relpath
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        header = {'type': 'file', 'path': relpath, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                  'resume': offset}
+        # 摘要覆盖整个文件，由后台线程读取文件计算（与发送并行）
+        digest = start_send_digest(sock, base_dir, path, st, header)
+        if digest is not None:
+            digest.hash_file()
+        pool = get_stream_pool(sock)
+        if pool is not None and st.st_size - offset >= get_multi_stream_threshold():
+            pool.send_file(sock, header, path, offset)
+            if digest is not None:
+                digest.finish(sock)
+            return st.st_size - offset
+        send_json(sock, header)
+        # 平台不支持 os.sendfile 时 socket.sendfile 自动回退为读取+发送
+        sent = sock.sendfile(f, offset, st.st_size - offset)
+        if sent != st.st_size - offset:
+            raise ConnectionError('File changed while sending: %s' % relpath)
+    if digest is not None:
+        digest.finish(sock)
+    return st.st_size - offset
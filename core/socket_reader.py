@@ -0,0 +1,136 @@
+"""带缓冲的套接字读取模块 - 用 recv_into 直接读入预分配的缓冲区
+
+同一个套接字上的所有接收都必须经过同一个读取器：读取器会多读入后续消息的
+数据，绕过它直接调用 sock.recv 会丢失这些数据。get_reader 为每个套接字
+返回唯一的读取器。
+"""
+
+import threading
+import weakref
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+_readers = weakref.WeakKeyDictionary()
+_readers_lock = threading.Lock()
+
+
+def get_reader(sock, buffer_size=DEFAULT_BUFFER_SIZE):
+    """返回套接字的读取器，首次调用时创建（之后 buffer_size 不再生效）"""
+    with _readers_lock:
+        reader = _readers.get(sock)
+        if reader is None:
+            reader = SocketReader(sock, buffer_size)
+            _readers[sock] = reader
+        return reader
+
+
+class SocketReader:
+    """套接字的缓冲读取器
+
+    小消息（消息头、JSON）从缓冲区中切出，一次 recv_into 可以读入多条消息；
+    大块数据直接读入调用方的缓冲区或经缓冲区写入文件，不为每块分配新对象。
+    """
+
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sock = sock
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    @property
+    def buffered(self):
+        """缓冲区中尚未读取的字节数"""
+        return self._end - self._start
+
+    def _fill(self):
+        """至少读入一些数据，连接关闭时返回 False"""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            # 剩余数据移到开头，腾出空间
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+        n = self.sock.recv_into(self._view[self._end:])
+        if not n:
+            return False
+        self._end += n
+        return True
+
+    def _take(self, out, pos, n):
+        """从缓冲区复制最多 n 字节到 out[pos:]，返回复制的字节数"""
+        k = min(n, self._end - self._start)
+        if k:
+            out[pos:pos + k] = self._view[self._start:self._start + k]
+            self._start += k
+        return k
+
+    def read_into(self, out):
+        """把 out（可写缓冲区）读满，连接提前关闭时返回 False"""
+        out = memoryview(out).cast('B')
+        n = len(out)
+        pos = self._take(out, 0, n)
+        while pos < n:
+            if n - pos >= len(self._buf):
+                # 大块数据直接读入目标，不经过缓冲区
+                k = self.sock.recv_into(out[pos:])
+                if not k:
+                    return False
+                pos += k
+            else:
+                if not self._fill():
+                    return False
+                pos += self._take(out, pos, n - pos)
+        return True
+
+    def read_exact(self, n):
+        """读取恰好 n 字节，连接提前关闭时返回 None
+
+        数据已在缓冲区中时返回 bytes；否则返回新分配的 bytearray，不再额外复制。
+        """
+        if self._end - self._start >= n:
+            data = bytes(self._view[self._start:self._start + n])
+            self._start += n
+            return data
+        out = bytearray(n)
+        if not self.read_into(out):
+            return None
+        return out
+
+    def peek(self, n):
+        """返回接下来的最多 n 字节而不消耗（连接关闭时可能少于 n）"""
+        n = min(n, len(self._buf))
+        while self._end - self._start < n:
+            if not self._fill():
+                break
+        return bytes(self._view[self._start:min(self._start + n, self._end)])
+
+    def read_into_file(self, f, n, digest=None):
+        """把接下来的 n 字节写入文件对象 f，连接提前关闭时抛出 ConnectionError
+
+        digest 为哈希对象时同时用写入的数据更新它。
+        """
+        remaining = n
+        while remaining:
+            if self._start == self._end and not self._fill():
+                raise ConnectionError('Unexpected EOF during file transfer')
+            k = min(remaining, self._end - self._start)
+            data = self._view[self._start:self._start + k]
+            if digest is not None:
+                digest.update(data)
+            f.write(data)
+            self._start += k
+            remaining -= k
+        return n
+
+    def discard(self, n):
+        """丢弃接下来的 n 字节，连接提前关闭时返回 False"""
+        remaining = n
+        while remaining:
+            if self._start == self._end and not self._fill():
+                return False
+            k = min(remaining, self._end - self._start)
+            self._start += k
+            remaining -= k
+        return True
@@ -0,0 +1,182 @@
+"""稀疏文件传输模块 - 只发送数据区段，接收方按偏移写入并保留空洞
+
+虚拟机磁盘镜像、数据库文件大部分是空洞，普通传输会把空洞当作零字节全部发送，
+接收方再把它们写成真实的磁盘块。发送方用 os.lseek(SEEK_DATA/SEEK_HOLE) 枚举
+数据区段，只发送区段描述和数据；接收方先把 .tmp 截断到文件大小（整个文件都是
+空洞），再把各区段写到对应偏移。
+
+文件头带 'sparse': True，后跟若干区段帧（8字节偏移 + 8字节长度 + 数据），以长度为0
+的帧结束。区段按偏移递增发送。启用传输摘要时随后跟整个文件（空洞按零字节计算）的
+摘要，接收方按区段顺序计算，空洞部分补算零字节。
+"""
+
+import os
+import errno
+import struct
+import logging
+import threading
+import weakref
+from pathlib import Path
+
+from .helpers import send_json, apply_file_mtime, get_sparse_threshold
+from .socket_reader import get_reader
+from .resume import save_partial
+from .transfer_digest import (
+    start_send_digest, start_receive_digest, verify_received, discard_digest, record_received
+)
+
+EXTENT_FRAME = struct.Struct('>QQ')
+# 平台支持按数据区段定位时才能枚举空洞（Linux、较新的 macOS/FreeBSD）
+SEEK_DATA_AVAILABLE = hasattr(os, 'SEEK_DATA') and hasattr(os, 'SEEK_HOLE')
+_ZEROS = memoryview(bytes(1024 * 1024))
+
+_enabled = weakref.WeakKeyDictionary()
+_enabled_lock = threading.Lock()
+
+
+def enable_sparse_transfer(sock):
+    """双方都支持稀疏传输时调用，之后该连接上的稀疏文件只发送数据区段"""
+    with _enabled_lock:
+        _enabled[sock] = True
+
+
+def is_sparse(st):
+    """按 stat 结果判断文件是否有空洞（占用的块少于大小）"""
+    blocks = getattr(st, 'st_blocks', None)
+    return blocks is not None and st.st_size >= get_sparse_threshold() and blocks * 512 < st.st_size
+
+
+def should_send_sparse(sock, path):
+    """连接启用了稀疏传输、平台能枚举空洞且文件有空洞时返回 True"""
+    if not SEEK_DATA_AVAILABLE:
+        return False
+    with _enabled_lock:
+        if not _enabled.get(sock):
+            return False
+    try:
+        return is_sparse(os.stat(path))
+    except OSError:
+        return False
+
+
+def data_extents(fd, size):
+    """产出文件的数据区段 (偏移, 长度)"""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # 之后全是空洞
+                return
+            raise
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+# 发送方
+
+def send_file_sparse(sock, base_dir, relpath):
+    """发送稀疏文件的数据区段，返回 (文件大小, 发送的数据字节数)"""
+    path = Path(base_dir) / relpath
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        header = {'type': 'file', 'path': relpath, 'size': st.st_size,
+                  'mtime_ns': st.st_mtime_ns, 'sparse': True}
+        digest = start_send_digest(sock, base_dir, path, st, header)
+        if digest is not None:
+            # 区段数据不经过用户空间：后台线程读取整个文件计算摘要（读取空洞不访问磁盘）
+            digest.hash_file()
+        send_json(sock, header)
+        sent = 0
+        for offset, length in data_extents(f.fileno(), st.st_size):
+            sock.sendall(EXTENT_FRAME.pack(offset, length))
+            # 平台不支持 os.sendfile 时 socket.sendfile 自动回退为读取+发送
+            if sock.sendfile(f, offset, length) != length:
+                raise ConnectionError('File changed while sending: %s' % relpath)
+            sent += length
+        sock.sendall(EXTENT_FRAME.pack(0, 0))
+    if digest is not None:
+        digest.finish(sock)
+    return st.st_size, sent
+
+
+def _update_zeros(digest, length):
+    """用 length 个零字节（空洞）更新摘要"""
+    while length > 0:
+        count = min(length, len(_ZEROS))
+        digest.update(_ZEROS[:count])
+        length -= count
+
+
+# 接收方
+
+def receive_file_sparse(sock, base_dir, header):
+    """把数据区段写入按文件大小截断的 .tmp 后替换，返回收到的数据字节数"""
+    logger = logging.getLogger(__name__)
+    reader = get_reader(sock)
+    rel = header['path']
+    size = header['size']
+    rel_path = Path(rel)
+    f = None
+    if rel_path.is_absolute() or '..' in rel_path.parts:
+        logger.error('Rejected unsafe path from peer: %s', rel)
+    else:
+        out_path = Path(base_dir) / rel_path
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = str(out_path) + '.tmp'
+        f = open(temp_path, 'wb')
+
+    digest = start_receive_digest(header) if f is not None else None
+    received = 0
+    # 已完整写入的区段之前的内容（包括空洞）都与源文件一致，中断时可作为续传前缀
+    prefix = 0
+    try:
+        if f is not None:
+            f.truncate(size)
+        while True:
+            frame = reader.read_exact(EXTENT_FRAME.size)
+            if not frame:
+                raise ConnectionError('Unexpected EOF during sparse file transfer')
+            offset, length = EXTENT_FRAME.unpack(frame)
+            if length == 0:
+                break
+            if offset < prefix or offset + length > size:
+                raise ValueError('Invalid sparse extent from peer: %d+%d' % (offset, length))
+            if f is None:
+                if not reader.discard(length):
+                    raise ConnectionError('Unexpected EOF during sparse file transfer')
+            else:
+                if digest is not None:
+                    _update_zeros(digest, offset - prefix)
+                f.seek(offset)
+                reader.read_into_file(f, length, digest)
+            received += length
+            prefix = offset + length
+        if f is None:
+            discard_digest(sock, header)
+        else:
+            if digest is not None:
+                _update_zeros(digest, size - prefix)
+            f.close()
+            verified = verify_received(sock, header, temp_path, digest)
+    except OSError:
+        if f is not None:
+            f.close()
+            save_partial(base_dir, header, temp_path, prefix)
+        raise
+    except ValueError:
+        if f is not None:
+            f.close()
+            os.remove(temp_path)
+        raise
+    if f is None or not verified:
+        return received
+    os.replace(temp_path, out_path)
+    apply_file_mtime(out_path, header)
+    record_received(base_dir, out_path, header, digest)
+    logger.info('Sparse received file: %s (%d bytes, %d bytes of data)', rel, size, received)
+    return received
@@ -0,0 +1,355 @@
+"""流式同步模块 - 边扫描边交换清单批次，收到即比较并请求文件"""
+
+import threading
+from collections import deque
+from pathlib import Path
+
+from .helpers import (
+    send_json, recv_json, iter_manifest_batches, fill_digests, stat_entry,
+    get_manifest_batch_size, should_compress_manifest
+)
+from .manifest_diff import is_newer, build_digest_reply, merge_digests
+from .manifest_codec import send_manifest_message, recv_manifest_entries
+from .file_transfer import receive_file
+from .file_batch import send_files, receive_file_batch, MAX_BATCH_FILES
+from .delta_transfer import send_signatures, receive_signatures
+from .chunk_store import (
+    dedup_candidates, send_chunk_lists, receive_chunk_list, send_chunk_haves, receive_chunk_haves
+)
+from .want_scheduler import WantScheduler
+from .resume import send_resume_requests, receive_resume_request
+
+
+class StreamingSync:
+    """流式清单同步会话
+
+    主线程遍历目录并发送清单批次；接收线程读取所有消息，逐批与本地文件比较后
+    立即发出需求；发送线程负责控制消息和对端请求的文件。接收线程从不直接写
+    套接字，因此双方同时发送大文件时也不会互相阻塞。
+
+    消息：manifest_batch / manifest_end、digest_request / digests、
+    chunk_request / chunk_list / chunk_have、resume、want（more为True表示还有后续）、
+    file、file_batch、unavailable、done_sending。
+    需求文件先进入调度队列，由发送线程按策略排序并在未完成数允许时分块发出。
+    """
+
+    def __init__(self, sock, base_dir, algorithm, lazy, log_func, binary=False, keep_manifest=False,
+                 delta=False, dedup=False, batched=False, pipelined=False, resume=False):
+        self.sock = sock
+        self.base_dir = Path(base_dir)
+        self.algorithm = algorithm
+        self.lazy = lazy
+        self.binary = binary
+        # delta为True时在需求之前为本地已有的大文件发送块签名
+        self.delta = delta
+        # dedup为True时大文件先请求块列表，只请求本地没有的块
+        self.dedup = dedup
+        # batched为True时连续请求的小文件打包成批量消息发送
+        self.batched = batched
+        # pipelined为True时需求分块发出，并向对端报告无法发送的文件
+        self.pipelined = pipelined
+        # resume为True时在需求之前为中断过的文件发送续传请求
+        self.resume = resume
+        # keep_manifest为True时保留已发送的本地清单和收到的文件（供同步日志记录）
+        self.manifest = {} if keep_manifest else None
+        self.received = []
+        self.log_func = log_func
+
+        self.incoming_done = threading.Event()
+        self.outgoing_done = threading.Event()
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._control = deque()
+        self._scheduler = WantScheduler(pipelined)
+        self._serve = deque()
+        self._peer_wants_done = False
+        self._closed = False
+
+        # 等待摘要后才能判断的对端条目
+        self._pending_digests = {}
+        # 等待块列表后才请求的文件及其对端条目
+        self._pending_chunks = {}
+        self._peer_listing_done = False
+        self._wants_finished = False
+        self._wanted = 0
+        self._peer_finished = False
+        self._sent_all = False
+
+    def run(self):
+        """执行同步，直到双方都发送完毕"""
+        self._start_threads()
+        self._stream_local_manifest()
+        self.incoming_done.wait()
+        self.outgoing_done.wait()
+        self._close()
+        self.log_func('Requested %d files from peer', self._wanted)
+
+    def _start_threads(self):
+        for target in (self._receiver, self._writer):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _stream_local_manifest(self):
+        """边遍历边发送本地清单批次"""
+        sent = 0
+        try:
+            batches = iter_manifest_batches(
+                self.base_dir, get_manifest_batch_size(),
+                with_digests=not self.lazy, algorithm=self.algorithm)
+            for batch in batches:
+                self._send_batch(batch)
+                sent += len(batch)
+                if self.manifest is not None:
+                    self.manifest.update(batch)
+            self._send({'type': 'manifest_end', 'count': sent})
+            self.log_func('Streamed local manifest with %d files', sent)
+        except Exception as e:
+            self.log_func('Manifest streaming error: %s', e)
+            self._close()
+
+    def _send_batch(self, batch):
+        with self._send_lock:
+            send_manifest_message(
+                self.sock, {'type': 'manifest_batch', 'algorithm': self.algorithm},
+                'entries', batch, self.algorithm, self.binary, should_compress_manifest())
+
+    @property
+    def completed(self):
+        """双方都正常发送完毕（而非出错结束）"""
+        return self._peer_finished and self._sent_all
+
+    def _send(self, msg):
+        with self._send_lock:
+            send_json(self.sock, msg)
+
+    def _enqueue_control(self, msg):
+        with self._cond:
+            self._control.append(msg)
+            self._cond.notify()
+
+    def _close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.incoming_done.set()
+        self.outgoing_done.set()
+
+    def _writer(self):
+        """发送控制消息、需求和对端请求的文件"""
+        try:
+            while True:
+                with self._cond:
+                    while not (self._closed or self._control or self._scheduler.ready() or self._serve
+                               or (self._peer_wants_done and not self.outgoing_done.is_set())):
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    if self._control:
+                        kind, item = 'control', self._control.popleft()
+                    elif self._scheduler.ready():
+                        kind, item = 'control', self._scheduler.next_want()
+                    elif self._serve:
+                        count = min(len(self._serve), MAX_BATCH_FILES) if self.batched else 1
+                        kind, item = 'files', [self._serve.popleft() for _ in range(count)]
+                    else:
+                        kind, item = 'done', None
+
+                if kind == 'control' and item.get('type') == 'signatures':
+                    # 本地请求：在对应的需求之前计算并发送签名
+                    with self._send_lock:
+                        send_signatures(self.sock, self.base_dir, item['files'], self.log_func)
+                elif kind == 'control' and item.get('type') == 'resume_requests':
+                    # 本地请求：核对部分文件并在对应的需求之前发送续传请求
+                    with self._send_lock:
+                        send_resume_requests(self.sock, self.base_dir, list(item['files']), item['files'],
+                                             self.log_func)
+                elif kind == 'control' and item.get('type') == 'chunk_lists':
+                    # 本地请求：为对端请求的路径计算并发送块列表
+                    with self._send_lock:
+                        send_chunk_lists(self.sock, self.base_dir, item['paths'], self.log_func)
+                elif kind == 'control' and item.get('type') == 'chunk_have':
+                    # 本地请求：查询块索引，在对应的需求之前告诉对端已有的块
+                    with self._send_lock:
+                        send_chunk_haves(self.sock, self.base_dir, item['path'], item['chunks'],
+                                         self.log_func)
+                elif kind == 'control':
+                    self._send(item)
+                elif kind == 'files':
+                    with self._send_lock:
+                        _, failed = send_files(self.sock, self.base_dir, item, self.log_func, self.batched,
+                                               self.manifest)
+                        if failed and self.pipelined:
+                            send_json(self.sock, {'type': 'unavailable', 'files': failed})
+                else:
+                    self._send({'type': 'done_sending'})
+                    self._sent_all = True
+                    self.outgoing_done.set()
+        except Exception as e:
+            self.log_func('Sender error: %s', e)
+            self._close()
+
+    def _receiver(self):
+        """读取并分发对端消息"""
+        try:
+            while True:
+                m = recv_json(self.sock)
+                if m is None:
+                    self.log_func('Connection closed by peer')
+                    break
+                t = m.get('type')
+                if t == 'manifest_batch':
+                    self._on_manifest_batch(m)
+                elif t == 'manifest_end':
+                    self.log_func('Peer manifest complete (%d files)', m.get('count', 0))
+                    self._peer_listing_done = True
+                    self._maybe_finish_wants()
+                elif t == 'digest_request':
+                    self._on_digest_request(m)
+                elif t == 'digests':
+                    self._on_digests(m)
+                elif t == 'want':
+                    self._on_want(m)
+                elif t == 'signatures':
+                    receive_signatures(self.sock, m)
+                elif t == 'resume':
+                    receive_resume_request(self.sock, m)
+                elif t == 'chunk_request':
+                    self._enqueue_control({'type': 'chunk_lists', 'paths': m.get('paths', [])})
+                elif t == 'chunk_list':
+                    self._on_chunk_list(m)
+                elif t == 'chunk_have':
+                    receive_chunk_haves(self.sock, m)
+                elif t == 'file':
+                    receive_file(self.sock, self.base_dir, m)
+                    self.received.append(m['path'])
+                    self.log_func('Received file from peer: %s', m['path'])
+                    self._completed(1)
+                elif t == 'file_batch':
+                    paths = receive_file_batch(self.sock, self.base_dir, m)
+                    self.received.extend(paths)
+                    self.log_func('Received batch of %d files from peer', len(paths))
+                    self._completed(len(m['files']))
+                elif t == 'unavailable':
+                    self.log_func('Peer could not send %d requested files', len(m.get('files', [])))
+                    self._completed(len(m.get('files', [])))
+                elif t == 'done_sending':
+                    self.log_func('Peer finished sending requested files')
+                    self._peer_finished = True
+                    self.incoming_done.set()
+                else:
+                    self.log_func('Unknown message type: %s', t)
+        except Exception as e:
+            if not self._closed:
+                self.log_func('Receiver error: %s', e)
+        finally:
+            self._close()
+
+    def _on_manifest_batch(self, m):
+        """逐条与本地文件比较，能直接判断的立即请求，其余先请求摘要"""
+        peer_algorithm = m.get('algorithm', self.algorithm)
+        entries = recv_manifest_entries(self.sock, m, 'entries')
+        want = {}
+        ambiguous = []
+        for rel, meta in entries.items():
+            mine = stat_entry(self.base_dir, rel)
+            if mine is None:
+                want[rel] = meta
+                continue
+            if meta['mtime'] <= mine['mtime']:
+                # 本地版本不比对端旧
+                continue
+            if meta['size'] != mine['size']:
+                want[rel] = meta
+                continue
+            if peer_algorithm == self.algorithm and self.algorithm in meta:
+                # 对端已附带摘要，只需计算本地摘要
+                fill_digests(self.base_dir, {rel: mine}, [rel], self.algorithm)
+                if is_newer(meta, mine, self.algorithm):
+                    want[rel] = meta
+                continue
+            self._pending_digests[rel] = (meta, mine)
+            ambiguous.append(rel)
+        if ambiguous:
+            self._enqueue_control({'type': 'digest_request', 'algorithm': self.algorithm,
+                                   'paths': ambiguous})
+        self._request(self._defer_chunked(want))
+
+    def _defer_chunked(self, want):
+        """大文件先请求块列表，收到后再请求；want 为 {路径: 对端条目}，返回其余可直接请求的文件"""
+        if not self.dedup or not want:
+            return want
+        chunked = set(dedup_candidates(self.base_dir, {rel: meta['size'] for rel, meta in want.items()},
+                                       self.delta))
+        if not chunked:
+            return want
+        self._pending_chunks.update((rel, want[rel]) for rel in chunked)
+        self._enqueue_control({'type': 'chunk_request', 'paths': sorted(chunked)})
+        return {rel: meta for rel, meta in want.items() if rel not in chunked}
+
+    def _on_chunk_list(self, m):
+        chunks = receive_chunk_list(self.sock, m)
+        rel = m['path']
+        if rel not in self._pending_chunks:
+            return
+        meta = self._pending_chunks.pop(rel)
+        self._enqueue_control({'type': 'chunk_have', 'path': rel, 'chunks': chunks})
+        self._request({rel: meta})
+        self._maybe_finish_wants()
+
+    def _on_digest_request(self, m):
+        paths = m.get('paths', [])
+        local = {}
+        for rel in paths:
+            entry = stat_entry(self.base_dir, rel)
+            if entry is not None:
+                local[rel] = entry
+        self._enqueue_control(build_digest_reply(self.base_dir, local, m))
+
+    def _on_digests(self, m):
+        peers = {rel: self._pending_digests[rel][0] for rel in m.get('digests', {})
+                 if rel in self._pending_digests}
+        merge_digests(peers, m)
+        mine = {rel: self._pending_digests[rel][1] for rel in peers}
+        fill_digests(self.base_dir, mine, list(mine), self.algorithm)
+        want = {}
+        for rel in peers:
+            del self._pending_digests[rel]
+            if is_newer(peers[rel], mine[rel], self.algorithm):
+                want[rel] = peers[rel]
+        self._request(self._defer_chunked(want))
+        self._maybe_finish_wants()
+
+    def _on_want(self, m):
+        files = m.get('files', [])
+        with self._cond:
+            self._serve.extend(files)
+            if not m.get('more'):
+                self._peer_wants_done = True
+            self._cond.notify()
+
+    def _completed(self, count):
+        with self._cond:
+            self._scheduler.completed(count)
+            self._cond.notify()
+
+    def _request(self, want):
+        """把 {路径: 对端条目} 加入需求队列，由发送线程按策略分块发出"""
+        if not want:
+            return
+        self._wanted += len(want)
+        if self.resume:
+            self._enqueue_control({'type': 'resume_requests', 'files': want})
+        if self.delta:
+            # 签名在入队时即排在对应的需求之前
+            self._enqueue_control({'type': 'signatures', 'files': list(want)})
+        with self._cond:
+            self._scheduler.add(want.items())
+            self._cond.notify()
+
+    def _maybe_finish_wants(self):
+        """对端清单结束、所有摘要都已比较且块列表都已收到后，发出最后的需求"""
+        if (self._peer_listing_done and not self._pending_digests and not self._pending_chunks
+                and not self._wants_finished):
+            self._wants_finished = True
+            with self._cond:
+                self._scheduler.finish()
+                self._cond.notify()
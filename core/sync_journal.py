@@ -0,0 +1,108 @@
+"""同步日志模块 - 按对端记录上次成功同步后的清单，下次只交换变化的条目"""
+
+import os
+import json
+import uuid
+import logging
+from pathlib import Path
+
+from .helpers import SYNC_META_DIR, stat_entry
+from .merkle import MerkleTree
+
+NODE_ID_FILE = 'node_id'
+JOURNAL_DIR = 'journal'
+
+
+def local_node_id(base_dir):
+    """同步根目录的唯一标识（首次使用时生成），对端据此区分日志"""
+    path = Path(base_dir) / SYNC_META_DIR / NODE_ID_FILE
+    try:
+        node_id = path.read_text(encoding='ascii').strip()
+        if node_id:
+            return node_id
+    except (OSError, ValueError):
+        pass
+    node_id = uuid.uuid4().hex
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(node_id, encoding='ascii')
+    except OSError as e:
+        logging.getLogger(__name__).warning('Failed to save node id %s: %s', path, e)
+    return node_id
+
+
+def _stat_only(manifest):
+    return {rel: {'size': meta['size'], 'mtime': meta['mtime']} for rel, meta in manifest.items()}
+
+
+def manifest_delta(baseline, manifest):
+    """返回 (新增或变化的条目, 已删除的路径)"""
+    changed = {}
+    for rel, meta in manifest.items():
+        old = baseline.get(rel)
+        if old is None or old['size'] != meta['size'] or old['mtime'] != meta['mtime']:
+            changed[rel] = {'size': meta['size'], 'mtime': meta['mtime']}
+    removed = [rel for rel in baseline if rel not in manifest]
+    return changed, removed
+
+
+def apply_delta(baseline, changed, removed):
+    """在基线上应用对端的变化，得到对端当前清单"""
+    manifest = dict(baseline)
+    for rel in removed:
+        manifest.pop(rel, None)
+    manifest.update(changed)
+    return manifest
+
+
+class SyncJournal:
+    """与某个对端上次成功同步后的本地清单（只含大小和修改时间）
+
+    同步完成后双方目录一致时，两端记录的基线相同；下次会话先比较基线校验和，
+    一致则只发送相对基线的变化，否则回退到完整交换。
+    记录保存在 ``<根目录>/.lan_sync/journal/<对端标识>.json``，先写临时文件再原子替换。
+    """
+
+    def __init__(self, base_dir, peer_id):
+        self.base_dir = Path(base_dir)
+        self.path = self.base_dir / SYNC_META_DIR / JOURNAL_DIR / ('%s.json' % peer_id)
+        self.logger = logging.getLogger(__name__)
+        self.baseline = None
+        self.checksum = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            baseline = data['manifest']
+            checksum = data['checksum']
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning('Ignoring unreadable sync journal %s: %s', self.path, e)
+            return
+        self.baseline = baseline
+        self.checksum = checksum
+
+    def record(self, manifest, received=()):
+        """会话成功后记录基线：本地清单加上本次收到的文件"""
+        baseline = _stat_only(manifest)
+        for rel in received:
+            entry = stat_entry(self.base_dir, rel)
+            if entry is not None:
+                baseline[rel] = entry
+        checksum = MerkleTree(baseline).root_digest
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = str(self.path) + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'checksum': checksum, 'manifest': baseline}, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            self.logger.warning('Failed to save sync journal %s: %s', self.path, e)
+            return
+        self.baseline = baseline
+        self.checksum = checksum
@@ -0,0 +1,208 @@
+"""传输摘要模块 - 发送和接收文件时顺带计算摘要，接收方替换前校验
+
+发送方在发送循环中对读出的数据计算摘要（哈希缓存中已有该文件的清单摘要时
+直接使用，不再计算），接收方对写入 .tmp 的数据计算摘要，两者一致才替换目标
+文件，并把摘要记入本地哈希缓存，下次构建清单时不必再读一遍文件。
+
+文件头带 'digest_algorithm' 字段时，文件数据（长度前缀协议下含结束块）之后跟一条
+{'type': 'file_digest', 'digest': 摘要}。数据不经过用户空间（零拷贝、并行数据连接）
+或不按顺序发送（续传）时，发送方在后台线程另行读取整个文件计算摘要，接收方则在
+写完后读取 .tmp 计算。
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+import weakref
+
+from .helpers import (
+    send_json, recv_json, should_use_hash_cache, should_use_xattr_hash_cache
+)
+from .digest import new_hash, compute_digest
+
+# 哈希缓存两次持久化的最短间隔（秒），避免每个文件都刷一次盘
+SAVE_INTERVAL = 1.0
+_READ_SIZE = 1024 * 1024
+
+_algorithms = weakref.WeakKeyDictionary()
+_algorithms_lock = threading.Lock()
+
+_dirty = {}
+_cache_lock = threading.Lock()
+
+
+def enable_transfer_digest(sock, algorithm):
+    """双方都支持传输摘要时调用，之后该连接上发送的文件都带摘要"""
+    with _algorithms_lock:
+        _algorithms[sock] = algorithm
+
+
+def get_transfer_algorithm(sock):
+    """返回连接上传输摘要所用的算法，未启用时返回 None"""
+    with _algorithms_lock:
+        return _algorithms.get(sock)
+
+
+def _open_cache(base_dir):
+    if not should_use_hash_cache():
+        return None
+    from .hash_cache import get_hash_cache
+    return get_hash_cache(base_dir, use_xattr=should_use_xattr_hash_cache())
+
+
+def _record(base_dir, path, st, digest, algorithm):
+    """把摘要记入哈希缓存，距上次持久化超过 SAVE_INTERVAL 时写盘"""
+    cache = _open_cache(base_dir)
+    if cache is None:
+        return
+    with _cache_lock:
+        cache.store(path, st, digest, algorithm)
+        last = _dirty.setdefault(cache, 0.0)
+        if time.monotonic() - last >= SAVE_INTERVAL:
+            cache.save(evict=False)
+            _dirty[cache] = time.monotonic()
+
+
+@atexit.register
+def flush_transfer_digests():
+    """持久化尚未写盘的传输摘要"""
+    with _cache_lock:
+        for cache in _dirty:
+            cache.save(evict=False)
+        _dirty.clear()
+
+
+# 发送方
+
+class SendDigest:
+    """一个文件的发送摘要：update 接收发出的原始数据，finish 发送摘要消息
+
+    数据不经过 update 时先调用 hash_file，由后台线程读取文件计算摘要。
+    """
+
+    def __init__(self, base_dir, path, st, algorithm):
+        self.base_dir = base_dir
+        self.path = path
+        self.st = st
+        self.algorithm = algorithm
+        cache = _open_cache(base_dir)
+        self.digest = cache.lookup(path, st, algorithm) if cache else None
+        self._hash = new_hash(algorithm) if self.digest is None else None
+        self._thread = None
+        self._file_digest = None
+        self._error = None
+
+    def update(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+
+    def hash_file(self):
+        """缓存中没有摘要时在后台线程读取整个文件计算摘要（与发送并行）"""
+        if self.digest is None and self._thread is None:
+            self._thread = threading.Thread(target=self._hash_file, name='send-digest', daemon=True)
+            self._thread.start()
+
+    def _hash_file(self):
+        try:
+            self._file_digest = compute_digest(self.path, self.algorithm)
+        except OSError as e:
+            self._error = e
+
+    def finish(self, sock):
+        """发送摘要消息，新计算的摘要记入哈希缓存；后台计算的摘要在这里等待完成"""
+        digest = self.digest
+        if digest is None:
+            if self._thread is None:
+                digest = self._hash.hexdigest()
+            else:
+                self._thread.join()
+                digest = self._file_digest
+            if self._error is not None:
+                # 接收方只能接受未经校验的数据
+                logging.getLogger(__name__).warning('Cannot compute digest of %s: %s', self.path, self._error)
+            else:
+                _record(self.base_dir, self.path, self.st, digest, self.algorithm)
+        send_json(sock, {'type': 'file_digest', 'digest': digest})
+
+
+def start_send_digest(sock, base_dir, path, st, header):
+    """连接启用了传输摘要时在文件头中注明算法，返回 SendDigest，否则返回 None"""
+    algorithm = get_transfer_algorithm(sock)
+    if algorithm is None:
+        return None
+    header['digest_algorithm'] = algorithm
+    return SendDigest(base_dir, path, st, algorithm)
+
+
+# 接收方
+
+def start_receive_digest(header):
+    """文件头注明了摘要算法时返回对应的哈希对象，否则返回 None"""
+    algorithm = header.get('digest_algorithm')
+    return new_hash(algorithm) if algorithm else None
+
+
+def hash_received_file(header, path, length=None):
+    """文件头注明了摘要算法时，返回已用文件前 length 字节（默认整个文件）更新的哈希对象
+
+    数据不按顺序经过接收线程时使用（并行数据连接、续传时已有的前缀）。
+    """
+    digest = start_receive_digest(header)
+    if digest is None:
+        return None
+    with open(path, 'rb') as f:
+        remaining = length
+        while remaining is None or remaining > 0:
+            block = f.read(_READ_SIZE if remaining is None else min(remaining, _READ_SIZE))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest
+
+
+def discard_digest(sock, header):
+    """丢弃文件的数据后调用：文件头注明了摘要算法时读取并丢弃摘要消息"""
+    if header.get('digest_algorithm'):
+        msg = recv_json(sock)
+        if not msg or msg.get('type') != 'file_digest':
+            raise ConnectionError('Expected file digest from peer, got: %s' % msg)
+
+
+def verify_received(sock, header, temp_path, digest):
+    """读取发送方的摘要消息并与写入的数据比较；不一致时删除 .tmp 并返回 False
+
+    digest 为 None（文件头没有注明算法）时不读取摘要消息，直接返回 True。发送方无法
+    计算摘要时（读取失败）摘要为 None，只接受数据。
+    """
+    if digest is None:
+        return True
+    msg = recv_json(sock)
+    if not msg or msg.get('type') != 'file_digest':
+        raise ConnectionError('Expected file digest from peer, got: %s' % msg)
+    expected = msg.get('digest')
+    if expected is None or expected == digest.hexdigest():
+        return True
+    logging.getLogger(__name__).error('Digest mismatch for %s (expected %s, received %s), discarding it',
+                                      header['path'], expected, digest.hexdigest())
+    if temp_path is not None:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    return False
+
+
+def record_received(base_dir, out_path, header, digest):
+    """替换并设置修改时间后，把接收时计算的摘要记入本地哈希缓存"""
+    if digest is None:
+        return
+    try:
+        st = os.stat(out_path)
+    except OSError:
+        return
+    if st.st_size == header['size']:
+        _record(base_dir, out_path, st, digest.hexdigest(), header['digest_algorithm'])
@@ -3,86 +3,238 @@
 import logging
 from pathlib import Path
 
-from .helpers import send_json, recv_json, build_manifest
-from .file_transfer import send_file_by_rel, receive_file
+from .helpers import send_json, recv_json, build_manifest, fill_digests
+from .file_transfer import receive_file
+from .file_batch import send_files, receive_file_batch
+from .manifest_diff import differs, digest_paths, answer_digest_request, merge_digests
+from .protocol import (
+    build_hello, local_features, negotiate_features, negotiate_digest_algorithm, stream_params,
+    FEATURE_LAZY_HASH, FEATURE_MERKLE_TREE, FEATURE_MULTI_STREAM, FEATURE_DELTA_TRANSFER,
+    FEATURE_CHUNK_DEDUP, FEATURE_FILE_BATCH, FEATURE_RESUME, FEATURE_TRANSFER_DIGEST, FEATURE_SPARSE,
+    negotiate_settings, apply_settings
+)
+from .merkle import MerkleTree, exchange_tree, answer_tree_request
+from .multi_stream import new_stream_session, setup_stream_pool
+from .delta_transfer import send_signatures, receive_signatures
+from .chunk_store import (
+    dedup_candidates, send_chunk_lists, receive_chunk_list, send_chunk_haves, receive_chunk_haves,
+    index_in_background
+)
+from .want_scheduler import sort_wants
+from .compression import enable_framed_compression
+from .resume import send_resume_requests, receive_resume_request
+from .transfer_digest import enable_transfer_digest
+from .sparse import enable_sparse_transfer
+from .digest import DEFAULT_DIGEST
 
 
 def handle_unidirectional_send(sock, base_dir, log_callback=None):
-    """发送方逻辑：发送所有文件给接收方"""
+    """发送方逻辑：发送接收方缺少或不同的文件（旧版本接收方收到全部文件）"""
     base_dir = Path(base_dir)
-    my_manifest = build_manifest(base_dir)
     log_func = log_callback or logging.info
+    # 只收集大小和修改时间，摘要等接收方按需请求时再计算
+    my_manifest = build_manifest(base_dir, with_digests=False)
     log_func('Built local manifest with %d files', len(my_manifest))
-    
-    # 发送模式标识
-    send_json(sock, {'type': 'mode', 'mode': 'send'})
-    
-    # 发送文件清单
-    send_json(sock, {'type': 'manifest', 'manifest': my_manifest})
-    log_func('Sent manifest with %d files', len(my_manifest))
-    
-    # 等待接收方确认
-    msg = recv_json(sock)
+
+    # 发送模式标识（携带握手信息，旧版本接收方会忽略）
+    send_json(sock, {'type': 'mode', 'mode': 'send', 'hello': build_hello()})
+
+    tree = None
+    if FEATURE_MERKLE_TREE in local_features():
+        # 只发送根摘要，由接收方逐层请求有差异的目录；旧版本接收方视为空清单并接收全部文件
+        tree = MerkleTree(my_manifest)
+        send_json(sock, {'type': 'manifest', 'manifest': {}, 'tree_root': tree.root_digest,
+                         'count': len(my_manifest)})
+        log_func('Sent tree root for %d files', len(my_manifest))
+    else:
+        # 发送文件清单
+        send_json(sock, {'type': 'manifest', 'manifest': my_manifest})
+        log_func('Sent manifest with %d files', len(my_manifest))
+
+    # 等待接收方确认，期间响应摘要、目录列表和块列表请求，并保存块签名、续传请求和接收方已有的块
+    while True:
+        msg = recv_json(sock)
+        if msg and msg.get('type') == 'digest_request':
+            answer_digest_request(sock, base_dir, my_manifest, msg)
+            continue
+        if msg and msg.get('type') == 'tree_request' and tree is not None:
+            answer_tree_request(sock, tree, msg)
+            continue
+        if msg and msg.get('type') == 'signatures':
+            receive_signatures(sock, msg)
+            continue
+        if msg and msg.get('type') == 'resume':
+            receive_resume_request(sock, msg)
+            continue
+        if msg and msg.get('type') == 'chunk_request':
+            send_chunk_lists(sock, base_dir, msg.get('paths', []), log_func)
+            continue
+        if msg and msg.get('type') == 'chunk_have':
+            receive_chunk_haves(sock, msg)
+            continue
+        break
     if not msg or msg.get('type') != 'ready':
         log_func('Expected ready message from receiver, got: %s', msg)
         return
-    
-    # 发送所有文件
-    total_files = len(my_manifest)
-    sent_files = 0
-    for relpath in my_manifest:
-        try:
-            send_file_by_rel(sock, base_dir, relpath)
-            sent_files += 1
-            log_func('Progress: %d/%d files sent - %s', sent_files, total_files, relpath)
-        except Exception as e:
-            log_func('Failed to send file %s: %s', relpath, e)
-    
+
+    # 新版本接收方给出需要的文件列表，否则发送全部文件
+    files = msg.get('files')
+    if files is None:
+        files = list(my_manifest)
+    log_func('Receiver wants %d of %d files', len(files), len(my_manifest))
+    if FEATURE_MULTI_STREAM in local_features():
+        # 接收方给出令牌时，为大文件建立并行数据连接
+        setup_stream_pool(sock, msg.get('streams'), log_func)
+
+    # 接收方在确认中给出协商后的功能；旧版本接收方不认识批量消息
+    batched = FEATURE_FILE_BATCH in msg.get('features', [])
+    if msg.get('settings'):
+        # 接收方按双方的握手信息选出的传输参数
+        apply_settings(sock, msg['settings'], log_func)
+        if msg['settings']['codec']:
+            enable_framed_compression(sock)
+    if FEATURE_TRANSFER_DIGEST in msg.get('features', []):
+        # 按接收方协商的清单算法给出摘要
+        enable_transfer_digest(sock, msg.get('algorithm', DEFAULT_DIGEST))
+    if FEATURE_SPARSE in msg.get('features', []):
+        enable_sparse_transfer(sock)
+    sent_files, _ = send_files(sock, base_dir, files, log_func, batched, my_manifest)
+
     # 发送完成信号
     send_json(sock, {'type': 'done_sending'})
     log_func('All files sent successfully (%d files)', sent_files)
 
 
-def handle_unidirectional_receive(sock, base_dir, log_callback=None):
-    """接收方逻辑：接收所有来自发送方的文件"""
+def handle_unidirectional_receive(sock, base_dir, log_callback=None, listener=None):
+    """接收方逻辑：接收所有来自发送方的文件
+
+    listener 为接收方的监听套接字，用于接受发送方为大文件建立的并行数据连接。
+    """
     base_dir = Path(base_dir)
     log_func = log_callback or logging.info
-    
+
     # 接收模式标识
     msg = recv_json(sock)
     if not msg or msg.get('type') != 'mode' or msg.get('mode') != 'send':
         log_func('Expected send mode from sender, got: %s', msg)
         return
-    
+    sender_hello = msg.get('hello')
+    features = negotiate_features(sender_hello)
+    algorithm = negotiate_digest_algorithm(sender_hello)
+
     # 接收文件清单
     msg = recv_json(sock)
     if not msg or msg.get('type') != 'manifest':
         log_func('Expected manifest from sender, got: %s', msg)
         return
-    
+
     sender_manifest = msg['manifest']
-    log_func('Received manifest with %d files from sender', len(sender_manifest))
-    
+    my_manifest = None
+    if 'tree_root' in msg:
+        # 发送方只给出根摘要，沿摘要不同的目录取回其条目
+        my_manifest = build_manifest(base_dir, with_digests=False)
+        sender_manifest = exchange_tree(sock, MerkleTree(my_manifest), msg['tree_root'],
+                                        log_func, serve_peer=False)
+        if sender_manifest is None:
+            return
+        log_func('Sender has %d files, %d in changed directories',
+                 msg.get('count', 0), len(sender_manifest))
+    else:
+        log_func('Received manifest with %d files from sender', len(sender_manifest))
+        if FEATURE_LAZY_HASH in features:
+            my_manifest = build_manifest(base_dir, with_digests=False)
+
+    ready = {'type': 'ready', 'features': sorted(features), 'algorithm': algorithm}
+    settings = negotiate_settings(sender_hello)
+    if settings is not None:
+        apply_settings(sock, settings, log_func)
+        ready['settings'] = settings
+    if my_manifest is not None:
+        # 跳过大小、修改时间（必要时摘要）都相同的文件
+        request = digest_paths(my_manifest, sender_manifest)
+        if request:
+            send_json(sock, {'type': 'digest_request', 'algorithm': algorithm, 'paths': request})
+            fill_digests(base_dir, my_manifest, request, algorithm)
+            msg = recv_json(sock)
+            if not msg or msg.get('type') != 'digests':
+                log_func('Expected digests from sender, got: %s', msg)
+                return
+            merge_digests(sender_manifest, msg)
+        ready['files'] = [
+            rel for rel, meta in sender_manifest.items()
+            if rel not in my_manifest or differs(meta, my_manifest[rel], algorithm)
+        ]
+        # 发送方按请求顺序发送
+        ready['files'] = sort_wants(ready['files'], sender_manifest)
+        log_func('Requesting %d changed files', len(ready['files']))
+
+    session = None
+    if FEATURE_MULTI_STREAM in features and listener is not None:
+        session = new_stream_session()
+        ready['streams'] = stream_params(session)
+
+    if FEATURE_RESUME in features and ready.get('files'):
+        # 中断过的大文件只接收剩余部分
+        send_resume_requests(sock, base_dir, ready['files'], sender_manifest, log_func)
+
+    if FEATURE_DELTA_TRANSFER in features and ready.get('files'):
+        # 本地已有旧版本的大文件只接收变化部分
+        send_signatures(sock, base_dir, ready['files'], log_func)
+
+    if FEATURE_CHUNK_DEDUP in features and ready.get('files'):
+        # 大文件先取得块列表，只接收本地块索引中没有的块
+        sizes = {rel: sender_manifest[rel]['size'] for rel in ready['files']}
+        paths = dedup_candidates(base_dir, sizes, FEATURE_DELTA_TRANSFER in features)
+        if not _request_chunks(sock, base_dir, paths, log_func):
+            return
+
     # 发送确认信号
-    send_json(sock, {'type': 'ready'})
-    
+    send_json(sock, ready)
+    if session is not None:
+        setup_stream_pool(sock, sender_hello.get('streams'), log_func, listener, session)
+
     # 接收所有文件
     received_files = 0
-    total_files = len(sender_manifest)
-    
+    total_files = len(ready.get('files', sender_manifest))
+
     while True:
         msg = recv_json(sock)
         if not msg:
             break
-            
+
         if msg.get('type') == 'file':
             receive_file(sock, base_dir, msg)
             received_files += 1
             log_func('Progress: %d/%d files received - %s', received_files, total_files, msg['path'])
+        elif msg.get('type') == 'file_batch':
+            paths = receive_file_batch(sock, base_dir, msg)
+            received_files += len(paths)
+            log_func('Progress: %d/%d files received - batch of %d files',
+                     received_files, total_files, len(paths))
         elif msg.get('type') == 'done_sending':
             log_func('Sender finished sending all files')
             break
         else:
             log_func('Unexpected message type: %s', msg.get('type'))
-    
-    log_func('All files received successfully (%d files)', received_files)
\ No newline at end of file
+
+    log_func('All files received successfully (%d files)', received_files)
+    if FEATURE_CHUNK_DEDUP in features:
+        index_in_background(base_dir, log_func)
+
+
+def _request_chunks(sock, base_dir, paths, log_func):
+    """向发送方请求块列表并告诉它本地已有的块，成功返回True"""
+    if not paths:
+        return True
+    send_json(sock, {'type': 'chunk_request', 'paths': paths})
+    # 先读完所有块列表再回复，发送方不会在写块列表时等不到读取
+    lists = {}
+    for _ in paths:
+        msg = recv_json(sock)
+        if not msg or msg.get('type') != 'chunk_list':
+            log_func('Expected chunk list from sender, got: %s', msg)
+            return False
+        lists[msg['path']] = receive_chunk_list(sock, msg)
+    reused = sum(send_chunk_haves(sock, base_dir, rel, chunks, log_func) for rel, chunks in lists.items())
+    log_func('%d bytes of requested files are already present locally', reused)
+    return True
@@ -0,0 +1,64 @@
+"""目录遍历模块 - 基于 os.scandir 的（可并行）目录树遍历"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Windows 上 DirEntry.stat() 不提供 st_ino/st_dev，哈希缓存需要真实值
+_DIRENTRY_STAT_HAS_INODE = os.name != 'nt'
+
+
+def _scan_dir(path, prefix):
+    """扫描单个目录，返回 (文件列表, 子目录列表)
+
+    文件为 (相对路径, 完整路径, stat结果)；子目录为 (完整路径, 相对路径前缀)。
+    与 os.walk 一致：指向目录的符号链接不进入，损坏的链接跳过。
+    """
+    files = []
+    subdirs = []
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return files, subdirs
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, prefix + entry.name + '/'))
+                    continue
+                st = entry.stat() if _DIRENTRY_STAT_HAS_INODE else os.stat(entry.path)
+            except OSError:
+                continue
+            files.append((prefix + entry.name, entry.path, st))
+    return files, subdirs
+
+
+def walk_tree(base_dir, workers=1, skip_root_dirs=()):
+    """遍历目录树，产出 (相对路径, 完整路径, stat结果)
+
+    相对路径始终以 '/' 分隔，由字符串拼接得到。workers 大于1时目录扫描分派到
+    线程池，适合高延迟的网络盘或机械盘；结果顺序不固定。
+    """
+    base_dir = os.fspath(base_dir)
+    files, subdirs = _scan_dir(base_dir, '')
+    subdirs = [d for d in subdirs if d[1][:-1] not in skip_root_dirs]
+    yield from files
+
+    if workers <= 1:
+        stack = subdirs[::-1]
+        while stack:
+            path, prefix = stack.pop()
+            files, children = _scan_dir(path, prefix)
+            yield from files
+            stack.extend(reversed(children))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan_dir, path, prefix) for path, prefix in subdirs}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, children = future.result()
+                for path, prefix in children:
+                    pending.add(pool.submit(_scan_dir, path, prefix))
+                yield from files
@@ -0,0 +1,99 @@
+"""需求调度模块 - 按策略排序需求文件，分块发出并限制未完成的请求数
+
+请求方不再一次发出完整的需求列表：需求文件先按策略排序，每条 want 消息只带
+一小块，未完成（已请求但还没收到）的文件数达到上限后，等收到文件再发下一块。
+对端收到第一块即开始发送，请求方也可以随时把更紧急的文件排到前面。
+
+策略：smallest（小文件优先，尽快得到可用的文件）、largest（大文件优先，
+缩短尾部延迟）、newest（最近修改的优先）、manifest（清单顺序）。
+"""
+
+import heapq
+import logging
+
+from .helpers import get_want_policy, get_want_in_flight, get_want_chunk_size
+
+POLICIES = {
+    'smallest': lambda meta: meta.get('size', 0),
+    'largest': lambda meta: -meta.get('size', 0),
+    'newest': lambda meta: -meta.get('mtime', 0),
+    'manifest': lambda meta: 0,
+}
+
+
+def order_key(policy):
+    """返回策略的排序键函数（参数为清单条目），未知策略按清单顺序"""
+    key = POLICIES.get(policy)
+    if key is None:
+        logging.getLogger(__name__).warning('Unknown want policy %r, using manifest order', policy)
+        key = POLICIES['manifest']
+    return key
+
+
+def sort_wants(files, metas, policy=None):
+    """按策略排序需求文件（metas 为 {相对路径: 清单条目}），相同键保持原顺序"""
+    key = order_key(policy or get_want_policy())
+    return sorted(files, key=lambda rel: key(metas.get(rel, {})))
+
+
+class WantScheduler:
+    """待请求文件的优先队列和未完成请求计数
+
+    不是线程安全的，由调用方的锁保护。pipelined 为 False（对端不支持或未启用）
+    时不限制未完成数，每次取出全部待请求文件。
+    """
+
+    def __init__(self, pipelined=True, policy=None):
+        self._key = order_key(policy or get_want_policy())
+        self.in_flight = get_want_in_flight() if pipelined else 0
+        self.chunk_size = get_want_chunk_size() if pipelined else 0
+        self._heap = []
+        self._seq = 0
+        self.outstanding = 0
+        self._finished = False
+        # 已发出 more 为 False 的需求；之后（监视模式）的需求都带 more=True
+        self.final_sent = False
+
+    @property
+    def pending(self):
+        return len(self._heap)
+
+    def add(self, items):
+        """加入 (相对路径, 清单条目) 序列"""
+        for rel, meta in items:
+            heapq.heappush(self._heap, (self._key(meta), self._seq, rel))
+            self._seq += 1
+
+    def finish(self):
+        """不会再有新的需求（监视模式之后仍可加入）"""
+        self._finished = True
+
+    def completed(self, count=1):
+        """收到（或对端报告无法发送）count 个已请求的文件"""
+        self.outstanding = max(0, self.outstanding - count)
+
+    def _free(self):
+        if self.in_flight <= 0:
+            return len(self._heap)
+        return self.in_flight - self.outstanding
+
+    def ready(self):
+        """是否应发出下一条需求：窗口能容纳一整块（或剩余全部），或需要发出最后的需求"""
+        if self._heap:
+            wanted = len(self._heap) if self.chunk_size <= 0 else min(self.chunk_size, len(self._heap))
+            if self.in_flight > 0:
+                wanted = min(wanted, self.in_flight)
+            return self._free() >= wanted
+        return self._finished and not self.final_sent
+
+    def next_want(self):
+        """取出下一条 want 消息"""
+        count = min(self._free(), len(self._heap))
+        if self.chunk_size > 0:
+            count = min(count, self.chunk_size)
+        files = [heapq.heappop(self._heap)[2] for _ in range(count)]
+        self.outstanding += count
+        more = self.final_sent or not (self._finished and not self._heap)
+        if not more:
+            self.final_sent = True
+        return {'type': 'want', 'files': files, 'more': more}
@@ -0,0 +1,132 @@
+"""持续监视同步模块 - 初始同步后保持连接，只推送发生变化的文件条目"""
+
+import time
+
+from .helpers import (
+    SYNC_META_DIR, build_manifest, fill_digests, stat_entry,
+    get_watch_debounce, get_watch_rescan_interval
+)
+from .inotify import DirectoryWatcher
+from .stream_sync import StreamingSync
+from .chunk_store import index_in_background
+
+# 事件持续不断时，最多合并这么多个防抖周期后强制推送
+MAX_DEBOUNCE_ROUNDS = 10
+
+
+def _same_stat(a, b):
+    return a is not None and b is not None and a['size'] == b['size'] and a['mtime'] == b['mtime']
+
+
+class WatchSync(StreamingSync):
+    """持续监视会话
+
+    先像流式同步一样交换完整清单，之后连接保持打开：inotify 报告的路径经过防抖
+    合并后，把大小或修改时间变化的条目作为新的清单批次发给对端，对端按原有逻辑
+    请求文件。定期完整扫描一次，补上 inotify 漏报（或不可用时）的变化。
+    收到的文件同样会触发事件，推送前先按收到时的状态记录，不会回传给对端。
+    """
+
+    def __init__(self, sock, base_dir, algorithm, lazy, log_func, binary=False, delta=False,
+                 dedup=False, batched=False, pipelined=False, resume=False):
+        super().__init__(sock, base_dir, algorithm, lazy, log_func, binary, keep_manifest=True,
+                         delta=delta, dedup=dedup, batched=batched, pipelined=pipelined, resume=resume)
+
+    def run(self):
+        """持续同步，直到连接关闭"""
+        self._start_threads()
+        watcher = None
+        try:
+            # 先建立监视再扫描，扫描期间的修改不会漏掉
+            watcher = DirectoryWatcher(self.base_dir, skip_root_dirs=(SYNC_META_DIR,))
+        except OSError as e:
+            self.log_func('inotify unavailable (%s), relying on periodic rescans', e)
+        try:
+            self._stream_local_manifest()
+            self._watch_loop(watcher)
+        except Exception as e:
+            if not self._closed:
+                self.log_func('Watch error: %s', e)
+        finally:
+            if watcher is not None:
+                watcher.close()
+            self._close()
+        self.log_func('Watch session ended, requested %d files from peer', self._wanted)
+
+    def _watch_loop(self, watcher):
+        debounce = get_watch_debounce()
+        interval = get_watch_rescan_interval()
+        next_rescan = time.monotonic() + interval
+        pending = set()
+        first_event = deadline = None
+
+        while not self._closed:
+            now = time.monotonic()
+            wake = min(next_rescan, deadline) if deadline else next_rescan
+            # 定期醒来检查连接是否已关闭
+            timeout = min(max(wake - now, 0), 1.0)
+            if watcher is not None:
+                changed, overflow = watcher.poll(timeout)
+            else:
+                time.sleep(timeout)
+                changed, overflow = set(), False
+
+            now = time.monotonic()
+            if changed:
+                pending |= changed
+                if first_event is None:
+                    first_event = now
+                deadline = min(now + debounce, first_event + debounce * MAX_DEBOUNCE_ROUNDS)
+
+            if overflow or now >= next_rescan:
+                if overflow:
+                    self.log_func('inotify event queue overflowed, rescanning')
+                self._rescan()
+                pending = set()
+                first_event = deadline = None
+                next_rescan = now + interval
+            elif deadline and now >= deadline:
+                self._push_paths(pending)
+                pending = set()
+                first_event = deadline = None
+
+    def _push_paths(self, paths):
+        """重新读取路径的状态，把变化的条目发送给对端"""
+        current = {}
+        for rel in paths:
+            entry = stat_entry(self.base_dir, rel)
+            if entry is None:
+                # 不传播删除，只更新已发送的记录
+                self.manifest.pop(rel, None)
+            else:
+                current[rel] = entry
+        self._push_changes(current)
+
+    def _rescan(self):
+        if self.dedup:
+            # 连接空闲时补齐块索引，之后的变化文件可以使用
+            index_in_background(self.base_dir, self.log_func)
+        manifest = build_manifest(self.base_dir, with_digests=False)
+        for rel in [rel for rel in self.manifest if rel not in manifest]:
+            del self.manifest[rel]
+        self._push_changes(manifest)
+
+    def _absorb_received(self):
+        """把从对端收到的文件记为已同步状态"""
+        while self.received:
+            rel = self.received.pop()
+            entry = stat_entry(self.base_dir, rel)
+            if entry is not None:
+                self.manifest[rel] = entry
+
+    def _push_changes(self, entries):
+        self._absorb_received()
+        changed = {rel: entry for rel, entry in entries.items()
+                   if not _same_stat(entry, self.manifest.get(rel))}
+        if not changed:
+            return
+        self.manifest.update(changed)
+        if not self.lazy:
+            fill_digests(self.base_dir, changed, list(changed), self.algorithm)
+        self._send_batch(changed)
+        self.log_func('Pushed %d changed entries to peer', len(changed))
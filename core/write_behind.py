@@ -0,0 +1,89 @@
+"""后台写入模块 - 接收线程只读套接字，写入线程把数据写入文件
+
+单线程接收时 recv 和 write 交替进行：磁盘刷写时网络数据停在内核缓冲区，读取
+套接字时磁盘又空闲。后台写入把两者分开：接收线程把数据直接读入空闲缓冲区后放入
+有界队列，写入线程依次取出写入文件（并计算传输摘要），写完的缓冲区再交还接收
+线程。缓冲区数量固定，内存占用为 write_behind_depth × write_behind_buffer_size。
+
+文件先按文件头给出的大小预分配，减少碎片和写入时的块分配停顿。
+"""
+
+import queue
+import threading
+
+from .helpers import (
+    preallocate_file, get_write_behind_depth, get_write_behind_buffer_size, get_write_behind_threshold
+)
+from .multi_stream import IncompleteTransfer
+
+
+def use_write_behind(size):
+    """文件是否足够大、值得使用后台写入"""
+    return get_write_behind_depth() > 0 and size >= get_write_behind_threshold()
+
+
+class WriteBehind:
+    """一个文件的后台写入；receive 在接收线程调用，finish 等待写完"""
+
+    def __init__(self, f, size, digest=None, depth=None, buffer_size=None):
+        self.f = f
+        self.digest = digest
+        self.written = 0
+        self.error = None
+        depth = max(1, depth or get_write_behind_depth())
+        buffer_size = min(buffer_size or get_write_behind_buffer_size(), max(size, 1))
+        preallocate_file(f.fileno(), size)
+        self._free = queue.Queue()
+        for _ in range(depth):
+            self._free.put(memoryview(bytearray(buffer_size)))
+        self._filled = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self._filled.get()
+            if item is None:
+                return
+            buf, count = item
+            if self.error is None:
+                try:
+                    with buf[:count] as data:
+                        if self.digest is not None:
+                            self.digest.update(data)
+                        self.f.write(data)
+                    self.written += count
+                except OSError as e:
+                    # 出错后仍然归还缓冲区，接收线程不会卡住
+                    self.error = e
+            self._free.put(buf)
+
+    def receive(self, reader, n):
+        """从读取器接收 n 字节交给写入线程，连接关闭或写入出错时抛出异常"""
+        remaining = n
+        while remaining:
+            buf = self._free.get()
+            count = min(len(buf), remaining)
+            if not reader.read_into(buf[:count]):
+                self._free.put(buf)
+                raise ConnectionError('Unexpected EOF during file transfer')
+            self._filled.put((buf, count))
+            remaining -= count
+            if self.error is not None:
+                raise self.error
+        return n
+
+    def finish(self):
+        """等待写入线程写完，返回写入的字节数；少于预分配的大小时截掉多余部分"""
+        self._filled.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        self.f.truncate(self.written)
+        return self.written
+
+    def abort(self, cause):
+        """接收中途出错：停止写入线程，抛出带已写入前缀长度的 IncompleteTransfer"""
+        self._filled.put(None)
+        self._thread.join()
+        raise IncompleteTransfer('File transfer interrupted: %s' % cause, self.written) from cause
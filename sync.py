@@ -5,6 +5,7 @@
   双向同步模式:
     监听方（机器 A）: python sync.py --listen --port 9000
     连接方（机器 B）: python sync.py --connect 192.168.1.100 --port 9000
+    持续同步（双方都加 --watch）: python sync.py --listen --watch
 
   单向传输模式（发送方 -> 接收方）:
     发送方: python sync.py --send --port 9000
@@ -13,7 +14,7 @@
 在当前工作目录下运行脚本（脚本会同步该目录及子目录）。
 
 协议概述：
-- 双方交换清单（relative path, size, mtime, sha256）
+- 双方交换清单（relative path, size, mtime），只为大小相同但 mtime 不同的文件补充交换 sha256
 - 双向模式：双方各生成想要从对方获取的文件列表并发送请求
 - 单向模式：发送方发送所有文件给接收方
 - 传输使用简单 JSON 报文（4 字节长度前缀 + JSON）和原始字节流传输文件内容
@@ -33,6 +34,7 @@ if str(project_root) not in sys.path:
     sys.path.insert(0, str(project_root))
 
 from core import run_listen, run_connect, run_send, run_receive
+from core.helpers import set_performance_option
 
 
 def main():
@@ -48,15 +50,23 @@ def main():
     group.add_argument('--receive', action='store_true', help='run as receiver (unidirectional)')
     parser.add_argument('--port', type=int, default=9000, help='port to listen/connect (default: 9000)')
     parser.add_argument('--bind', default='0.0.0.0', help='bind address for listen (default: 0.0.0.0)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep the connection open and push changes as they happen (bidirectional, both sides)')
+    parser.add_argument('--no-hash-cache', action='store_true', help='re-hash every file instead of using the hash cache')
     args = parser.parse_args()
+    if args.watch and not (args.listen or args.connect):
+        parser.error('--watch requires --listen or --connect')
+    
+    if args.no_hash_cache:
+        set_performance_option('use_hash_cache', False)
     
     cwd = os.getcwd()
     logging.info('Working dir: %s', cwd)
     
     if args.listen:
-        run_listen(args.port, cwd, bind=args.bind)
+        run_listen(args.port, cwd, bind=args.bind, watch=args.watch)
     elif args.connect:
-        run_connect(args.connect, args.port, cwd)
+        run_connect(args.connect, args.port, cwd, watch=args.watch)
     elif args.send:
         run_send(args.send, args.port, cwd)  # args.send now contains the host
     elif args.receive:
@@ -73,10 +73,17 @@ class PerformanceTab(QtWidgets.QWidget):
         self.thread_count_spin.setValue(4)
         self.thread_count_spin.setToolTip("并发传输线程数，较多的线程可以提高多文件传输速度")
         
+        # 哈希并行数
+        self.hash_workers_spin = QtWidgets.QSpinBox()
+        self.hash_workers_spin.setRange(0, 64)
+        self.hash_workers_spin.setSpecialValueText("自动")
+        self.hash_workers_spin.setToolTip("构建文件清单时并行计算哈希的线程数，自动表示按CPU核数")
+        
         form_layout.addRow('数据块大小:', self.chunk_size_combo)
         form_layout.addRow('缓冲区大小:', self.buffer_size_combo)
         form_layout.addRow('', self.nagle_checkbox)
         form_layout.addRow('并发线程数:', self.thread_count_spin)
+        form_layout.addRow('哈希并行数:', self.hash_workers_spin)
         layout.addWidget(performance_group)
         
         # === 高级优化设置 ===
@@ -112,12 +119,21 @@ class PerformanceTab(QtWidgets.QWidget):
         self.compression_threshold_combo.addItem("10MB", 10485760)
         self.compression_threshold_combo.setToolTip("文件大小超过此阈值时启用压缩")
         
+        # 哈希缓存
+        self.hash_cache_checkbox = QtWidgets.QCheckBox("启用哈希缓存 (推荐)")
+        self.hash_cache_checkbox.setToolTip("缓存未变化文件的摘要，避免每次同步重新计算哈希")
+        
+        self.hash_cache_xattr_checkbox = QtWidgets.QCheckBox("哈希缓存写入扩展属性 (仅Linux)")
+        self.hash_cache_xattr_checkbox.setToolTip("将摘要保存在文件的扩展属性中，不支持时自动回退到缓存文件")
+        
         optimization_layout.addRow('', self.memory_mapping_checkbox)
         optimization_layout.addRow('', self.stream_protocol_checkbox)
         optimization_layout.addRow('', self.dynamic_chunk_checkbox)
         optimization_layout.addRow('', self.adaptive_threading_checkbox)
         optimization_layout.addRow('', self.compression_checkbox)
         optimization_layout.addRow('压缩阈值:', self.compression_threshold_combo)
+        optimization_layout.addRow('', self.hash_cache_checkbox)
+        optimization_layout.addRow('', self.hash_cache_xattr_checkbox)
         layout.addWidget(optimization_group)
         
         # === 性能测试区域 ===
@@ -194,6 +210,7 @@ class PerformanceTab(QtWidgets.QWidget):
         # 设置线程数
         thread_count = performance_config.get('thread_count', 4)
         self.thread_count_spin.setValue(thread_count)
+        self.hash_workers_spin.setValue(performance_config.get('hash_workers', 0))
         
         # 设置高级优化选项
         self.memory_mapping_checkbox.setChecked(
@@ -212,6 +229,13 @@ class PerformanceTab(QtWidgets.QWidget):
             performance_config.get('enable_compression', False)
         )
         
+        self.hash_cache_checkbox.setChecked(
+            performance_config.get('use_hash_cache', True)
+        )
+        self.hash_cache_xattr_checkbox.setChecked(
+            performance_config.get('hash_cache_xattr', False)
+        )
+        
         # 设置压缩阈值
         compression_threshold = performance_config.get('compression_threshold', 1048576)
         index = self.compression_threshold_combo.findData(compression_threshold)
@@ -238,6 +262,7 @@ class PerformanceTab(QtWidgets.QWidget):
         self.buffer_size_combo.setCurrentIndex(2)  # 1MB
         self.nagle_checkbox.setChecked(True)
         self.thread_count_spin.setValue(4)
+        self.hash_workers_spin.setValue(0)
         
         self.status_label.setText("已重置为默认配置")
         self.status_label.setStyleSheet("color: blue; font-weight: bold;")
@@ -250,11 +275,14 @@ class PerformanceTab(QtWidgets.QWidget):
     
     def _save_settings(self):
         """保存当前设置到配置管理器"""
-        performance_config = {
+        # 保留界面上未提供的配置项
+        performance_config = dict(self.config_manager.get_performance_config())
+        performance_config.update({
             'chunk_size': self.chunk_size_combo.currentData(),
             'socket_buffer_size': self.buffer_size_combo.currentData(),
             'disable_nagle': self.nagle_checkbox.isChecked(),
             'thread_count': self.thread_count_spin.value(),
+            'hash_workers': self.hash_workers_spin.value(),
             'use_memory_mapping': self.memory_mapping_checkbox.isChecked(),
             'use_stream_protocol': self.stream_protocol_checkbox.isChecked(),
             'dynamic_chunk_size': self.dynamic_chunk_checkbox.isChecked(),
@@ -262,8 +290,10 @@ class PerformanceTab(QtWidgets.QWidget):
             'enable_compression': self.compression_checkbox.isChecked(),
             'compression_threshold': self.compression_threshold_combo.currentData(),
             'max_chunk_size': 1048576,  # 1MB
-            'min_chunk_size': 65536     # 64KB
-        }
+            'min_chunk_size': 65536,    # 64KB
+            'use_hash_cache': self.hash_cache_checkbox.isChecked(),
+            'hash_cache_xattr': self.hash_cache_xattr_checkbox.isChecked()
+        })
         self.config_manager.set_performance_config(performance_config)
     
     def on_run_test(self):